@@ -1,50 +1,2442 @@
+import array
+import asyncio
+import contextlib
+import datetime
+import functools
+import hashlib
+import io
+import itertools
+import json
+import math
+import mmap
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import weakref
+import xml.etree.ElementTree as ElementTree
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import resource_tracker, shared_memory
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+try:
+    import numpy as np
+except ImportError: # numpy is only needed for the array results
+    np = None
+
+try:
+    import aiohttp
+except ImportError: # aiohttp is only needed for AsyncDbc
+    aiohttp = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError: # pyarrow is only needed for ArrowSink
+    pa = None
+
+
+# status codes of the server after which a query is sent again
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+# errors raised by dbc.send_query, so callers can tell which failures are worth retrying
+class WCPSError(Exception):
+    # base class for every error that comes back from talking to a WCPS server
+    retryable = False
+
+
+class QueryError(WCPSError, ValueError):
+    # the server rejected the query itself (4xx), sending it again won't help
+    retryable = False
+
+
+class ServerError(WCPSError):
+    # the server failed while processing a query (5xx), still failing after all retries
+    retryable = True
+
+
+class ConnectionFailed(WCPSError):
+    # the server couldn't be reached, the connection was reset or timed out
+    retryable = True
+
+
+def normalize_query(wcps_query):
+    
+   # Collapses every run of whitespace outside of string literals into one space, so that the same query written differently gets the same cache key.
+
+    parts = re.split(r'("[^"]*")', wcps_query)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'\s+', ' ', parts[i])
+    return ''.join(parts).strip()
+
+
+# in-memory result cache
+class ResultCache:
+    """
+    Keeps the responses of recent queries in memory, so that a query which is sent again within 'ttl'
+        seconds doesn't go to the server. When the responses take up more than 'max_bytes', the least
+        recently used ones are evicted. The cache is thread-safe and can be shared by several dbc
+        instances.
+
+    Example:
+        >>> my_dbc = dbc("https://ows.rasdaman.org/rasdaman/ows", cache = ResultCache(ttl = 600))
+
+    """
+    def __init__(self, max_bytes = 256 * 1024 * 1024, ttl = 300):
+        if not isinstance(max_bytes, int) or max_bytes < 1:
+            raise ValueError("Cache size must be a positive integer")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expiry time, response)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        
+       # Returns the cached response of 'key', or None if it's missing or expired.
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and entry[0] < time.monotonic():
+                self.remove(key)
+                entry = None
+            if entry == None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, response):
+        
+       # Stores a response, evicting the least recently used ones if the cache gets too big.
+
+        size = len(response.content)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, response)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        self.size -= len(self.entries.pop(key)[1].content)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        
+       # Returns the hit/miss/eviction counters and the current size of the cache.
+
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.size}
+
+
+def write_atomically(path, data):
+    
+   # Writes to a temporary file next to 'path' and renames it, readers see either nothing or the whole file.
+
+    handle, temporary_path = tempfile.mkstemp(dir = os.path.dirname(path), prefix = '.tmp-')
+    try:
+        with os.fdopen(handle, 'wb') as temporary_file:
+            temporary_file.write(data)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+# persistent on-disk result cache
+class DiskCache:
+    """
+    Keeps the responses of queries on disk, so that they survive restarts and can be shared by all
+        worker processes of a node that point to the same 'directory'. Responses are stored by the
+        hash of their content next to a small JSON index entry per query (query hash, format,
+        timestamp, size). All files are written atomically, so concurrent writers can't see half
+        written entries. Cached responses are read through mmap, their content is a read-only
+        memory-mapped buffer instead of a bytes object.
+
+    Parameters:
+        directory (str): Where the cache lives, created if it doesn't exist.
+        max_bytes (int): Total size of the stored responses, the least recently used ones are
+            evicted beyond it.
+        ttl (float): Seconds after which an entry expires, None to keep entries until evicted.
+
+    """
+    def __init__(self, directory, max_bytes = 1024 * 1024 * 1024, ttl = None):
+        if not isinstance(directory, str):
+            raise TypeError("Value entered must be a string.")
+        if not isinstance(max_bytes, int) or max_bytes < 1:
+            raise ValueError("Cache size must be a positive integer")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.objects_dir = os.path.join(directory, 'objects')
+        self.index_dir = os.path.join(directory, 'index')
+        os.makedirs(self.objects_dir, exist_ok = True)
+        os.makedirs(self.index_dir, exist_ok = True)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.size = self.stored_bytes()
+
+    def index_path(self, key):
+        url, query = key
+        return os.path.join(self.index_dir, hashlib.sha256(f'{url}\n{query}'.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key):
+        
+       # Returns the cached response of 'key' with its content memory-mapped, or None if it's missing or expired.
+
+        path = self.index_path(key)
+        try:
+            with open(path, encoding = 'utf-8') as index_file:
+                entry = json.load(index_file)
+            if self.ttl != None and entry['timestamp'] + self.ttl < time.time():
+                os.remove(path)
+                raise FileNotFoundError(path)
+            with open(os.path.join(self.objects_dir, entry['object']), 'rb') as object_file:
+                content = mmap.mmap(object_file.fileno(), 0, access = mmap.ACCESS_READ) if entry['size'] else b''
+            # the modification time of the index entry is its last use, for the LRU eviction
+            os.utime(path)
+        except (FileNotFoundError, ValueError, KeyError):
+            # missing, expired, evicted by another worker in the meantime, or unreadable
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return WCPSResponse(200, content, {'Content-Type': entry['format']}, key[0])
+
+    def put(self, key, response):
+        
+       # Stores a response, evicting the least recently used ones if the cache gets too big.
+
+        content = response.content
+        size = len(content)
+        if size > self.max_bytes:
+            return
+        url, query = key
+        object_name = hashlib.sha256(content).hexdigest()
+        object_path = os.path.join(self.objects_dir, object_name)
+        if not os.path.exists(object_path):
+            write_atomically(object_path, content)
+            with self.lock:
+                self.size += size
+        entry = {'object': object_name, 'query_hash': hashlib.sha256(query.encode('utf-8')).hexdigest(),
+                 'url': url, 'format': response.headers.get('Content-Type', ''), 'timestamp': time.time(),
+                 'size': size}
+        write_atomically(self.index_path(key), json.dumps(entry).encode('utf-8'))
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def stored_bytes(self):
+        total = 0
+        with os.scandir(self.objects_dir) as entries:
+            for entry in entries:
+                if not entry.name.startswith('.tmp-'):
+                    try:
+                        total += entry.stat().st_size
+                    except FileNotFoundError:
+                        pass
+        return total
+
+    def evict(self):
+        
+       # Removes expired entries and unreferenced objects, then the least recently used entries until the stored objects fit into 'max_bytes'.
+
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.index_dir):
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(self.index_dir, name)
+                try:
+                    with open(path, encoding = 'utf-8') as index_file:
+                        entries.append((os.stat(path).st_mtime, path, json.load(index_file)))
+                except (FileNotFoundError, ValueError):
+                    pass
+            entries.sort(key = lambda entry: entry[0])
+            # expired entries go first, without counting as evictions
+            now = time.time()
+            live = []
+            for entry in entries:
+                if self.ttl != None and entry[2]['timestamp'] + self.ttl < now:
+                    try:
+                        os.remove(entry[1])
+                    except FileNotFoundError:
+                        pass
+                else:
+                    live.append(entry)
+            entries = live
+            # an object can be shared by several queries with the same result
+            references = {}
+            for _, _, entry in entries:
+                references[entry['object']] = references.get(entry['object'], 0) + 1
+            # then the objects that no entry points to any more, e.g. of replaced or expired entries
+            # (an object that a concurrent put() hasn't indexed yet is lost as well, which is only a miss)
+            for name in os.listdir(self.objects_dir):
+                if not name.startswith('.tmp-') and not (name in references):
+                    try:
+                        os.remove(os.path.join(self.objects_dir, name))
+                    except FileNotFoundError:
+                        pass
+            size = self.stored_bytes()
+            for _, path, entry in entries:
+                if size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self.evictions += 1
+                references[entry['object']] -= 1
+                if references[entry['object']] == 0:
+                    try:
+                        os.remove(os.path.join(self.objects_dir, entry['object']))
+                        size -= entry['size']
+                    except FileNotFoundError:
+                        pass
+            self.size = size
+
+    def clear(self):
+        with self.lock:
+            for directory in (self.index_dir, self.objects_dir):
+                for name in os.listdir(directory):
+                    try:
+                        os.remove(os.path.join(directory, name))
+                    except FileNotFoundError:
+                        pass
+            self.size = 0
+
+    def stats(self):
+        
+       # Returns the hit/miss/eviction counters of this process and the current size of the cache.
+
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(os.listdir(self.index_dir)), 'bytes': self.size}
+
+
+# cell types of the bands of a coverage, as named in DescribeCoverage, with their numpy dtype
+BAND_TYPES = {'boolean': 'bool', 'char': 'uint8', 'unsignedByte': 'uint8', 'uint8': 'uint8', 'octet': 'int8',
+              'signedByte': 'int8', 'int8': 'int8', 'short': 'int16', 'signedShort': 'int16', 'int16': 'int16',
+              'ushort': 'uint16', 'unsignedShort': 'uint16', 'uint16': 'uint16', 'long': 'int32',
+              'signedInt': 'int32', 'int': 'int32', 'int32': 'int32', 'ulong': 'uint32', 'unsignedInt': 'uint32',
+              'uint32': 'uint32', 'float': 'float32', 'float32': 'float32', 'double': 'float64', 'float64': 'float64'}
+BAND_SIZES = {'bool': 1, 'uint8': 1, 'int8': 1, 'int16': 2, 'uint16': 2, 'int32': 4, 'uint32': 4, 'float32': 4,
+              'float64': 8}
+# typical bytes of one cell in a CSV result, with its comma, to compare against BAND_SIZES
+CSV_CELL_BYTES = {'bool': 2, 'uint8': 4, 'int8': 4, 'int16': 6, 'uint16': 6, 'int32': 8, 'uint32': 8, 'float32': 10,
+                  'float64': 14}
+
+
+def iso_key(value):
+    
+   # Makes dates comparable as strings: "2014-07" -> '2014-07-01T00:00:00', timezones and fractions are dropped.
+
+    text = value.strip().strip('"').rstrip('Z')
+    return text[:19] + '0000-01-01T00:00:00'[len(text[:19]):]
+
+
+class AxisMetadata:
+    # one axis of a coverage: its extent in coordinates and in cells
+    def __init__(self, name, lower, upper, size, resolution = None, coefficients = None):
+        self.name = name
+        self.lower = lower
+        self.upper = upper
+        self.size = size
+        self.resolution = resolution
+        # coordinates of the cells of irregular axes, e.g. the months of a time axis
+        self.coefficients = coefficients
+        self.is_time = isinstance(lower, str)
+
+    def key(self, value):
+        
+       # Turns a subset bound of this axis into something comparable with its extent.
+
+        if self.is_time:
+            return iso_key(value)
+        return float(value)
+
+    def contains(self, value):
+        if value.strip() == '*':
+            return True
+        low, high = self.key(self.lower), self.key(self.upper)
+        # the envelope goes around the cells, a bound can lie half a cell outside of their centers
+        return min(low, high) <= self.key(value) <= max(low, high)
+
+    def count_cells(self, low, high):
+        
+       # Estimates the number of cells of the axis between two subset bounds.
+
+        low = str(self.lower) if low.strip() == '*' else low
+        high = str(self.upper) if high.strip() == '*' else high
+        if self.coefficients:
+            return len(self.slices(low, high)) or 1
+        if self.is_time:
+            days = (datetime.date.fromisoformat(iso_key(high)[:10]) - datetime.date.fromisoformat(iso_key(low)[:10])).days
+            return min(self.size, int(days / abs(self.resolution or 1)) + 1)
+        if not self.resolution:
+            return self.size
+        # rounded a little up, so that e.g. 0.3 / 0.1 = 2.9999999999999996 counts 4 cells, not 3
+        return min(self.size, int(abs(float(high) - float(low)) / abs(self.resolution) + 1e-9) + 1)
+
+    def slices(self, low, high):
+        
+       # The coordinates of the cells of an irregular axis between two subset bounds, in the order of the axis.
+
+        low = self.key(str(self.lower) if low.strip() == '*' else low)
+        high = self.key(str(self.upper) if high.strip() == '*' else high)
+        return [coefficient for coefficient in self.coefficients or [] if low <= self.key(coefficient) <= high]
+
+
+class CoverageMetadata:
+    """
+    What DescribeCoverage tells about a coverage: its axes with their extents and resolutions, the
+        CRS, and the name, cell type and nodata values of every band.
+
+    """
+    def __init__(self, name, axes, crs = None, bands = None):
+        self.name = name
+        self.axes = axes
+        self.crs = crs
+        # list of (band name, numpy dtype, list of nodata values)
+        self.bands = bands if bands != None else []
+
+    def axis(self, name):
+        # an axis by name, also for subsets in grid coordinates like ansi:"CRS:1"
+        name = name.split(':')[0]
+        for axis in self.axes:
+            if axis.name == name:
+                return axis
+        raise ValueError(f"Coverage {self.name} has no axis {name}, only {[axis.name for axis in self.axes]}")
+
+    def cell_size(self):
+        # bytes of one cell with all its bands
+        return sum(BAND_SIZES.get(dtype, 8) for _, dtype, _ in self.bands) or 8
+
+    @classmethod
+    def from_xml(cls, name, document):
+        
+       # Parses a DescribeCoverage (WCS 2.0) response, namespaces are ignored.
+
+        root = ElementTree.fromstring(document)
+        elements = {}
+        for element in root.iter():
+            elements.setdefault(element.tag.split('}')[-1], []).append(element)
+        if not ('Envelope' in elements):
+            raise ValueError(f"No description of coverage {name} found")
+        tokens = lambda text: re.findall(r'"[^"]*"|\S+', text or '')
+        envelope = elements['Envelope'][0]
+        labels = envelope.get('axisLabels', '').split()
+        lower = tokens(next(e for e in envelope if e.tag.endswith('lowerCorner')).text)
+        upper = tokens(next(e for e in envelope if e.tag.endswith('upperCorner')).text)
+        sizes = [None] * len(labels)
+        if 'low' in elements and 'high' in elements:
+            sizes = [int(high) - int(low) + 1
+                     for low, high in zip(elements['low'][0].text.split(), elements['high'][0].text.split())]
+        # regular axes have an offset vector with one non-zero entry, irregular ones a list of coefficients
+        resolutions = {}
+        for vector in elements.get('offsetVector', []):
+            values = [float(value) for value in tokens(vector.text) if not value.startswith('"')]
+            for index, value in enumerate(values):
+                if value != 0 and index < len(labels):
+                    resolutions[labels[index]] = value
+        coefficients = {}
+        for grid_axis in elements.get('GeneralGridAxis', []):
+            spanned = next((e.text for e in grid_axis.iter() if e.tag.endswith('gridAxesSpanned')), None)
+            values = next((e.text for e in grid_axis.iter() if e.tag.endswith('coefficients')), None)
+            if spanned and values and values.strip():
+                coefficients[spanned.strip()] = [value.strip('"') for value in tokens(values)]
+        axes = []
+        for index, label in enumerate(labels):
+            low, high = lower[index], upper[index]
+            if low.startswith('"'):
+                low, high = low.strip('"'), high.strip('"')
+            else:
+                low, high = float(low), float(high)
+            axes.append(AxisMetadata(label, low, high, sizes[index], resolutions.get(label), coefficients.get(label)))
+        bands = []
+        for field in elements.get('field', []):
+            quantity = next((e for e in field.iter() if e.tag.endswith('Quantity')), None)
+            band_type = quantity.get('definition', '').rstrip('/').split('/')[-1] if quantity != None else ''
+            nodata = [float(e.text) for e in field.iter() if e.tag.endswith('nilValue') and e.text]
+            bands.append((field.get('name'), BAND_TYPES.get(band_type, 'float64'), nodata))
+        return cls(name, axes, envelope.get('srsName'), bands)
+
+
+def series_fingerprint(metadata, axis, last):
+    
+   # Hashes what the stored slices of a time series up to 'last' depend on: the bands, the CRS, the other axes and the earlier time slices.
+
+    other_axes = [(other.name, other.lower, other.upper, other.size, other.resolution)
+                  for other in metadata.axes if other.name != axis.name]
+    earlier = [coefficient for coefficient in axis.coefficients if iso_key(coefficient) <= iso_key(last)]
+    description = json.dumps([metadata.crs, metadata.bands, other_axes, earlier], default = str)
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+class TimeSeriesStore:
+    """
+    Keeps the slices of time series that dco.execute_incremental has fetched, so that later calls
+        only fetch the new ones. A series is kept per query template, the query without its time
+        range, together with a fingerprint of the coverage metadata it was fetched with.
+
+    Parameters:
+        path (str): JSON file the series are loaded from and saved to after every change, None to
+            keep them in memory only.
+
+    """
+    def __init__(self, path = None):
+        if path != None and not isinstance(path, str):
+            raise TypeError("Value entered must be a string.")
+        self.path = path
+        # template -> {'fingerprint': str, 'slices': {time coordinate: value}}
+        self.series = {}
+        self.lock = threading.Lock()
+        if path != None and os.path.exists(path):
+            with open(path, encoding = 'utf-8') as store_file:
+                self.series = json.load(store_file)
+
+    def get(self, template):
+        
+       # Returns the fingerprint and a copy of the slices stored for a template, (None, {}) if there are none.
+
+        with self.lock:
+            entry = self.series.get(template)
+            if entry == None:
+                return None, {}
+            return entry['fingerprint'], dict(entry['slices'])
+
+    def put(self, template, fingerprint, slices):
+        with self.lock:
+            self.series[template] = {'fingerprint': fingerprint, 'slices': slices}
+            self.save()
+
+    def drop(self, template = None):
+        
+       # Forgets the slices of one template, or of all of them, so that they are fetched again.
+
+        with self.lock:
+            if template == None:
+                self.series = {}
+            else:
+                self.series.pop(template, None)
+            self.save()
+
+    def save(self):
+        # called with the lock held
+        if self.path != None:
+            write_atomically(self.path, json.dumps(self.series).encode('utf-8'))
+
+
+# time each thread spent waiting for a pooled connection, measured by the timed connection pools
+CONNECTION_TIMING = threading.local()
+
+
+class TimedPool:
+    # mixin for the urllib3 connection pools of a dbc, it measures how long taking a connection out of the pool takes
+    def _get_conn(self, timeout = None):
+        start = time.perf_counter()
+        try:
+            return super()._get_conn(timeout)
+        finally:
+            CONNECTION_TIMING.acquire = getattr(CONNECTION_TIMING, 'acquire', 0.0) + time.perf_counter() - start
+
+
+class TimedHTTPConnectionPool(TimedPool, HTTPConnectionPool):
+    pass
+
+
+class TimedHTTPSConnectionPool(TimedPool, HTTPSConnectionPool):
+    pass
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    # the HTTPAdapter of a dbc, with connection pools that measure the connection acquire time
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+
+class QueryMetrics:
+    """
+    Where the time of one query went, as reported to the listeners of a dbc. Durations are in
+        seconds and stay None for the stages a query didn't go through (e.g. no download on a
+        cache hit, no build or parse time for queries sent with send_query directly).
+
+    Attributes:
+        query, coverage: The WCPS query and the coverage(s) it reads.
+        build: Building the query with to_wcps_query.
+        acquire: Waiting for a connection from the pool.
+        ttfb: From sending the query until the response headers arrived.
+        download: Reading the response body.
+        parse: Turning the body into the result (byte_to_list, array or image decoding).
+        bytes: Size of the response body.
+        wire_bytes: Size of the response body as it was transferred, before decompression.
+        cache: 'hit' or 'miss' if the dbc has a cache.
+        coalesced: The query was already in flight and its response was shared.
+        endpoint: The URL the query was answered by.
+        retries: How many times the query was sent again to the same endpoint.
+        failovers: How many times the query was sent to another endpoint after a failure.
+        error: The exception the query failed with.
+
+    """
+    def __init__(self, query = None):
+        self.query = query
+        self.coverage = ','.join(re.findall(r'\bin\s*\(\s*([^)]+?)\s*\)', query or '')) or None
+        self.build = None
+        self.acquire = None
+        self.ttfb = None
+        self.download = None
+        self.parse = None
+        self.bytes = None
+        self.wire_bytes = None
+        self.cache = None
+        self.coalesced = False
+        self.endpoint = None
+        self.retries = 0
+        self.failovers = 0
+        self.error = None
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def percentile(sorted_values, q):
+    
+   # Nearest-rank percentile of an already sorted list.
+
+    return sorted_values[max(0, math.ceil(q / 100 * len(sorted_values)) - 1)]
+
+
+class MetricsSummary:
+    """
+    A dbc listener that keeps the timings of the last 'max_samples' queries per coverage in memory
+        and reports their percentiles.
+
+    Example:
+        >>> summary = MetricsSummary()
+        >>> my_dbc.add_listener(summary)
+        >>> summary.report()['AvgLandTemp']['ttfb']['p95']
+
+    """
+    FIELDS = ('build', 'acquire', 'ttfb', 'download', 'parse', 'bytes', 'wire_bytes')
+
+    def __init__(self, max_samples = 10000):
+        self.max_samples = max_samples
+        self.samples = {} # coverage -> field -> deque of the last max_samples values
+        self.counters = {} # coverage -> counter -> number
+        self.lock = threading.Lock()
+
+    def __call__(self, metrics):
+        coverage = metrics.coverage or ''
+        with self.lock:
+            samples = self.samples.setdefault(coverage, {field: deque(maxlen = self.max_samples) for field in self.FIELDS})
+            counters = self.counters.setdefault(coverage, {'queries': 0, 'errors': 0, 'cache_hits': 0, 'coalesced': 0,
+                                                           'retries': 0, 'failovers': 0})
+            counters['queries'] += 1
+            counters['errors'] += metrics.error != None
+            counters['cache_hits'] += metrics.cache == 'hit'
+            counters['coalesced'] += metrics.coalesced
+            counters['retries'] += metrics.retries
+            counters['failovers'] += metrics.failovers
+            for field in self.FIELDS:
+                value = getattr(metrics, field)
+                if value != None:
+                    samples[field].append(value)
+
+    def report(self):
+        
+       # Returns {coverage: {counter: number, field: {'p50': .., 'p95': .., 'p99': ..}}}.
+
+        with self.lock:
+            report = {}
+            for coverage, samples in self.samples.items():
+                report[coverage] = dict(self.counters[coverage])
+                for field, values in samples.items():
+                    if values:
+                        values = sorted(values)
+                        report[coverage][field] = {'p50': percentile(values, 50), 'p95': percentile(values, 95),
+                                                   'p99': percentile(values, 99)}
+            return report
+
+
+class Endpoint:
+    """
+    One server of a dbc and what the dbc has learned about it: a moving average (EWMA) of the
+        time its queries take, and a circuit breaker. After 'failure_threshold' failures in a row
+        the circuit opens and the endpoint gets no queries for 'cooldown' seconds; then it gets
+        one query again, which closes the circuit if it succeeds.
+
+    """
+    def __init__(self, url, alpha = 0.3, failure_threshold = 3, cooldown = 30):
+        self.url = url
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.latency = None # seconds, None until the first query came back
+        self.failures = 0 # failures in a row
+        self.open_until = 0.0 # time.monotonic() until which the circuit is open
+        self.lock = threading.Lock()
+
+    def succeeded(self, seconds = None):
+        with self.lock:
+            if seconds != None:
+                self.latency = seconds if self.latency == None else self.alpha * seconds + (1 - self.alpha) * self.latency
+            self.failures = 0
+            self.open_until = 0.0
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.open_until = time.monotonic() + self.cooldown
+
+    def available(self):
+        return time.monotonic() >= self.open_until
+
+    def as_dict(self):
+        return {'url': self.url, 'latency': self.latency, 'failures': self.failures, 'available': self.available()}
+
+
+def endpoint_rank(endpoint):
+    
+   # Sort key of the routing: untried endpoints first (to learn their latency), then the fastest, then the ones that only failed.
+
+    if endpoint.latency != None:
+        return endpoint.latency
+    return 0.0 if endpoint.failures == 0 else float('inf')
+
+
+# database connection object
+class dbc:
+    # initalizing our dbc by providing it with the service endpoint, from which we can get a datacube
+    def __init__(self, url, pool_size = 10, timeout = (5, 60), retries = 3, backoff_factor = 0.5, cache = None,
+                 metadata_ttl = 3600, validate = False, coalesce = True, failure_threshold = 3, cooldown = 30,
+                 health_interval = None, health_query = None, compress = True, auto_min_bytes = 65536,
+                 strict_functions = False):
+        """
+        Initializes a new dbc instance which is used to manage connections and send queries to a WCPS server.
+            Every dbc keeps its own pool of keep-alive connections, so consecutive queries reuse the
+            same TCP/TLS connection instead of opening a new one each time.
+
+        Parameters:
+            url (str or list): The WCPS service endpoint, or the endpoints of several replicas of the
+                same server. Every query goes to the replica that has answered fastest so far (see
+                Endpoint), and if it fails with a 5xx answer or a connection error it is sent to the
+                next one instead of being retried on the same replica.
+            pool_size (int): Maximum number of connections kept open to the server.
+            timeout (tuple): (connect, read) timeouts in seconds.
+            retries (int): How many times a query is retried on 5xx answers and connection resets
+                (with several endpoints: sent to another endpoint).
+            backoff_factor (float): Base of the exponential backoff between retries
+                (backoff_factor * 2 ** (retry - 1) seconds).
+            cache (ResultCache or DiskCache): Optional cache for the responses of repeated queries.
+            metadata_ttl (float): Seconds for which coverage descriptions are kept, see describe_coverage.
+            validate (bool): Check coverage names and subsets against the coverage descriptions before
+                a dco sends its query, see dco.validate.
+            coalesce (bool): Let concurrent callers of the same query share one request, see send_query.
+            failure_threshold (int), cooldown (float): Circuit breaker settings of the endpoints, they
+                only apply when there are several.
+            health_interval (float): If given, check_health() runs every 'health_interval' seconds
+                on a background thread.
+            health_query (str): WCPS query sent by check_health(), a GetCapabilities request by default.
+            compress (bool): Ask the server for gzip/deflate compressed responses. They are
+                decompressed while they are read, also when streaming.
+            auto_min_bytes (int): Smallest binary result for which a dco with set_format('AUTO') asks
+                for 'RAW' instead of 'CSV', see dco.choose_format.
+            strict_functions (bool): dco.validate also rejects calls of functions that aren't in
+                WCPS_FUNCTIONS, see parse_wcps. Together with 'validate' they are checked before
+                every query.
+
+        """
+        urls = [url] if isinstance(url, str) else url
+        if not isinstance(urls, (list, tuple)) or not all(isinstance(item, str) for item in urls):
+            raise TypeError("Value entered must be a string or a list of strings.")
+        if not urls:
+            raise ValueError("At least one endpoint is needed")
+        if not isinstance(pool_size, int) or pool_size < 1:
+            raise ValueError("Pool size must be a positive integer")
+        self.server_url = urls[0] # replicas serve the same data, so they share the cache keys of the first one
+        self.endpoints = [Endpoint(item, failure_threshold = failure_threshold, cooldown = cooldown) for item in urls]
+        self.health_query = health_query
+        self.compress = compress
+        self.auto_min_bytes = auto_min_bytes
+        self.capabilities = None # (expiry time, set of output formats of the server)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.cache = cache
+        self.metadata_ttl = metadata_ttl
+        self.validate = validate
+        self.strict_functions = strict_functions
+        self.metadata = {} # coverage name -> (expiry time, CoverageMetadata)
+        self.metadata_lock = threading.Lock()
+        self.listeners = []
+        self.coalesce = coalesce
+        self.in_flight = {} # (cache key, refresh) -> Future of the request that is being sent
+        self.in_flight_lock = threading.Lock()
+        self.executor = None # thread pool for the lazy results of dco.execute, created on first use
+        self.executor_lock = threading.Lock()
+        self.session = self.create_session()
+        self.health_stop = threading.Event()
+        if health_interval != None:
+            threading.Thread(target = self.check_health_every, args = (health_interval,), daemon = True).start()
+
+    def create_session(self):
+        """
+        Creates the persistent HTTP session of the dbc, with a connection pool of 'pool_size'
+            keep-alive connections and a retry policy with exponential backoff for 5xx answers
+            and connection resets. WCPS queries only read data, so POSTs are safe to retry.
+            With several endpoints, failover takes the place of retries on the same endpoint.
+
+        """
+        retries = self.retries if len(self.endpoints) == 1 else 0
+        retry = Retry(total = retries, connect = retries, read = retries,
+                      status = retries, backoff_factor = self.backoff_factor,
+                      status_forcelist = RETRY_STATUSES,
+                      allowed_methods = frozenset(['GET', 'POST']),
+                      raise_on_status = False)
+        adapter = TimedHTTPAdapter(pool_connections = len(self.endpoints), pool_maxsize = self.pool_size,
+                                   max_retries = retry, pool_block = True)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Connection'] = 'keep-alive'
+        session.headers['Accept-Encoding'] = 'gzip, deflate' if self.compress else 'identity'
+        # 'verify=False' is used to skip SSL certificate verification;
+        session.verify = False
+        return session
+
+    def close(self):
+        
+       # Closes all pooled connections of the dbc, after the lazy results still being fetched are done.
+
+        self.health_stop.set()
+        if self.executor != None:
+            self.executor.shutdown()
+            self.executor = None
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_listener(self, listener):
+        
+       # Registers a callable that gets the QueryMetrics of every query of this dbc, e.g. a MetricsSummary.
+
+        if not callable(listener):
+            raise TypeError("Listener must be callable.")
+        self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener):
+        self.listeners = [registered for registered in self.listeners if registered != listener]
+
+    @contextlib.contextmanager
+    def collect(self):
+        """
+        Collects the QueryMetrics of all queries sent while the context is open.
+
+        Example:
+            >>> with my_dbc.collect() as metrics:
+            ...     datacube.execute()
+            >>> metrics[0].ttfb
+
+        """
+        records = []
+        self.add_listener(records.append)
+        try:
+            yield records
+        finally:
+            self.remove_listener(records.append)
+
+    def emit(self, metrics):
+        for listener in self.listeners:
+            listener(metrics)
+
+    def route(self, exclude = ()):
+        
+       # Returns the fastest endpoint that is not in 'exclude' and whose circuit is closed, or None.
+
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude
+                      and (endpoint.available() or len(self.endpoints) == 1)]
+        if not candidates:
+            return None
+        return min(candidates, key = endpoint_rank)
+
+    def failover(self, send, metrics = None):
+        
+       # Calls send(endpoint) on the endpoint chosen by route(), and on the next ones while it fails with a retryable error.
+
+        error = None
+        tried = []
+        while len(tried) <= self.retries:
+            endpoint = self.route(tried)
+            if endpoint == None:
+                break
+            if tried and metrics != None:
+                metrics.failovers += 1
+            tried.append(endpoint)
+            start = time.perf_counter()
+            try:
+                result = send(endpoint)
+            except WCPSError as failure:
+                if not failure.retryable:
+                    endpoint.succeeded() # the endpoint answered, the query was wrong
+                    raise
+                endpoint.failed()
+                error = failure
+                continue
+            endpoint.succeeded(time.perf_counter() - start)
+            return result
+        if error == None:
+            raise ConnectionFailed("No endpoint is available, the circuits of all of them are open")
+        raise error
+
+    def check_health(self):
+        """
+        Sends a cheap request to every endpoint, a GetCapabilities request or the 'health_query' of
+            the dbc, and updates their circuit breakers with the outcome. The time of a health query
+            counts into the latency of the endpoint, GetCapabilities requests don't.
+
+        Returns:
+            dict: {url: True if the endpoint answered, False otherwise}
+
+        """
+        health = {}
+        for endpoint in self.endpoints:
+            start = time.perf_counter()
+            try:
+                if self.health_query != None:
+                    self.post_to(endpoint, self.health_query, False, QueryMetrics(self.health_query))
+                else:
+                    self.get_from(endpoint, {'service': 'WCS', 'version': '2.0.1', 'request': 'GetCapabilities'})
+            except WCPSError as failure:
+                if failure.retryable:
+                    endpoint.failed()
+                    health[endpoint.url] = False
+                    continue
+            endpoint.succeeded(time.perf_counter() - start if self.health_query != None else None)
+            health[endpoint.url] = True
+        return health
+
+    def check_health_every(self, interval):
+        while not self.health_stop.wait(interval):
+            self.check_health()
+    
+    def send_query(self, wcps_query, stream = False, refresh = False, metrics = None):
+        """
+        Sends a WCPS query to the server and retrieves the response. With 'stream' only the headers
+            are read, and the body can be consumed in chunks with response.iter_content().
+            If the dbc has a cache, a cached response is returned instead, unless 'refresh' is set
+            (streamed responses are never cached). Callers that send the same query while it is
+            already in flight, e.g. from other threads, wait for that request and get its response
+            or error, instead of sending the query again. The timings of the query are reported to
+            the listeners of the dbc, unless a 'metrics' record is passed in to be filled instead.
+
+        Raises:
+            QueryError: The server rejected the query (also a ValueError).
+            ServerError: The server kept failing with 5xx after all retries.
+            ConnectionFailed: The server couldn't be reached or the connection timed out.
+
+        """
+        if not isinstance(wcps_query, str):
+            raise TypeError("Value entered must be a string.")
+        report = metrics == None
+        if report:
+            metrics = QueryMetrics(wcps_query)
+        try:
+            if stream or not self.coalesce: # a streamed body can only be read by one caller
+                return self.post_query(wcps_query, stream, refresh, metrics)
+            return self.shared_query(wcps_query, refresh, metrics)
+        except Exception as error:
+            metrics.error = error
+            raise
+        finally:
+            if report:
+                self.emit(metrics)
+
+    def shared_query(self, wcps_query, refresh, metrics):
+        
+       # Sends the query, unless the same query is already in flight, then waits for that request instead.
+
+        # a refresh only waits for another refresh, a request that may answer from the cache isn't fresh enough
+        key = (self.cache_key(wcps_query), refresh)
+        with self.in_flight_lock:
+            future = self.in_flight.get(key)
+            leader = future == None
+            if leader:
+                future = self.in_flight[key] = Future()
+        if not leader:
+            metrics.coalesced = True
+            response = future.result()
+            metrics.bytes = len(response.content)
+            return response
+        try:
+            response = self.post_query(wcps_query, False, refresh, metrics)
+            future.set_result(response)
+            return response
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self.in_flight_lock:
+                del self.in_flight[key]
+
+    def post_query(self, wcps_query, stream, refresh, metrics):
+        use_cache = self.cache != None and not stream
+        if use_cache:
+            key = self.cache_key(wcps_query)
+            cached = None if refresh else self.cache.get(key)
+            metrics.cache = 'miss' if cached == None else 'hit'
+            if cached != None:
+                metrics.bytes = len(cached.content)
+                return cached
+        response = self.failover(lambda endpoint: self.post_to(endpoint, wcps_query, stream, metrics), metrics)
+        if use_cache:
+            self.cache.put(key, WCPSResponse(response.status_code, response.content, response.headers, self.server_url))
+        return response
+
+    def post_to(self, endpoint, wcps_query, stream, metrics):
+        # getting a response from the server, only the headers at first
+        url = endpoint.url
+        metrics.endpoint = url
+        CONNECTION_TIMING.acquire = 0.0
+        start = time.perf_counter()
+        try:
+            response = self.session.post(url, data = {'query': wcps_query}, timeout = self.timeout, stream = True)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+            raise ConnectionFailed(f"Couldn't reach {url}: {error}") from error
+        except requests.exceptions.RetryError as error:
+            raise ServerError(f"Server kept failing after {self.retries} retries: {error}") from error
+        except requests.exceptions.RequestException as error:
+            raise WCPSError(f"Request to {url} failed: {error}") from error
+        metrics.acquire = CONNECTION_TIMING.acquire
+        metrics.ttfb = time.perf_counter() - start - metrics.acquire
+        retries = getattr(response.raw, 'retries', None)
+        metrics.retries = len(retries.history) if retries != None else 0
+        if not stream:
+            start = time.perf_counter()
+            try:
+                metrics.bytes = len(response.content)
+            except requests.exceptions.RequestException as error:
+                raise ConnectionFailed(f"Connection to {url} broke during the download: {error}") from error
+            metrics.download = time.perf_counter() - start
+            metrics.wire_bytes = response.raw.tell() if hasattr(response.raw, 'tell') else None
+        return check_response(response)
+
+    def describe_coverage(self, name, refresh = False):
+        """
+        Returns the CoverageMetadata of a coverage. It is fetched with a WCS DescribeCoverage request
+            once and then kept for 'metadata_ttl' seconds.
+
+        Raises:
+            QueryError: The coverage doesn't exist.
+
+        """
+        if not isinstance(name, str):
+            raise TypeError("Value entered must be a string.")
+        with self.metadata_lock:
+            entry = self.metadata.get(name)
+        if entry != None and entry[0] > time.monotonic() and not refresh:
+            return entry[1]
+        response = self.send_request({'service': 'WCS', 'version': '2.0.1', 'request': 'DescribeCoverage',
+                                      'coverageId': name})
+        metadata = CoverageMetadata.from_xml(name, response.content)
+        with self.metadata_lock:
+            self.metadata[name] = (time.monotonic() + self.metadata_ttl, metadata)
+        return metadata
+
+    def formats(self, refresh = False):
+        """
+        Returns the set of output formats (MIME types) that the server lists in its GetCapabilities
+            response. It is fetched once and then kept for 'metadata_ttl' seconds.
+
+        """
+        with self.metadata_lock:
+            entry = self.capabilities
+        if entry != None and entry[0] > time.monotonic() and not refresh:
+            return entry[1]
+        response = self.send_request({'service': 'WCS', 'version': '2.0.1', 'request': 'GetCapabilities'})
+        root = ElementTree.fromstring(response.content)
+        formats = {element.text.strip() for element in root.iter()
+                   if element.tag.split('}')[-1] == 'formatSupported' and element.text}
+        with self.metadata_lock:
+            self.capabilities = (time.monotonic() + self.metadata_ttl, formats)
+        return formats
+
+    def send_request(self, params):
+        
+       # Sends a WCS key-value-pair GET request (DescribeCoverage, GetCapabilities) to the server.
+
+        return self.failover(lambda endpoint: self.get_from(endpoint, params))
+
+    def get_from(self, endpoint, params):
+        try:
+            response = self.session.get(endpoint.url, params = params, timeout = self.timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+            raise ConnectionFailed(f"Couldn't reach {endpoint.url}: {error}") from error
+        except requests.exceptions.RequestException as error:
+            raise WCPSError(f"Request to {endpoint.url} failed: {error}") from error
+        return check_response(response)
+
+    def cache_key(self, wcps_query):
+        return (self.server_url, normalize_query(wcps_query))
+
+    def send_many(self, queries, max_workers = None, yield_completed = False):
+        """
+        Sends many WCPS queries at once on a thread pool of 'max_workers' threads (the pool size by
+            default), all sharing the pooled connections of the dbc. A failing query doesn't fail the
+            whole batch: its exception is returned in place of its response.
+
+        Returns:
+            list: Responses (or exceptions) in the order of 'queries', or, with 'yield_completed',
+                a generator of (index, response) tuples in the order the queries finish.
+
+        """
+        queries = list(queries)
+        for query in queries:
+            if not isinstance(query, str):
+                raise TypeError("Value entered must be a string.")
+        return self.run_batch([(self.send_query, (query,)) for query in queries], max_workers, yield_completed)
+
+    def execute_many(self, items, max_workers = None, yield_completed = False, sink = None, regions = None):
+        """
+        Executes many dco instances and/or raw WCPS strings at once, the same way as send_many.
+            For a dco the value of its execute() is returned, for a string the server response.
+            The queries of all dco instances are built (and the instances reset) before anything is sent.
+            With a NpySink 'sink', every item must be a dco, which writes its result into its region
+            of 'regions' instead, see dco.execute_to, and the sink is returned for it.
+
+        """
+        items = list(items)
+        if sink != None:
+            if not isinstance(sink, NpySink):
+                raise TypeError("Batches can only be written into a NpySink")
+            if regions == None or len(regions) != len(items):
+                raise ValueError("Every item needs a region of the sink")
+        for item in items:
+            if not isinstance(item, (dco, str)):
+                raise TypeError("Items must be dco instances or strings.")
+            if sink != None and isinstance(item, str):
+                raise TypeError("Only dco instances can be written into a sink, not WCPS strings")
+        tasks = []
+        for index, item in enumerate(items):
+            if isinstance(item, dco) and sink != None:
+                tasks.append((item.fork().execute_to, (sink, regions[index])))
+            elif isinstance(item, dco):
+                tasks.append((self.send_and_parse, (item.to_wcps_query(), item, item.format, item.aggregations)))
+            else:
+                tasks.append((self.send_query, (item,)))
+        # the instances are only reset once all queries are built, a bad item leaves them as they were
+        for item in items:
+            if isinstance(item, dco):
+                item.reset()
+        return self.run_batch(tasks, max_workers, yield_completed)
+
+    def send_and_parse(self, wcps_query, item, output_format, stats = None):
+        return item.parse_result(self.send_query(wcps_query).content, output_format, stats = stats)
+
+    def run_batch(self, tasks, max_workers, yield_completed):
+        
+       # Runs (function, arguments) tasks on a thread pool, collecting exceptions as results.
+
+        if max_workers == None:
+            max_workers = self.pool_size
+        if yield_completed:
+            return self.iter_batch(tasks, max_workers)
+        results = [None] * len(tasks)
+        for index, result in self.iter_batch(tasks, max_workers):
+            results[index] = result
+        return results
+
+    def submit(self, function, *args, **kwargs):
+        
+       # Runs function(*args, **kwargs) on the thread pool of the dbc and returns its Future.
+
+        with self.executor_lock:
+            if self.executor == None:
+                self.executor = ThreadPoolExecutor(max_workers = self.pool_size, thread_name_prefix = 'wdc')
+            return self.executor.submit(function, *args, **kwargs)
+
+    def iter_batch(self, tasks, max_workers):
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            futures = {executor.submit(function, *arguments): index for index, (function, arguments) in enumerate(tasks)}
+            for future in as_completed(futures):
+                error = future.exception()
+                yield futures[future], (error if error != None else future.result())
+
+
+def check_response(response):
+    
+   # Turns a non-200 answer of the server into the matching WCPSError, otherwise passes the response through.
+
+    if response.status_code == 200:
+        return response
+    if response.status_code >= 500:
+        raise ServerError(f"Server error {response.status_code}: {response.text[:200]}")
+    raise QueryError(f"Not correct query ({response.status_code}): {response.text[:200]}")
+
+
+
+class WCPSResponse:
+    # a completely read server response, used where there is no requests.Response (e.g. the asyncio client)
+    def __init__(self, status_code, content, headers = None, url = None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers if headers != None else {}
+        self.url = url
+
+    @property
+    def text(self):
+        return bytes(self.content).decode('utf-8', 'replace')
+
+
+# asyncio database connection object
+class AsyncDbc(dbc):
+    """
+    A dbc whose queries can be awaited, so that one event loop keeps many WCPS queries in flight
+        against the server. It needs the optional 'aiohttp' package. The blocking send_query of dbc
+        keeps working as well.
+
+    Example:
+        >>> async with AsyncDbc("https://ows.rasdaman.org/rasdaman/ows") as my_dbc:
+        ...     results = await my_dbc.gather(list_of_dcos, limit = 20)
+
+    """
+    def __init__(self, url, pool_size = 10, timeout = (5, 60), retries = 3, backoff_factor = 0.5, cache = None,
+                 coalesce = True, failure_threshold = 3, cooldown = 30, health_interval = None, health_query = None,
+                 validate = False, metadata_ttl = 3600, compress = True, auto_min_bytes = 65536,
+                 strict_functions = False):
+        if aiohttp == None:
+            raise ImportError("AsyncDbc needs the 'aiohttp' package")
+        super().__init__(url, pool_size, timeout, retries, backoff_factor, cache, metadata_ttl = metadata_ttl,
+                         validate = validate, coalesce = coalesce, failure_threshold = failure_threshold,
+                         cooldown = cooldown, health_interval = health_interval, health_query = health_query,
+                         compress = compress, auto_min_bytes = auto_min_bytes, strict_functions = strict_functions)
+        self.async_session = None
+        self.async_in_flight = {} # (cache key, refresh) -> task of the request that is being sent
+
+    def get_async_session(self):
+        
+       # Creates the aiohttp session on first use, it has to be created inside the running event loop.
+
+        if self.async_session == None or self.async_session.closed:
+            connect_timeout, read_timeout = self.timeout
+            # 'ssl=False' skips SSL certificate verification, just like the blocking dbc
+            connector = aiohttp.TCPConnector(limit = self.pool_size, ssl = False)
+            self.async_session = aiohttp.ClientSession(
+                connector = connector,
+                headers = {'Accept-Encoding': 'gzip, deflate' if self.compress else 'identity'},
+                timeout = aiohttp.ClientTimeout(sock_connect = connect_timeout, sock_read = read_timeout))
+        return self.async_session
+
+    async def asend_query(self, wcps_query, refresh = False, metrics = None):
+        """
+        Sends a WCPS query to the server without blocking the event loop. Failed attempts are retried
+            with the same policy as send_query, and errors are reported with the same exception types.
+            The cache, the listeners and the sharing of in-flight requests work the same way as well.
+
+        """
+        if not isinstance(wcps_query, str):
+            raise TypeError("Value entered must be a string.")
+        report = metrics == None
+        if report:
+            metrics = QueryMetrics(wcps_query)
+        try:
+            if not self.coalesce:
+                return await self.apost_query(wcps_query, refresh, metrics)
+            return await self.ashared_query(wcps_query, refresh, metrics)
+        except Exception as error:
+            metrics.error = error
+            raise
+        finally:
+            if report:
+                self.emit(metrics)
+
+    async def ashared_query(self, wcps_query, refresh, metrics):
+        
+       # Awaitable version of shared_query, the request runs as a task that all callers of the query await.
+
+        key = (self.cache_key(wcps_query), refresh)
+        task = self.async_in_flight.get(key)
+        if task == None:
+            task = asyncio.ensure_future(self.apost_query(wcps_query, refresh, metrics))
+            self.async_in_flight[key] = task
+            task.add_done_callback(lambda done: self.async_in_flight.pop(key, None))
+        else:
+            metrics.coalesced = True
+        # shielded, so that a cancelled caller doesn't cancel the request of the others
+        response = await asyncio.shield(task)
+        if metrics.coalesced:
+            metrics.bytes = len(response.content)
+        return response
+
+    async def apost_query(self, wcps_query, refresh, metrics):
+        if self.cache != None:
+            key = self.cache_key(wcps_query)
+            cached = None if refresh else self.cache.get(key)
+            metrics.cache = 'miss' if cached == None else 'hit'
+            if cached != None:
+                metrics.bytes = len(cached.content)
+                return cached
+        session = self.get_async_session()
+        several = len(self.endpoints) > 1
+        error = None
+        tried = []
+        for attempt in range(self.retries + 1):
+            # with several endpoints a failed query goes to the next one, otherwise it is retried after a backoff
+            endpoint = self.route(tried if several else ())
+            if endpoint == None:
+                break
+            if attempt > 0 and several:
+                metrics.failovers += 1
+            elif attempt > 0:
+                await asyncio.sleep(self.backoff_factor * 2 ** (attempt - 1))
+                metrics.retries = attempt
+            tried.append(endpoint)
+            url = metrics.endpoint = endpoint.url
+            try:
+                start = time.perf_counter()
+                async with session.post(url, data = {'query': wcps_query}) as answer:
+                    metrics.ttfb = time.perf_counter() - start
+                    start = time.perf_counter()
+                    response = WCPSResponse(answer.status, await answer.read(), dict(answer.headers), url)
+                    metrics.download = time.perf_counter() - start
+                    metrics.bytes = len(response.content)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as failure:
+                endpoint.failed()
+                error = ConnectionFailed(f"Couldn't reach {url}: {failure}")
+                continue
+            except aiohttp.ClientError as failure:
+                raise WCPSError(f"Request to {url} failed: {failure}") from failure
+            try:
+                response = check_response(response)
+            except WCPSError as failure:
+                if not failure.retryable:
+                    endpoint.succeeded()
+                    raise
+                endpoint.failed()
+                error = failure
+                continue
+            endpoint.succeeded(metrics.ttfb + metrics.download)
+            if self.cache != None:
+                self.cache.put(key, response)
+            return response
+        if error == None:
+            raise ConnectionFailed("No endpoint is available, the circuits of all of them are open")
+        raise error
+
+    async def gather(self, items, limit = None, return_exceptions = False):
+        """
+        Runs many queries concurrently, like asyncio.gather, but with at most 'limit' of them in flight
+            at the same time (the pool size by default). 'items' can hold dco instances, whose
+            aexecute() results are returned, and raw WCPS strings, whose responses are returned.
+            Results come back in input order.
+
+        """
+        if limit == None:
+            limit = self.pool_size
+        semaphore = asyncio.Semaphore(limit)
+
+        async def run(item):
+            async with semaphore:
+                if isinstance(item, dco):
+                    return await item.aexecute()
+                return await self.asend_query(item)
+
+        return await asyncio.gather(*[run(item) for item in items], return_exceptions = return_exceptions)
+
+    async def aclose(self):
+        
+       # Closes the pooled connections of both the asyncio and the blocking session.
+
+        if self.async_session != None:
+            await self.async_session.close()
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+
+
+# function needed for converting a byte string to the list of numbers
+def byte_to_list(byte_str):
+    
+   # Converts a byte string into a list of floats. Useful for parsing numeric data returned from a server.
+
+
+    decoded_str = str(byte_str, 'utf-8') # decode the byte string (or any other buffer, e.g. a memory-mapped cache file)
+    str_list = decoded_str.split(',') # split numbers separated by comma
+    num_list = [float(num) for num in str_list] # create a list of numbers
+    return num_list
+
+
+def parse_csv_array(byte_str, dtype = 'float64', nodata = None, ndim = None):
+    """
+    Converts a CSV result into a NumPy array of the right shape. Nested CSV output of
+        multi-dimensional coverages, e.g. {1,2},{3,4}, becomes a 2x2 array. The numbers are parsed in
+        one vectorized pass instead of one float() call per value. Needs the optional 'numpy' package.
+
+    Parameters:
+        byte_str (bytes): The content of the server response.
+        dtype (str): The dtype of the returned array.
+        nodata (float or list): Sentinel value(s) like 99999 marking cells without data. They become
+            NaN in floating point arrays and are masked otherwise (a numpy.ma.MaskedArray is returned).
+        ndim (int): Number of dimensions the result is known to have. A result with a length of 1
+            along its first axes, like {1,2,3}, can't be told apart from a flat one otherwise.
+
+    """
+    if np == None:
+        raise ImportError("Array results need the 'numpy' package")
+    byte_str = bytes(byte_str)
+    nested = b'{' in byte_str
+    values = np.fromstring(byte_str.translate(None, b'{}') if nested else byte_str, dtype = np.float64, sep = ',')
+    shape = csv_shape(byte_str, len(values)) if nested else None
+    if shape:
+        values = values.reshape(shape)
+    if ndim != None and values.ndim < ndim:
+        values = values.reshape((1,) * (ndim - values.ndim) + values.shape)
+    return finish_array(values, dtype, nodata)
+
+
+def csv_shape(text, count):
+    """
+    Works out the shape of nested CSV output, e.g. [2, 2] for {1,2},{3,4}, from its braces and
+        commas and the number of values it holds. Only braces and commas are looked at, so 'text'
+        can also be the skeleton of a result without its numbers. None for flat output.
+
+    """
+    chars = np.frombuffer(text, dtype = np.uint8)
+    opens = chars == ord('{')
+    if not opens.any():
+        return None
+    # nesting depth after every character, e.g. {1,2},{3,4} -> 1111101111 0
+    depth = np.cumsum(opens.astype(np.int64) - (chars == ord('}')))
+    if depth[-1] != 0 or depth.min() < 0:
+        raise ValueError("Unbalanced braces in the CSV result")
+    # how many brace groups are opened at every depth
+    groups = np.bincount(depth[opens], minlength = int(depth.max()) + 1)[1:]
+    # every innermost group has to hold the same number of values
+    commas = np.cumsum(chars == ord(','))
+    innermost = len(groups)
+    starts = np.flatnonzero(opens & (depth == innermost))
+    ends = np.flatnonzero((chars == ord('}')) & (depth == innermost - 1))
+    if len(np.unique(commas[ends] - commas[starts])) > 1:
+        raise ValueError("The nested CSV result isn't rectangular")
+    # and every outer group the same number of groups one level deeper, unlike {{1,2},{3,4}},{{5,6}}
+    for level in range(1, innermost):
+        parents = np.flatnonzero(opens & (depth == level))
+        children = np.flatnonzero(opens & (depth == level + 1))
+        if len(np.unique(np.diff(np.append(np.searchsorted(children, parents), len(children))))) > 1:
+            raise ValueError("The nested CSV result isn't rectangular")
+    shape = [int(groups[0])] + [int(groups[i] // groups[i - 1]) for i in range(1, len(groups))]
+    # a single group around everything, e.g. {1,2,3}, is just a wrapper and not a dimension
+    top_level_comma = np.any((chars == ord(',')) & (depth == 0))
+    if shape[0] == 1 and not top_level_comma:
+        groups = groups[1:]
+        shape = shape[1:]
+    if not shape:
+        return None
+    if count % groups[-1] != 0 or any(groups[i] % groups[i - 1] for i in range(1, len(groups))):
+        raise ValueError("The nested CSV result isn't rectangular")
+    shape.append(count // int(groups[-1]))
+    return shape
+
+
+def finish_array(values, dtype = 'float64', nodata = None):
+    
+   # Converts parsed cell values to 'dtype', with the 'nodata' cells turned into NaN or masked (see parse_csv_array).
+
+    mask = None
+    if nodata != None:
+        mask = np.isin(values, nodata)
+    if np.issubdtype(np.dtype(dtype), np.floating):
+        values = values.astype(dtype, copy = False)
+        if mask is not None:
+            if not values.flags.writeable: # e.g. a RAW result on top of the response buffer
+                values = values.copy()
+            values[mask] = np.nan
+        return values
+    values = values.astype(dtype)
+    if mask is not None:
+        return np.ma.masked_array(values, mask = mask)
+    return values
+
+
+# CSV results from this size on are parsed on several cores, see CsvParser
+PARALLEL_CSV_BYTES = 32 * 1024 * 1024
+# every byte except braces and commas, deleting them leaves the skeleton csv_shape needs
+CSV_NUMBER_BYTES = bytes(sorted(set(range(256)) - set(b'{},')))
+
+
+def parse_csv_chunk(source_name, start, end, target_name, offset, count):
+    
+   # Runs in the worker processes of a CsvParser: parses the numbers of the shared body between 'start' and 'end' into the shared output.
+
+    source = shared_memory.SharedMemory(name = source_name)
+    target = shared_memory.SharedMemory(name = target_name)
+    try:
+        chunk = bytes(source.buf[start:end])
+        if b'{' in chunk or b'}' in chunk:
+            chunk = chunk.translate(None, b'{}')
+        values = np.fromstring(chunk, dtype = np.float64, sep = ',')
+        if len(values) != count:
+            raise ValueError(f"Expected {count} numbers between bytes {start} and {end} of the CSV result, "
+                             f"parsed {len(values)}")
+        output = np.ndarray((count,), np.float64, buffer = target.buf, offset = offset * 8)
+        output[...] = values
+        del output
+    finally:
+        source.close()
+        target.close()
+
+
+def close_shared_memory(block):
+    
+   # Closes a shared memory block, unless something still uses its buffer; then it is closed with the process.
+
+    try:
+        block.close()
+    except BufferError:
+        pass
+
+
+class CsvParser:
+    """
+    Parses very large CSV results on a pool of worker processes, like parse_csv_array does on one
+        core. The body is copied into shared memory once and split after commas into one chunk per
+        worker. The numbers of every chunk are counted up front, so every worker writes its numbers
+        straight to their place in one shared output array, instead of returning its own array to
+        be concatenated. A float64 result is that shared array itself, which is freed once the
+        result is garbage collected. Results smaller than 'min_bytes', or without more than one
+        worker, are parsed by parse_csv_array in the calling thread. The worker processes are only
+        started by the first large result. Needs the optional 'numpy' package.
+
+    Parameters:
+        max_workers (int): Number of worker processes, the number of CPUs by default.
+        min_bytes (int): Size from which a result is parsed in parallel.
+        mp_context: A multiprocessing context for the workers, the platform default if missing.
+
+    """
+    def __init__(self, max_workers = None, min_bytes = PARALLEL_CSV_BYTES, mp_context = None):
+        if not isinstance(min_bytes, int) or min_bytes < 1:
+            raise ValueError("The minimum size must be a positive integer")
+        self.max_workers = max_workers if max_workers != None else os.cpu_count() or 1
+        self.min_bytes = min_bytes
+        self.mp_context = mp_context
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor == None:
+                # the workers have to report their shared memory blocks to the same tracker as this process
+                resource_tracker.ensure_running()
+                self.executor = ProcessPoolExecutor(max_workers = self.max_workers, mp_context = self.mp_context)
+            return self.executor
+
+    def parse(self, content, dtype = 'float64', nodata = None, ndim = None):
+        
+       # Parses a CSV result into a NumPy array, see parse_csv_array for the parameters.
+
+        if len(content) < self.min_bytes or self.max_workers < 2:
+            return parse_csv_array(content, dtype, nodata, ndim)
+        if np == None:
+            raise ImportError("Array results need the 'numpy' package")
+        if not isinstance(content, bytes): # searched with the methods of bytes, a bytes body isn't copied
+            content = bytes(content)
+        # trailing separators are skipped, like parse_csv_array does, instead of being counted as a cell
+        size = len(content)
+        while size > 0 and content[size - 1] in b', \t\r\n':
+            size -= 1
+        # cut right after a comma, so that no number is split between two chunks
+        cuts = [-1]
+        for index in range(1, self.max_workers):
+            cut = content.find(b',', size * index // self.max_workers, size)
+            if cut != -1 and cut > cuts[-1]:
+                cuts.append(cut)
+        cuts.append(size)
+        chunks = [(cuts[index] + 1, cuts[index + 1]) for index in range(len(cuts) - 1)]
+        counts = [content.count(b',', start, end) + 1 for start, end in chunks]
+        offsets = list(itertools.accumulate([0] + counts[:-1]))
+        total = sum(counts)
+        source = shared_memory.SharedMemory(create = True, size = max(size, 1))
+        target = shared_memory.SharedMemory(create = True, size = total * 8)
+        shared = False
+        try:
+            source.buf[:size] = memoryview(content)[:size]
+            executor = self.get_executor()
+            futures = [executor.submit(parse_csv_chunk, source.name, start, end, target.name, offset, count)
+                       for (start, end), offset, count in zip(chunks, offsets, counts)]
+            # the shape is worked out while the workers parse
+            shape = csv_shape(content.translate(None, CSV_NUMBER_BYTES).rstrip(b','), total) if b'{' in content else None
+            # all workers have to be done with the blocks before they are freed
+            for error in [future.exception() for future in futures]:
+                if error != None:
+                    raise error
+            view = np.ndarray((total,), np.float64, buffer = target.buf)
+            # float64 cells stay where the workers put them, other types are a converted copy
+            values = finish_array(view, dtype, nodata)
+            shared = np.may_share_memory(values, view)
+            if shared:
+                # the block is closed once the array and all its views are gone, its name is freed right away
+                weakref.finalize(view, close_shared_memory, target)
+            del view
+        finally:
+            source.close()
+            source.unlink()
+            target.unlink()
+            if not shared:
+                close_shared_memory(target)
+        if shape:
+            values = values.reshape(shape)
+        if ndim != None and values.ndim < ndim:
+            values = values.reshape((1,) * (ndim - values.ndim) + values.shape)
+        return values
+
+    def close(self):
+        with self.lock:
+            if self.executor != None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# the parser behind parse_csv_parallel and execute(), its workers are started by the first large result
+CSV_PARSER = CsvParser()
+
+
+def parse_csv_parallel(byte_str, dtype = 'float64', nodata = None, ndim = None):
+    
+   # parse_csv_array on all cores for results of PARALLEL_CSV_BYTES and more, with the shared CSV_PARSER.
+
+    return CSV_PARSER.parse(byte_str, dtype, nodata, ndim)
+
+
+def decode_raw(content, dtype = 'float64', shape = None, as_numpy = True):
+    """
+    Decodes a 'RAW' (application/octet-stream) result, little-endian cell values without any header,
+        without copying the response buffer.
+
+    Parameters:
+        content (bytes-like): The content of the server response.
+        dtype (str): The cell type of the coverage, e.g. 'float32' or 'int16'.
+        shape (tuple): Shape of the result, the octet stream itself doesn't carry it.
+        as_numpy (bool): Return a read-only NumPy array on top of the buffer. Otherwise a memoryview
+            is returned, which needs neither numpy nor a copy on little-endian machines.
+
+    """
+    if as_numpy:
+        if np == None:
+            raise ImportError("Array results need the 'numpy' package")
+        values = np.frombuffer(content, dtype = np.dtype(dtype).newbyteorder('<'))
+        return values.reshape(shape) if shape != None else values
+    typecode = np.dtype(dtype).char if np != None else RAW_TYPECODES[dtype]
+    if sys.byteorder == 'little':
+        values = memoryview(content).cast(typecode)
+    else:
+        # the cells have to be swapped on big-endian machines, which needs one copy
+        values = array.array(typecode, bytes(content))
+        values.byteswap()
+        values = memoryview(values)
+    return values.cast('B').cast(typecode, shape) if shape != None else values
+
+
+# struct typecodes of the cell types, used for 'RAW' results when numpy isn't installed
+RAW_TYPECODES = {'float64': 'd', 'float32': 'f', 'int8': 'b', 'uint8': 'B', 'int16': 'h', 'uint16': 'H',
+                 'int32': 'i', 'uint32': 'I', 'int64': 'q', 'uint64': 'Q'}
+
+
+def decode_geotiff(content):
+    
+   # Decodes a GEOTIFF result into a (bands, rows, columns) array, needs the optional 'rasterio' package.
+
+    try:
+        from rasterio.io import MemoryFile
+    except ImportError:
+        raise ImportError("Decoding GEOTIFF results needs the 'rasterio' package")
+    with MemoryFile(bytes(content)) as memory_file:
+        with memory_file.open() as dataset:
+            return dataset.read()
+
+
+def decode_netcdf(content):
+    
+   # Decodes a NETCDF result into a dict of variable name -> array, needs the optional 'netCDF4' package.
+
+    try:
+        import netCDF4
+    except ImportError:
+        raise ImportError("Decoding NETCDF results needs the 'netCDF4' package")
+    with netCDF4.Dataset('result.nc', memory = bytes(content)) as dataset:
+        return {name: variable[:] for name, variable in dataset.variables.items()}
+
+
+# any number written by the server, including nan and inf
+NUMBER = re.compile(rb'[-+]?(?:\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?|nan|inf)', re.IGNORECASE)
+
+
+def parse_stats(content, names):
+    
+   # Converts the composite result of dco.stats(), e.g. {1.5 2 3} or 1.5,2,3, into a dict of aggregation name -> value.
+
+    values = [float(number) for number in NUMBER.findall(bytes(content))]
+    if len(values) != len(names):
+        raise ValueError(f"Expected {len(names)} values for {names}, got {len(values)}")
+    return dict(zip(names, values))
+
+
+def iter_csv_values(chunks, block_size = None):
+    """
+    Parses comma separated numbers from an iterable of byte chunks (e.g. response.iter_content()),
+        without ever holding more than one chunk in memory. A number split between two chunks is
+        carried over to the next one, and the braces of nested CSV output ({1,2},{3,4}) are skipped.
+
+    Parameters:
+        chunks (iterable): Byte strings, in the order they were received.
+        block_size (int): If given, lists of 'block_size' floats are yielded instead of single
+            floats (the last one may be shorter).
+
+    Returns:
+        generator: Floats, or lists of floats.
+
+    """
+    tail = b''
+    block = []
+    for chunk in chunks:
+        if not chunk:
+            continue
+        chunk = tail + chunk.translate(None, b'{}')
+        # everything after the last comma may be the beginning of a number from the next chunk
+        cut = chunk.rfind(b',')
+        if cut == -1:
+            tail = chunk
+            continue
+        tail = chunk[cut + 1:]
+        for num in chunk[:cut].split(b','):
+            if num.strip():
+                if block_size == None:
+                    yield float(num)
+                else:
+                    block.append(float(num))
+                    if len(block) == block_size:
+                        yield block
+                        block = []
+    if tail.strip():
+        if block_size == None:
+            yield float(tail)
+        else:
+            block.append(float(tail))
+    if block:
+        yield block
+
+
+# a single axis of a subset: Lat(53.08), Long(0:10), ansi("2014-01":"2014-12"), ansi:"CRS:1"(0:5)
+SUBSET_AXIS = re.compile(r'\s*([A-Za-z_][A-Za-z0-9_]*(?::"[^"]*")?)\s*\(\s*("[^"]*"|[^:)]*?)\s*(?::\s*("[^"]*"|[^)]*?)\s*)?\)\s*(?:,|$)')
+
+
+def parse_subset(subset):
+    """
+    Splits a subset string into a list of (axis, low, high) tuples, with the bounds as they are
+        written (e.g. '53.08' or '"2014-01"'). 'high' is None for a slice like Lat(53.08).
+
+    Example:
+        >>> parse_subset('Lat(53.08), Long(0:10)')
+        [('Lat', '53.08', None), ('Long', '0', '10')]
+
+    """
+    axes = []
+    index = 0
+    subset = subset.strip()
+    while index < len(subset):
+        match = SUBSET_AXIS.match(subset, index)
+        if match == None:
+            raise ValueError(f"Subset can't be parsed: {subset}")
+        axes.append(match.groups())
+        index = match.end()
+    return axes
+
+
+def format_subset(axes):
+    
+   # Inverse of parse_subset.
+
+    return ', '.join(f'{axis}({low})' if high == None else f'{axis}({low}:{high})' for axis, low, high in axes)
+
+
+def parse_axis_value(value):
+    """
+    Turns a subset bound into a number on a regular scale: a float for numeric axes, and for dates
+        a count of years ("2014"), months ("2014-07") or days ("2014-07-15"). Returns (number, unit).
+
+    """
+    value = value.strip()
+    if not value.startswith('"'):
+        return float(value), None
+    text = value.strip('"')
+    try:
+        if len(text) == 4:
+            return int(text), 'year'
+        if len(text) == 7:
+            year, month = text.split('-')
+            return int(year) * 12 + int(month) - 1, 'month'
+        return datetime.date.fromisoformat(text[:10]).toordinal(), 'day'
+    except ValueError:
+        raise ValueError(f"Only numbers and dates like \"2014\", \"2014-07\" or \"2014-07-15\" can be tiled, not {value}")
+
+
+def format_axis_value(number, unit):
+    
+   # Inverse of parse_axis_value.
+
+    if unit == None:
+        return f'{number:.12g}'
+    if unit == 'year':
+        return f'"{number:04d}"'
+    if unit == 'month':
+        return f'"{number // 12:04d}-{number % 12 + 1:02d}"'
+    return f'"{datetime.date.fromordinal(number).isoformat()}"'
+
+
+def split_axis(low, high, tile_size, resolution = None):
+    """
+    Splits the range low:high of one axis into consecutive, non-overlapping tiles. Dates are split
+        into tiles of 'tile_size' years, months or days (the unit they are written in). Numeric axes
+        are split into tiles of 'tile_size' coordinate units, which needs the 'resolution' of the
+        axis, so that neighbouring tiles don't both contain the cells at their common border.
+
+    Returns:
+        list: (low, high, cells) of every tile, the bounds formatted for a subset.
+
+    """
+    low, unit = parse_axis_value(low)
+    high, high_unit = parse_axis_value(high)
+    if unit != high_unit:
+        raise ValueError("Both bounds of a subset must be written the same way")
+    if unit == None:
+        if resolution == None:
+            raise ValueError("Numeric axes need a resolution to be tiled")
+        step = abs(resolution)
+        cells = int(round((high - low) / step)) + 1
+        cells_per_tile = max(1, int(round(tile_size / step)))
+    else:
+        step = 1
+        cells = high - low + 1
+        cells_per_tile = int(tile_size)
+        if cells_per_tile < 1:
+            raise ValueError("Tiles of dates must be at least one year, month or day")
+    tiles = []
+    for first in range(0, cells, cells_per_tile):
+        last = min(first + cells_per_tile, cells) - 1
+        tile_low = low + first * step
+        tile_high = low + last * step
+        if unit != None:
+            tile_low, tile_high = int(tile_low), int(tile_high)
+        tiles.append((format_axis_value(tile_low, unit), format_axis_value(tile_high, unit), last - first + 1))
+    return tiles
+
+
+def decode_image(content):
+    
+   # Decodes PNG/JPEG bytes into a (rows, columns[, bands]) array, needs the optional 'Pillow' package.
+
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImportError("Decoding images needs the 'Pillow' package")
+    if np == None:
+        raise ImportError("Array results need the 'numpy' package")
+    with Image.open(io.BytesIO(bytes(content))) as image:
+        return np.asarray(image)
+
+
+def decode_to_shared_memory(content):
+    
+   # Runs in the worker processes of an ImageDecoder: decodes an image into a new shared memory block.
+
+    pixels = decode_image(content)
+    block = shared_memory.SharedMemory(create = True, size = max(1, pixels.nbytes))
+    np.ndarray(pixels.shape, pixels.dtype, buffer = block.buf)[...] = pixels
+    block.close()
+    return block.name, pixels.shape, pixels.dtype.str
+
+
+def take_shared_pixels(name, shape, dtype):
+    
+   # Copies the pixels of a worker out of its shared memory block and frees the block.
+
+    block = shared_memory.SharedMemory(name = name)
+    view = np.ndarray(shape, dtype, buffer = block.buf)
+    pixels = view.copy()
+    del view
+    block.close()
+    block.unlink()
+    return pixels
+
+
+def chain_future(source, target, convert = None):
+    
+   # Completes 'target' with the outcome of 'source', passing a result through 'convert' first.
+
+    def done(future):
+        try:
+            result = future.result()
+            target.set_result(convert(result) if convert != None else result)
+        except BaseException as error:
+            target.set_exception(error)
+    source.add_done_callback(done)
+
+
+class ImageDecoder:
+    """
+    Decodes PNG/JPEG results into pixel arrays on a pool of worker processes, so that decoding
+        doesn't compete with the request threads for the GIL. The workers hand the pixels back
+        through shared memory instead of pickling them. Needs the optional 'numpy' and 'Pillow'
+        packages.
+
+    Parameters:
+        max_workers (int): Number of worker processes, the number of CPUs by default.
+        mp_context: A multiprocessing context for the workers, the platform default if missing.
+
+    Example:
+        >>> with ImageDecoder() as decoder:
+        ...     images = decoder.execute_many(my_dbc, [tile.set_format('PNG') for tile in tiles])
+
+    """
+    def __init__(self, max_workers = None, mp_context = None):
+        if np == None:
+            raise ImportError("Array results need the 'numpy' package")
+        # the workers have to report their shared memory blocks to the same tracker as this process
+        resource_tracker.ensure_running()
+        self.executor = ProcessPoolExecutor(max_workers = max_workers, mp_context = mp_context)
+
+    def submit(self, content):
+        
+       # Starts decoding the bytes of an image and returns a Future of its pixel array.
+
+        pixels = Future()
+        chain_future(self.executor.submit(decode_to_shared_memory, bytes(content)), pixels,
+                     lambda block: take_shared_pixels(*block))
+        return pixels
+
+    def decode(self, content):
+        return self.submit(content).result()
+
+    def execute_many(self, my_dbc, items, yield_completed = False):
+        """
+        Sends PNG/JPEG queries on the thread pool of 'my_dbc' and decodes every response as soon as
+            it arrives, while the others are still downloading. 'items' can hold dco instances and
+            raw WCPS strings. Results and errors are returned like in dbc.execute_many.
+
+        """
+        queries = []
+        for item in items:
+            if isinstance(item, dco):
+                if item.format not in ('PNG', 'JPEG'):
+                    raise ValueError("Only PNG and JPEG results can be decoded into pixels")
+                queries.append(item.to_wcps_query())
+                item.reset()
+            elif isinstance(item, str):
+                queries.append(item)
+            else:
+                raise TypeError("Items must be dco instances or strings.")
+        futures = {}
+        for index, wcps_query in enumerate(queries):
+            decoded = Future()
+            my_dbc.submit(my_dbc.send_query, wcps_query).add_done_callback(
+                lambda download, decoded = decoded: self.decode_download(download, decoded))
+            futures[decoded] = index
+        if yield_completed:
+            return self.iter_completed(futures)
+        results = [None] * len(queries)
+        for index, result in self.iter_completed(futures):
+            results[index] = result
+        return results
+
+    def decode_download(self, download, decoded):
+        try:
+            chain_future(self.submit(download.result().content), decoded)
+        except BaseException as error:
+            decoded.set_exception(error)
+
+    def iter_completed(self, futures):
+        for future in as_completed(futures):
+            error = future.exception()
+            yield futures[future], (error if error != None else future.result())
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def axis_literal(value):
+    
+   # Writes a step of an axis the way a subset needs it: numbers as they are, dates and other text in quotes.
+
+    if isinstance(value, (int, float)):
+        return f'{value:.12g}' if isinstance(value, float) else str(value)
+    value = str(value).strip()
+    if value.startswith('"') or re.fullmatch(r'[-+]?\d+(\.\d*)?([eE][-+]?\d+)?', value):
+        return value
+    return f'"{value}"'
+
+
+def combine_aggregates(aggregation, values, weights = None):
+    
+   # Combines the aggregates of the tiles of a subset into the aggregate of the whole subset, averages are weighted by the cells of their tile.
+
+    if aggregation == 'MIN':
+        return min(values)
+    if aggregation == 'MAX':
+        return max(values)
+    if aggregation == 'AVG':
+        if weights == None:
+            raise ValueError("Averages of tiles can only be combined with the cell count of every tile")
+        # tiles without any cells (all null) have no average to add
+        pairs = [(value, weight) for value, weight in zip(values, weights) if weight > 0]
+        if not pairs:
+            return float('nan')
+        return sum(value * weight for value, weight in pairs) / sum(weight for value, weight in pairs)
+    # sums and counts just add up
+    return sum(values)
+
+
+def tile_regions(shapes, grid, tiled_axes, axis_order, descending = ()):
+    """
+    Works out where the tiles of a grid go in the combined array. 'shapes' holds the shape of every
+        tile, 'grid' its position along 'tiled_axes', 'axis_order' names the axis of every array
+        dimension, and along the 'descending' axes the tile with the highest coordinates comes first.
+
+    Returns:
+        tuple: The shape of the combined array and a list with the region (tuple of slices) of every tile.
+
+    """
+    for axis in tiled_axes:
+        if not (axis in axis_order):
+            raise ValueError(f"Axis {axis} isn't in the axis order {axis_order}")
+    dims = [axis_order.index(axis) for axis in tiled_axes]
+    counts = [max(position[i] for position in grid) + 1 for i in range(len(tiled_axes))]
+    # where every tile starts along every tiled dimension (tiles in one row/column have the same size)
+    sizes = [[0] * count for count in counts]
+    for tile_shape, position in zip(shapes, grid):
+        for i, dim in enumerate(dims):
+            sizes[i][position[i]] = tile_shape[dim]
+    starts = []
+    for i, axis in enumerate(tiled_axes):
+        order = range(counts[i] - 1, -1, -1) if axis in descending else range(counts[i])
+        offsets = [0] * counts[i]
+        offset = 0
+        for index in order:
+            offsets[index] = offset
+            offset += sizes[i][index]
+        starts.append(offsets)
+    shape = list(shapes[0])
+    for i, dim in enumerate(dims):
+        shape[dim] = sum(sizes[i])
+    regions = []
+    for tile_shape, position in zip(shapes, grid):
+        region = [slice(None)] * len(shape)
+        for i, dim in enumerate(dims):
+            region[dim] = slice(starts[i][position[i]], starts[i][position[i]] + tile_shape[dim])
+        regions.append(tuple(region))
+    return tuple(shape), regions
+
+
+def stitch_tiles(arrays, grid, tiled_axes, axis_order, descending = ()):
+    
+   # Puts the arrays of a grid of tiles together into one array, see tile_regions.
+
+    if np == None:
+        raise ImportError("Array results need the 'numpy' package")
+    shape, regions = tile_regions([array.shape for array in arrays], grid, tiled_axes, axis_order, descending)
+    stitched = np.empty(shape, dtype = arrays[0].dtype)
+    for array, region in zip(arrays, regions):
+        stitched[region] = array
+    return stitched
+
+
+class NpySink:
+    """
+    Writes the cells of a result into a memory-mapped .npy file while they are downloaded, see
+        dco.execute_to. Other processes open it with open_result() and share its pages instead of
+        unpickling a copy. The coverage, subset, format and query of the result are kept in a JSON
+        file next to it (path + '.json'). Tiled and batched executions write their parts into
+        disjoint regions of the same file, also from several processes (open_result with 'writable').
+        Needs the optional 'numpy' package.
+
+    Parameters:
+        path (str): The .npy file, it's overwritten.
+        shape (tuple): Shape of the result. If missing, the file is created by the first execution
+            that writes into it, with the shape of its result.
+        dtype (str): Cell type of the file, the values are converted to it.
+        metadata (dict): More metadata for the JSON file.
+
+    Example:
+        >>> with NpySink('temperature.npy', dtype = 'float32') as sink:
+        ...     datacube.subset('Lat(40:60), Long(0:20), ansi("2014-07")', '$c').execute_to(sink)
+        >>> cells, metadata = open_result('temperature.npy')
+
+    """
+    def __init__(self, path, shape = None, dtype = 'float64', metadata = None):
+        if np == None:
+            raise ImportError("Array results need the 'numpy' package")
+        if not isinstance(path, str):
+            raise TypeError("Value entered must be a string.")
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.metadata = dict(metadata) if metadata != None else {}
+        self.array = None
+        self.lock = threading.Lock()
+        if shape != None:
+            self.allocate(shape)
+
+    def allocate(self, shape):
+        
+       # Creates the file with the given shape, unless it already exists with that shape.
+
+        shape = tuple(int(size) for size in shape)
+        with self.lock:
+            if self.array is None:
+                self.array = np.lib.format.open_memmap(self.path, mode = 'w+', dtype = self.dtype, shape = shape)
+                self.metadata.update(shape = list(shape), dtype = self.dtype.str)
+                self.save_metadata()
+            elif self.array.shape != shape:
+                raise ValueError(f"The sink has the shape {self.array.shape}, not {shape}")
+        return self.array
+
+    def describe(self, **metadata):
+        with self.lock:
+            self.metadata.update(metadata)
+            if self.array is not None:
+                self.save_metadata()
+
+    def write(self, values, region = None, start = 0):
+        
+       # Writes values into 'region' of the file (a tuple of slices, the whole file by default), from its cell 'start' on in C order.
+
+        if self.array is None:
+            raise ValueError("The sink has no shape yet")
+        target = self.array if region == None else self.array[region]
+        values = np.asarray(values)
+        if start == 0 and values.shape == target.shape:
+            target[...] = values
+        else:
+            values = values.reshape(-1)
+            if start + len(values) > target.size:
+                raise ValueError(f"{start + len(values)} values don't fit into {target.size} cells")
+            target.flat[start:start + len(values)] = values
+
+    def save_metadata(self):
+        # called with the lock held
+        write_atomically(self.path + '.json', json.dumps(self.metadata).encode('utf-8'))
+
+    def close(self):
+        if self.array is not None:
+            self.array.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ArrowSink:
+    """
+    Writes the cells of a result into an Arrow IPC file while they are downloaded, see
+        dco.execute_to. The cells are one 'value' column, written in record batches of 'batch_size'
+        rows, and the coverage, subset, format, query and shape of the result are in the metadata of
+        the schema. Other processes open it with open_result(), which maps the file into memory
+        without copying. Arrow files are written front to back, so unlike a NpySink the parts of a
+        tiled or batched execution can't go into regions of one file. Needs the optional 'pyarrow' and
+        'numpy' packages.
+
+    """
+    def __init__(self, path, dtype = 'float64', metadata = None, batch_size = 65536):
+        if pa == None or np == None:
+            raise ImportError("Arrow results need the 'pyarrow' and 'numpy' packages")
+        if not isinstance(path, str):
+            raise TypeError("Value entered must be a string.")
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError("The batch size must be a positive integer")
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.metadata = dict(metadata) if metadata != None else {}
+        self.batch_size = batch_size
+        self.pending = []
+        self.pending_rows = 0
+        self.schema = None
+        self.writer = None
+        self.file = None
+        self.lock = threading.Lock()
+
+    def allocate(self, shape):
+        # the file grows with every batch, the shape is only recorded
+        self.describe(shape = [int(size) for size in shape])
+
+    def describe(self, **metadata):
+        with self.lock:
+            if self.writer != None:
+                raise ValueError("The metadata can't change after the first batch was written")
+            self.metadata.update(metadata)
 
+    def write(self, values, region = None, start = 0):
+        if region != None:
+            raise ValueError("An ArrowSink can only be written front to back")
+        values = np.asarray(values, dtype = self.dtype).reshape(-1)
+        with self.lock:
+            self.pending.append(values)
+            self.pending_rows += len(values)
+            if self.pending_rows >= self.batch_size:
+                self.write_batch()
 
-# database connection object
-class dbc:
-    # initalizing our dbc by providing it with the service endpoint, from which we can get a datacube
-    def __init__(self, url):
-    
-       # Initializes a new dbc instance which is used to manage connections and send queries to a WCPS server.
+    def write_batch(self):
+        # called with the lock held
+        if self.writer == None:
+            metadata = dict(self.metadata, dtype = self.dtype.str)
+            self.schema = pa.schema([pa.field('value', pa.from_numpy_dtype(self.dtype))],
+                                    metadata = {'wdc': json.dumps(metadata)})
+            self.file = pa.OSFile(self.path, 'wb')
+            self.writer = pa.ipc.new_file(self.file, self.schema)
+        if self.pending:
+            values = np.concatenate(self.pending)
+            self.writer.write_batch(pa.record_batch([pa.array(values)], schema = self.schema))
+        self.pending = []
+        self.pending_rows = 0
 
-      
-        if not isinstance(url, str):
-            raise TypeError("Value entered must be a string.")
-        self.server_url = url
-    
-    def send_query(self, wcps_query):
-        
-       # Sends a WCPS query to the server and retrieves the response.
+    def close(self):
+        with self.lock:
+            if self.file != None and self.file.closed:
+                return
+            self.write_batch()
+            self.writer.close()
+            self.file.close()
 
-     
-        if not isinstance(wcps_query, str):
-            raise TypeError("Value entered must be a string.")
-        # getting a response from the server
-        try:
-            # 'verify=False' is used to skip SSL certificate verification;
-            response = requests.post(self.server_url, data = {'query': wcps_query}, verify = False)
-            if response.status_code == 200:
-                return response
-            else:
-                raise ValueError("Not correct query")
-        except:
-            raise Exception("Something is wrong...")
-         # General exception handling to catch potential issues like network 
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc_info):
+        self.close()
 
 
+def open_result(path, writable = False):
+    """
+    Opens a result written by a NpySink (.npy) or ArrowSink (any other file) without copying it.
 
-# function needed for converting a byte string to the list of numbers
-def byte_to_list(byte_str):
+    Parameters:
+        writable (bool): Map a .npy file for writing, e.g. to fill regions of it from several processes.
+
+    Returns:
+        tuple: A memory-mapped NumPy array (or a pyarrow Table) and the dict of metadata.
+
+    """
+    if path.endswith('.npy'):
+        if np == None:
+            raise ImportError("Array results need the 'numpy' package")
+        cells = np.load(path, mmap_mode = 'r+' if writable else 'r')
+        metadata = {}
+        if os.path.exists(path + '.json'):
+            with open(path + '.json', encoding = 'utf-8') as metadata_file:
+                metadata = json.load(metadata_file)
+        return cells, metadata
+    if pa == None:
+        raise ImportError("Arrow results need the 'pyarrow' package")
+    table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    return table, json.loads(table.schema.metadata.get(b'wdc', b'{}'))
+
+
+# tokens of a WCPS expression, tried in this order
+WCPS_TOKEN = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<string>"[^"]*")
+  | (?P<placeholder>\$\{[A-Za-z_][A-Za-z0-9_]*\})
+  | (?P<var>\$[A-Za-z0-9_]+)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<open>[(\[{])
+  | (?P<close>[)\]}])
+  | (?P<operator>>=|<=|!=|:=|.)
+''', re.VERBOSE | re.DOTALL)
+
+BRACKETS = {'(': ')', '[': ']', '{': '}'}
+
+# names that can be followed by '(' outside of subsets and domain intervals
+WCPS_FUNCTIONS = {
+    'abs', 'sqrt', 'exp', 'log', 'ln', 'pow', 'power', 'sin', 'cos', 'tan', 'sinh', 'cosh', 'tanh', 'arcsin',
+    'arccos', 'arctan', 'round', 'floor', 'ceil', 'mod', 'div', 'bit', 'not', 'and', 'or', 'xor', 'min', 'max',
+    'avg', 'sum', 'count', 'add', 'all', 'some', 'encode', 'decode', 'imagecrsdomain', 'imagecrs', 'domain',
+    'crsset', 'crstransform', 'scale', 'extend', 'clip', 'flip', 'sort', 'identifier', 'nullset',
+    'interpolationdefault', 'interpolationset', 'complex', 'real', 'im', 're', 'log10', 'arctan2', 'cast', 'trim',
+    'slice', 'describecoverage',
+    # geometries of clip()
+    'point', 'linestring', 'polygon', 'multipoint', 'multilinestring', 'multipolygon', 'curtain', 'corridor',
+    # keywords that can be followed by a bracket
+    'in', 'return', 'where', 'values', 'using', 'case', 'default', 'over', 'is', 'let', 'for'}
+
+
+class WCPSNode:
+    """
+    A node of the syntax tree of a WCPS expression: a single token ('var', 'name', 'number',
+        'string', 'placeholder', 'operator'), a bracketed 'group' or a function 'call'. Groups and
+        calls hold their nodes in 'children', 'start' and 'end' are positions in the expression.
+
+    """
+    def __init__(self, kind, text, start, end, children = None):
+        self.kind = kind
+        self.text = text
+        self.start = start
+        self.end = end
+        self.children = children if children != None else []
+
+    def __repr__(self):
+        if self.children:
+            return f'{self.kind}({self.text!r}, {self.children!r})'
+        return f'{self.kind}({self.text!r})'
+
+
+class WCPSExpression:
+    """
+    A parsed WCPS expression, made by parse_wcps. It holds the syntax 'tree', the 'variables' in
+        the order they appear and where they are, so that checking and substituting variables
+        doesn't scan the text again.
+
+    """
+    def __init__(self, text, tree, var_tokens):
+        self.text = text
+        self.tree = tree
+        self.var_tokens = var_tokens
+        self.variables = [token.text for token in var_tokens]
+
+    def substitute(self, subsets):
+        
+       # Returns the expression with every variable of 'subsets' (name -> subset) followed by [subset], in one pass.
+
+        pieces = []
+        position = 0
+        for token in self.var_tokens:
+            subset = subsets.get(token.text)
+            if subset != None:
+                pieces.append(self.text[position:token.end])
+                pieces.append(f'[{subset}]')
+                position = token.end
+        pieces.append(self.text[position:])
+        return ''.join(pieces)
+
+
+def tokenize_wcps(expression):
     
-   # Converts a byte string into a list of floats. Useful for parsing numeric data returned from a server.
+   # Splits a WCPS expression into (kind, text, start, end) tokens, whitespace is dropped.
 
+    tokens = []
+    for match in WCPS_TOKEN.finditer(expression):
+        kind = match.lastgroup
+        if kind != 'space':
+            tokens.append((kind, match.group(), match.start(), match.end()))
+    if tokens and tokens[-1][1] == '"':
+        raise ValueError(f"Unterminated string at position {tokens[-1][2]}")
+    return tokens
 
-    decoded_str = byte_str.decode('utf-8') # decode the byte string
-    str_list = decoded_str.split(',') # split numbers separated by comma
-    num_list = [float(num) for num in str_list] # create a list of numbers
-    return num_list
+
+@functools.lru_cache(maxsize = 1024)
+def parse_wcps(expression, strict = False):
+    """
+    Parses a WCPS expression into a WCPSExpression in one linear pass. Parsed expressions are
+        cached, so checking the same condition again costs nothing.
+
+    Parameters:
+        strict (bool): Also reject calls of functions that aren't in WCPS_FUNCTIONS. Servers may
+            know more functions than that list, so they are accepted by default.
+
+    Raises:
+        ValueError: Unbalanced or mismatched brackets, unterminated strings, or with 'strict'
+            unknown functions.
+
+    """
+    root = WCPSNode('expression', '', 0, len(expression))
+    stack = [root]
+    var_tokens = []
+    # how many of the open brackets are subsets [...] or domain intervals {...}, where axis names are followed by '('
+    axis_context = 0
+    for kind, text, start, end in tokenize_wcps(expression):
+        parent = stack[-1]
+        if kind == 'open':
+            group = WCPSNode('group', text, start, None)
+            previous = parent.children[-1] if parent.children else None
+            if text == '(' and previous != None and previous.kind == 'name':
+                before = parent.children[-2] if len(parent.children) > 1 else None
+                # an axis iterator like '$pt ansi(...)' isn't a function call either
+                if strict and axis_context == 0 and not (before != None and before.kind == 'var') \
+                        and not (previous.text.lower() in WCPS_FUNCTIONS):
+                    raise ValueError(f"Unknown function {previous.text} at position {previous.start}")
+                parent.children[-1] = WCPSNode('call', previous.text, previous.start, None, [group])
+            else:
+                parent.children.append(group)
+            if text != '(':
+                axis_context += 1
+            stack.append(group)
+        elif kind == 'close':
+            if len(stack) == 1:
+                raise ValueError(f"Unbalanced bracket {text} at position {start}")
+            group = stack.pop()
+            if BRACKETS[group.text] != text:
+                raise ValueError(f"Bracket {group.text} at position {group.start} is closed by {text} at position {start}")
+            group.end = end
+            if group.text != '(':
+                axis_context -= 1
+            if stack[-1].children and stack[-1].children[-1].kind == 'call':
+                stack[-1].children[-1].end = end
+        else:
+            if kind == 'operator' and text == '"':
+                raise ValueError(f"Unterminated string at position {start}")
+            token = WCPSNode(kind, text, start, end)
+            parent.children.append(token)
+            if kind == 'var':
+                var_tokens.append(token)
+    if len(stack) > 1:
+        raise ValueError(f"Bracket {stack[-1].text} at position {stack[-1].start} is never closed")
+    return WCPSExpression(expression, root, var_tokens)
 
 
 # datacube object
@@ -68,6 +2460,7 @@ class dco:
         self.var_names = []
         self.transformation = None
         self.encode_as = None
+        self.aggregations = []
         
     def reset(self):
       
@@ -82,36 +2475,43 @@ class dco:
         self.var_names = []
         self.transformation = None
         self.encode_as = None
+        self.aggregations = []
         return self
 
+    def fork(self):
+        
+       # Returns an independent copy of the dco, e.g. to execute variations of a base query without rebuilding it.
+
+        copy = dco.__new__(dco)
+        copy.__dict__.update(self.__dict__)
+        copy.vars = list(self.vars)
+        copy.Subsets = list(self.Subsets)
+        copy.var_names = list(self.var_names)
+        copy.aggregations = list(self.aggregations)
+        return copy
+
+    def prepare(self):
+        """
+        Compiles the current state of the dco into a PreparedQuery. Subsets and conditions can contain
+            named placeholders like '${lat}', which get their values on every execution, without
+            building or validating the query again. The dco itself is left unchanged.
+
+        Example:
+            >>> query = datacube.subset('Lat(${lat}), Long(${long}), ansi("2014-07")', '$c').avg('$c').prepare()
+            >>> query.execute({'lat': 53.08, 'long': 8.80})
+
+        """
+        return PreparedQuery(self.DBC, self.to_wcps_query(), self.format, stats = self.aggregations)
+
     
     def get_all_var_names(self, string):
         """
         Extracts all variable names from a string where variables are prefixed by '$' and can be
-            followed by various delimiters such as spaces, commas, parentheses, etc.
+            followed by various delimiters such as spaces, commas, parentheses, etc. The string is
+            parsed with parse_wcps, so malformed expressions are reported here with a ValueError.
 
         """
-        var_names = []
-        index = 0
-        while index < len(string):
-            start_index = string.find('$', index) # Find the index of the next '$' symbol starting from 'index'
-            if start_index == -1:
-                break
-            
-            # Define a list of characters that should terminate the variable name
-            delimiters = [' ', ',', '(', ')', '[', ']', '{', '}', ';', '>', '<', '+', '-', '=', '.', 
-                         '/', '\\', '|', '!']
-            end_index = len(string)
-            
-            # Enumerate through the substring starting from 'start_index' to find the first delimiter
-            for i, char in enumerate(string[start_index:]):
-                if char in delimiters:
-                    end_index = start_index + i
-                    break
-
-            var_names.append(string[start_index:end_index])
-            index = end_index
-            
+        var_names = parse_wcps(string).variables
         if len(var_names) == 0:
             return None
         return var_names
@@ -130,7 +2530,10 @@ class dco:
         if not(s.startswith('$') and " in (" in s and s.endswith(')')):
             raise ValueError("The format of variable initialization wasn't correct")
         
-        var_name = self.get_all_var_names(s)[0]
+        var_names = self.get_all_var_names(s)
+        if var_names == None:
+            raise ValueError("The format of variable initialization wasn't correct")
+        var_name = var_names[0]
         self.vars.append(s)
         #No subset has been defined yet
         self.Subsets.append(None)
@@ -145,10 +2548,6 @@ class dco:
         before proceeding with further operations.
 
         """
-        # Normalize the string by replacing common whitespace characters with a space
-        string = string.replace('\n', ' ')
-        string = string.replace('\r', ' ')
-        string = string.replace('\t', ' ')
         var_names = self.get_all_var_names(string)
         if var_names != None:
             var_names = set(var_names)
@@ -174,6 +2573,7 @@ class dco:
             raise TypeError("Value entered must be a string.")
         if not(var_name in self.var_names):
             raise ValueError("Such variable doesn't exist")
+        parse_wcps(f'[{subset}]') # unbalanced brackets or quotes are reported right away
         # index of the variable name in the var_names list
         idx = self.var_names.index(var_name)
         # Update the subset specification at the corresponding index in the Subsets list
@@ -201,11 +2601,15 @@ class dco:
         the format in which the data should be returned after a query is executed, enabling different
         types of data processing.
 
+        Besides 'PNG', 'CSV' and 'JPEG', numeric data can be requested in binary form: 'RAW'
+            (application/octet-stream, decoded without copying), 'GEOTIFF' and 'NETCDF'.
+            With 'AUTO', execute() picks 'RAW' or 'CSV' for every query (see choose_format) and
+            returns the same value either way.
 
         """
         if not isinstance(output_format, str):
             raise TypeError("Value entered must be a string.")
-        if not (output_format in ['PNG', 'CSV', 'JPEG']):
+        if not (output_format in ['PNG', 'CSV', 'JPEG', 'RAW', 'GEOTIFF', 'NETCDF', 'AUTO']):
             raise ValueError("Entered format doesn't exist")
         self.format = output_format
         return self
@@ -225,6 +2629,7 @@ class dco:
             self.do_vars_exist(condition)
         self.aggregation_condition = condition
         self.aggregation = 'MIN'
+        self.aggregations = []
         return self
         
     def max(self, condition = None):
@@ -240,6 +2645,7 @@ class dco:
             self.do_vars_exist(condition)
         self.aggregation_condition = condition
         self.aggregation = 'MAX'
+        self.aggregations = []
         return self
     
     def avg(self, condition = None):
@@ -255,6 +2661,7 @@ class dco:
             self.do_vars_exist(condition)
         self.aggregation_condition = condition
         self.aggregation = 'AVG'
+        self.aggregations = []
         return self
     
     def sum(self, condition = None):
@@ -271,6 +2678,7 @@ class dco:
             self.do_vars_exist(condition)
         self.aggregation_condition = condition
         self.aggregation = 'SUM'
+        self.aggregations = []
         return self
         
     def count(self, condition = None):
@@ -286,8 +2694,184 @@ class dco:
             self.do_vars_exist(condition)
         self.aggregation = 'COUNT'
         self.aggregation_condition = condition
+        self.aggregations = []
         return self
     
+    def coverage_name(self, var):
+        
+       # The coverage of a variable initialization like '$c in (AvgLandTemp)'.
+
+        return var[var.index(' in (') + 5:-1].strip()
+
+    def validate(self):
+        """
+        Checks the coverages and subsets of the dco against the coverage descriptions of the dbc,
+            which are fetched once and cached, so that a wrong coverage name or a subset outside of
+            the coverage is reported before the query is sent. With the 'strict_functions' setting
+            of the dbc, the expressions of the dco may only call functions of WCPS_FUNCTIONS.
+
+        Raises:
+            ValueError: A coverage or axis doesn't exist, a subset is out of the coverage extent, or
+                an expression calls an unknown function.
+
+        """
+        if self.DBC.strict_functions:
+            for expression in (self.filter_condition, self.aggregation_condition, self.transformation, self.encode_as):
+                if expression != None:
+                    parse_wcps(expression, strict = True)
+        for var, subset in zip(self.vars, self.Subsets):
+            name = self.coverage_name(var)
+            try:
+                metadata = self.DBC.describe_coverage(name)
+            except QueryError:
+                raise ValueError(f"Coverage {name} doesn't exist")
+            if subset == None or '${' in subset:
+                continue
+            for axis_name, low, high in parse_subset(subset):
+                axis = metadata.axis(axis_name)
+                if ':' in axis_name:
+                    # grid coordinates
+                    if any(not (0 <= float(bound) < axis.size) for bound in (low, high) if bound != None):
+                        raise ValueError(f"Subset {format_subset([(axis_name, low, high)])} is outside of the "
+                                         f"{axis.size} cells of {name}")
+                    continue
+                for bound in (low, high):
+                    if bound != None and not axis.contains(bound):
+                        raise ValueError(f"Subset {axis_name} bound {bound} is outside of {name} "
+                                         f"({axis.lower}:{axis.upper})")
+                if high != None and axis.key(low) > axis.key(high):
+                    raise ValueError(f"Subset {format_subset([(axis_name, low, high)])} has its bounds the wrong way round")
+        return self
+
+    def estimate(self):
+        """
+        Estimates the size of the result of the query before sending it, from the coverage
+            descriptions of the dbc.
+
+        Returns:
+            dict: 'cells' of the result and their size in 'bytes' when encoded as binary values.
+
+        """
+        if self.aggregation != None or self.aggregations:
+            return {'cells': 1, 'bytes': 8 * max(1, len(self.aggregations))}
+        cells = 0
+        size = 8
+        for var, subset in zip(self.vars, self.Subsets):
+            metadata = self.DBC.describe_coverage(self.coverage_name(var))
+            bounds = {axis_name.split(':')[0]: (low, high) for axis_name, low, high in parse_subset(subset or '')}
+            var_cells = 1
+            for axis in metadata.axes:
+                if not (axis.name in bounds):
+                    var_cells *= axis.size or 1
+                elif bounds[axis.name][1] != None:
+                    var_cells *= axis.count_cells(*bounds[axis.name])
+            # the variables are combined cell by cell, the result is as big as the biggest of them
+            if var_cells > cells:
+                cells = var_cells
+                size = metadata.cell_size()
+        return {'cells': cells, 'bytes': cells * size}
+
+    def choose_format(self):
+        """
+        Picks the encoding of a query with set_format('AUTO'). 'RAW' is chosen when the query returns a
+            plain subset of one single-band coverage, the server lists application/octet-stream among
+            its formats, and the binary result is smaller than the CSV one and at least
+            'auto_min_bytes' (a dbc setting) big. The octet stream doesn't carry the shape of the
+            result, so it is counted from the coverage description, or asked from the server with
+            imageCrsDomain() if the description can't tell. Everything else, e.g. aggregations, or
+            anything that can't be found out, is fetched as 'CSV'.
+
+        Returns:
+            tuple: ('RAW', (cell dtype, shape)) or ('CSV', None)
+
+        """
+        plain = (len(self.vars) == 1 and self.aggregation == None and not self.aggregations and self.encode_as == None
+                 and self.transformation == None and self.filter_condition == None)
+        if not plain:
+            return 'CSV', None
+        try:
+            if not ('application/octet-stream' in self.DBC.formats()):
+                return 'CSV', None
+            metadata = self.DBC.describe_coverage(self.coverage_name(self.vars[0]))
+            if len(metadata.bands) != 1:
+                return 'CSV', None
+            cell_dtype = metadata.bands[0][1]
+            cells = self.estimate()['cells']
+            raw_bytes = cells * BAND_SIZES[cell_dtype]
+            if raw_bytes < self.DBC.auto_min_bytes or raw_bytes >= cells * CSV_CELL_BYTES[cell_dtype]:
+                return 'CSV', None
+            shape = self.metadata_shape(metadata) or self.domain_shape()
+        except (WCPSError, ValueError, ElementTree.ParseError):
+            return 'CSV', None
+        return 'RAW', (cell_dtype, shape)
+
+    def metadata_shape(self, metadata):
+        
+       # Counts the shape of the subset of the first variable from its coverage description, like estimate() does; None if it can't.
+
+        bounds = {}
+        for axis_name, low, high in parse_subset(self.Subsets[0] or ''):
+            if ':' in axis_name: # grid coordinates, e.g. Lat:"CRS:1"(0:99)
+                return None
+            bounds[axis_name] = (low, high)
+        shape = []
+        for axis in metadata.axes:
+            if not (axis.name in bounds):
+                if not axis.size:
+                    return None
+                shape.append(axis.size)
+            elif bounds[axis.name][1] != None: # sliced axes aren't dimensions of the result
+                shape.append(axis.count_cells(*bounds[axis.name]))
+        return tuple(shape)
+
+    def domain_shape(self):
+        
+       # Asks the server for the shape of the subset of the first variable with imageCrsDomain().
+
+        response = self.DBC.send_query(f'for {self.vars[0]} return imageCrsDomain({self.replace_variables_with_subsets()})')
+        # e.g. (0:99,0:49) or Lat(0:99),Long(0:49) -> (100, 50)
+        bounds = re.findall(r'(-?\d+)\s*:\s*(-?\d+)', str(bytes(response.content), 'utf-8'))
+        if not bounds:
+            raise ValueError(f"No domain in the answer of the server: {bytes(response.content)[:100]}")
+        return tuple(int(high) - int(low) + 1 for low, high in bounds)
+
+    def resolve_query(self, stream = False):
+        
+       # Builds the query for execute(), with the encoding of an 'AUTO' dco picked; returns (query, format, layout).
+
+        if self.format != 'AUTO' or stream: # streamed 'AUTO' results are CSV
+            return self.to_wcps_query(), self.format, None
+        output_format, layout = self.choose_format()
+        if layout != None:
+            # the shape is counted from the coverage description, the server may cut the subset one cell
+            # differently at the edges; then the shape is asked from the server (after this dco is reset)
+            layout = layout + (self.fork().domain_shape,)
+        return self.fork().set_format(output_format).to_wcps_query(), output_format, layout
+
+    def stats(self, aggregations, condition = None):
+        """
+        Configures the datacube to compute several aggregations of the same data subset in one query,
+            e.g. stats(['MIN', 'MAX', 'AVG', 'COUNT']), instead of one query per aggregation.
+            execute() then returns a dict of aggregation name -> value.
+
+        """
+        if not isinstance(aggregations, (list, tuple)) or len(aggregations) == 0:
+            raise TypeError("Aggregations must be given as a list of names.")
+        for aggregation in aggregations:
+            if not (aggregation in ['MIN', 'MAX', 'AVG', 'SUM', 'COUNT']):
+                raise ValueError("Entered aggregation doesn't exist")
+        if len(set(aggregations)) != len(aggregations):
+            raise ValueError("Every aggregation can only be used once")
+        #if condition is provided, check if it's a string and if all the variables are pre-defined
+        if condition != None:
+            if not isinstance(condition, str):
+                raise TypeError("Value entered must be a string.")
+            self.do_vars_exist(condition)
+        self.aggregation_condition = condition
+        self.aggregation = None
+        self.aggregations = list(aggregations)
+        return self
+
     def replace_variables_with_subsets(self, str_to_transform = None):
         """
         Replaces variables in a given string with their corresponding subsets if defined.
@@ -298,13 +2882,9 @@ class dco:
         #This distinction is critical as it determines the course of action
         #code will either modifying an existing string or creating a new list of all variables and their subsets.
         if str_to_transform != None:
-            expression = str_to_transform
-            #iterate over tuples of variables and corresponding subsets
-            for var, subset in zip(self.var_names, self.Subsets):
-                if subset != None:
-                    #replace the variable in the expression with its subset
-                    expression = expression.replace(var, f'{var}[{subset}]')
-            return expression
+            # the variables are found by the parser, so $c inside $cc or inside a string is left alone
+            subsets = {var: subset for var, subset in zip(self.var_names, self.Subsets) if subset != None}
+            return parse_wcps(str_to_transform).substitute(subsets)
         else:
             expression = ''
             for var, subset in zip(self.var_names, self.Subsets):
@@ -383,17 +2963,36 @@ class dco:
             query = f'''count({helper_query})'''
         return query
     
+    def aggregate_many(self):
+        
+        # Constructs the part of the WCPS query for stats(): all aggregations as the fields of one composite value.
+
+        helper_query = self.replace_variables_with_subsets(self.aggregation_condition)
+        fields = []
+        for aggregation in self.aggregations:
+            if aggregation == 'CELLS': # the cells that aren't null, which avg() is taken over (used by execute_tiled)
+                fields.append(f'cells_value: count(({helper_query}) = ({helper_query}))')
+            else:
+                fields.append(f'{aggregation.lower()}_value: {aggregation.lower()}({helper_query})')
+        return '{' + '; '.join(fields) + '}'
+
     def return_format(self):
      
        # Determines the format for the output based on the configured settings of the datacube.
 
   
-        if self.format == 'CSV':
+        if self.format == 'CSV' or self.format == 'AUTO': # 'AUTO' queries that execute() didn't resolve are CSV
             query = "text/csv" # if the desired format of the output is text/csv
         elif self.format == 'PNG':
             query = "image/png" # if the desired format of the output is image/png:
         elif self.format == 'JPEG': 
             query = "image/jpeg" # if the desired format of the output is image/jpeg:
+        elif self.format == 'RAW':
+            query = "application/octet-stream" # raw cell values, without any header
+        elif self.format == 'GEOTIFF':
+            query = "image/tiff"
+        elif self.format == 'NETCDF':
+            query = "application/netcdf"
         return query
     
     
@@ -416,6 +3015,9 @@ class dco:
         if self.aggregation != None:
             query += self.aggregate_data()
             return query
+        if self.aggregations:
+            query += self.aggregate_many()
+            return query
         
         # we check if the encoding conditions were specified. If they were, we will add them to 'return'
         if self.encode_as != None:
@@ -439,24 +3041,720 @@ class dco:
     
     
     # executing, when all the operations were added
-    def execute(self):
-        
-       # Executes the constructed WCPS query and processes the response based on the specified format.
+    def execute(self, stream = False, block_size = None, chunk_size = 65536, as_numpy = False, dtype = 'float64',
+                nodata = None, shape = None, refresh = False, lazy = False):
+        """
+        Executes the constructed WCPS query and processes the response based on the specified format.
 
- 
-        wcps_query = self.to_wcps_query() # get a WCPS query
-        response = self.DBC.send_query(wcps_query) # pass the WCPS query to the server and get a response
-        if self.format == 'CSV': # if the format is CSV, convert binary string to the list of numbers
-            data = byte_to_list(response.content) 
-            self.reset() # returning the values of the dco instance to default
-            return data
-        elif self.format == 'PNG': # if the format is PNG, return the image
-            self.reset() # returning the values of the dco instance to default
-            return response.content
-        elif self.format == 'JPEG': # if the format is JPEG, return the image
+        Parameters:
+            stream (bool): Instead of the whole result, return a generator that downloads and parses
+                the response 'chunk_size' bytes at a time, so that memory use doesn't grow with the
+                size of the coverage. Numbers are yielded as floats (or as lists of 'block_size'
+                floats), the binary formats (PNG, JPEG, RAW, GEOTIFF, NETCDF) as byte chunks.
+            as_numpy (bool): Return numbers as a NumPy array shaped like the coverage, see parse_csv_array
+                for 'dtype' and 'nodata'. GEOTIFF and NETCDF results are decoded into arrays as well.
+            dtype (str), shape (tuple): Cell type and shape of a 'RAW' result, see decode_raw.
+            refresh (bool): Bypass the cache of the dbc and fetch the result from the server again.
+            lazy (bool): Return a LazyResult right away. The query is sent on the thread pool of the
+                dbc, and the response is only decoded into the form the caller asks for.
+
+        """
+        if stream and lazy:
+            raise ValueError("A result can't be streamed and lazy at the same time")
+        if stream and self.aggregations:
+            raise ValueError("The result of stats() is a single composite value and can't be streamed")
+        if self.DBC.validate:
+            self.validate()
+        stats = self.aggregations
+        start = time.perf_counter()
+        wcps_query, output_format, layout = self.resolve_query(stream) # get a WCPS query
+        metrics = QueryMetrics(wcps_query)
+        metrics.build = time.perf_counter() - start
+        if lazy:
+            future = self.DBC.submit(self.DBC.send_query, wcps_query, refresh = refresh, metrics = metrics)
+            future.add_done_callback(lambda done: self.DBC.emit(metrics))
+            self.reset()
+            return LazyResult(future, output_format, dtype, nodata, shape, stats, layout)
+        try:
+            # pass the WCPS query to the server and get a response
+            response = self.DBC.send_query(wcps_query, stream = stream, refresh = refresh, metrics = metrics)
             self.reset() # returning the values of the dco instance to default
-            return response.content
+            if stream:
+                return self.stream_result(response, output_format, block_size, chunk_size)
+            start = time.perf_counter()
+            result = self.parse_result(response.content, output_format, as_numpy, dtype, nodata, shape, stats, layout)
+            metrics.parse = time.perf_counter() - start
+            return result
+        except Exception as error:
+            metrics.error = error
+            raise
+        finally:
+            self.DBC.emit(metrics)
+
+    def stream_result(self, response, output_format, block_size, chunk_size):
+        
+       # Generator behind execute(stream = True), it gives the connection back to the pool once it is exhausted or closed.
+
+        try:
+            if output_format in ('PNG', 'JPEG', 'RAW', 'GEOTIFF', 'NETCDF'): # binary, passed on as it is
+                yield from response.iter_content(chunk_size)
+            else:
+                yield from iter_csv_values(response.iter_content(chunk_size), block_size)
+        finally:
+            response.close()
+
+    def execute_to(self, sink, region = None, chunk_size = 65536):
+        """
+        Executes the query and writes the cells of the result into a NpySink or ArrowSink while the
+            response is downloaded, without building a list or array of the whole result first. The
+            coverage, subset, format and query are added to the metadata of the sink. CSV, RAW
+            (cells of the type of the sink) and 'AUTO' results can be written, and stats() and
+            aggregations as their values.
+
+        Parameters:
+            sink (NpySink or ArrowSink): Where the cells go. A NpySink without a shape is created
+                with the shape of the result, which is asked from the server with imageCrsDomain()
+                unless the query is an aggregation.
+            region (tuple): Slices of a NpySink that the result is written into, in C order, e.g.
+                (slice(0, 10), slice(None)), so that several queries can fill one file.
+
+        Returns:
+            The sink.
+
+        Raises:
+            ValueError: The result has more or fewer cells than the sink (or its region), or a RAW
+                result ends with an incomplete cell.
+
+        """
+        if not isinstance(sink, (NpySink, ArrowSink)):
+            raise TypeError("NpySink or ArrowSink instance not passed")
+        if self.format in ('PNG', 'JPEG', 'GEOTIFF', 'NETCDF'):
+            raise ValueError(f"{self.format} results have no cells that could be written into a sink")
+        if self.DBC.validate:
+            self.validate()
+        stats = self.aggregations
+        start = time.perf_counter()
+        wcps_query, output_format, layout = self.resolve_query()
+        cell_dtype = layout[0] if layout != None else sink.dtype
+        if region != None or (isinstance(sink, NpySink) and sink.array is not None):
+            shape = None # the cells are already there
+        elif stats or self.aggregation != None:
+            shape = (len(stats) or 1,)
+        elif layout != None:
+            shape = layout[2]() # the file is created before the cells arrive, so its shape must be exact
+        elif isinstance(sink, NpySink):
+            shape = self.domain_shape()
+        else:
+            shape = None # an Arrow file grows with the result
+        sink.describe(coverage = [self.coverage_name(var) for var in self.vars], subset = list(self.Subsets),
+                      format = output_format, query = wcps_query)
+        if shape != None:
+            sink.allocate(shape)
+        metrics = QueryMetrics(wcps_query)
+        metrics.build = time.perf_counter() - start
+        self.reset()
+        try:
+            response = self.DBC.send_query(wcps_query, stream = True, metrics = metrics)
+            start = time.perf_counter()
+            position = 0
+            try:
+                if stats:
+                    values = list(parse_stats(response.content, stats).values())
+                    sink.write(values, region)
+                    position = len(values)
+                elif output_format == 'RAW':
+                    # cells can be split between two chunks
+                    cell_size = np.dtype(cell_dtype).itemsize
+                    tail = b''
+                    for chunk in response.iter_content(chunk_size):
+                        chunk = tail + chunk
+                        cut = len(chunk) - len(chunk) % cell_size
+                        cells = np.frombuffer(chunk, dtype = cell_dtype, count = cut // cell_size)
+                        sink.write(cells, region, position)
+                        position += len(cells)
+                        tail = chunk[cut:]
+                    if tail:
+                        raise ValueError(f"The RAW result ends with {len(tail)} bytes of an incomplete {cell_dtype} cell")
+                else:
+                    for block in iter_csv_values(response.iter_content(chunk_size), max(1, chunk_size // 8)):
+                        sink.write(block, region, position)
+                        position += len(block)
+            finally:
+                response.close()
+            if isinstance(sink, NpySink):
+                expected = (sink.array if region == None else sink.array[region]).size
+            else:
+                expected = int(np.prod(shape)) if shape != None else position
+            if position != expected:
+                raise ValueError(f"The result has {position} cells, but {expected} were expected in the sink")
+            metrics.parse = time.perf_counter() - start
+            return sink
+        except Exception as error:
+            metrics.error = error
+            raise
+        finally:
+            self.DBC.emit(metrics)
+
+    async def aexecute(self, as_numpy = False, dtype = 'float64', nodata = None, shape = None):
+        """
+        Awaitable version of execute(). With an AsyncDbc the query is sent on the event loop, so many
+            queries can be in flight at once; with a plain dbc the blocking send_query runs in a
+            worker thread instead. The array options are the same as for execute().
+
+        """
+        if self.DBC.validate: # the coverage descriptions may have to be fetched, which blocks
+            await asyncio.to_thread(self.validate)
+        stats = self.aggregations
+        start = time.perf_counter()
+        if self.format == 'AUTO': # picking the format may ask the server, which blocks
+            wcps_query, output_format, layout = await asyncio.to_thread(self.resolve_query)
         else:
+            wcps_query, output_format, layout = self.resolve_query()
+        metrics = QueryMetrics(wcps_query)
+        metrics.build = time.perf_counter() - start
+        try:
+            if isinstance(self.DBC, AsyncDbc):
+                response = await self.DBC.asend_query(wcps_query, metrics = metrics)
+            else:
+                response = await asyncio.to_thread(self.DBC.send_query, wcps_query, metrics = metrics)
             self.reset()
-            data = byte_to_list(response.content) 
-            return data
\ No newline at end of file
+            start = time.perf_counter()
+            result = self.parse_result(response.content, output_format, as_numpy, dtype, nodata, shape, stats, layout)
+            metrics.parse = time.perf_counter() - start
+            return result
+        except Exception as error:
+            metrics.error = error
+            raise
+        finally:
+            self.DBC.emit(metrics)
+
+    def parse_result(self, content, output_format, as_numpy = False, dtype = 'float64', nodata = None, shape = None,
+                     stats = None, layout = None):
+        
+       # Converts the content of a server response into the value execute() returns for the given output format.
+
+        if stats: # the composite value of stats(), e.g. {1.5 2 3}, becomes a dict
+            return parse_stats(content, stats)
+        if output_format == 'RAW' and layout != None: # an 'AUTO' result, returned the way a CSV one would be
+            cell_dtype, cell_shape, domain_shape = layout
+            if as_numpy:
+                if len(content) != math.prod(cell_shape) * BAND_SIZES[cell_dtype]:
+                    cell_shape = domain_shape()
+                return finish_array(decode_raw(content, cell_dtype, cell_shape), dtype, nodata)
+            return [float(value) for value in decode_raw(content, cell_dtype, as_numpy = False).tolist()]
+        if output_format == 'PNG' or output_format == 'JPEG': # images are returned as they are
+            return content
+        if output_format == 'RAW':
+            return decode_raw(content, dtype, shape, as_numpy)
+        if output_format == 'GEOTIFF':
+            return decode_geotiff(content) if as_numpy else content
+        if output_format == 'NETCDF':
+            return decode_netcdf(content) if as_numpy else content
+        # CSV or no format at all, convert binary string to the list of numbers (or to an array)
+        if as_numpy:
+            return parse_csv_parallel(content, dtype, nodata)
+        return byte_to_list(content)
+
+    def execute_tiled(self, tiles, var_name = None, resolution = None, axis_order = None, descending = (),
+                      max_workers = None, retries = 2, dtype = 'float64', nodata = None, sink = None):
+        """
+        Executes the query as a grid of smaller queries (tiles), fetched in parallel and put back
+            together, so that large subsets don't hit server timeouts or memory limits. Failed tiles
+            are retried on their own, and every tile goes through the cache of the dbc.
+
+        Parameters:
+            tiles (dict): Tile size per axis of the subset, e.g. {'Lat': 10, 'ansi': 12}. Dates are
+                tiled in the unit they are written in, e.g. 12 months for ansi("2000-01":"2019-12").
+            var_name (str): The variable whose subset is tiled, the first one with a subset by default.
+            resolution (dict): Cell size of numeric axes, e.g. {'Lat': 0.5}, see split_axis. Taken from
+                the coverage description if missing.
+            axis_order (list): Axes in the order of the dimensions of the result, by default the
+                trimmed axes in the order they are written in the subset.
+            descending (tuple): Axes which go from high to low coordinates in the result, e.g. 'Lat'
+                for the rows of an image.
+            retries (int): How many times a tile is sent again after a retryable error.
+            sink (NpySink): Write every tile into its region of the sink as soon as it arrives, instead
+                of stitching them together in memory. A sink without a shape gets the shape of the
+                whole subset. The regions follow from the tile sizes, a tile of another shape raises
+                a ValueError.
+
+        Returns:
+            The combined aggregate for min/max/avg/sum/count queries (as a list, like execute()),
+                the dict of combined aggregates for stats() queries, otherwise a NumPy array of
+                the whole subset (PNG/JPEG tiles are decoded with decode_image), or the sink.
+
+        """
+        if not isinstance(tiles, dict) or not tiles:
+            raise TypeError("Tile sizes must be given as a dict of axis -> size")
+        if var_name == None:
+            var_name = next((var for var, subset in zip(self.var_names, self.Subsets) if subset != None), None)
+        if not (var_name in self.var_names) or self.Subsets[self.var_names.index(var_name)] == None:
+            raise ValueError("Tiling needs a variable with a subset")
+        if sink != None:
+            if not isinstance(sink, NpySink):
+                raise TypeError("Tiles can only be written into a NpySink")
+            if self.aggregation != None or self.aggregations:
+                raise ValueError("Aggregated tiles have no cells that could be written into a sink")
+        resolution = dict(resolution) if resolution != None else {}
+        subset_axes = parse_subset(self.Subsets[self.var_names.index(var_name)])
+        trimmed = [axis for axis, low, high in subset_axes if high != None]
+        for axis in tiles:
+            if not (axis in trimmed):
+                raise ValueError(f"Axis {axis} isn't trimmed in the subset, so it can't be tiled")
+        tiled_axes = [axis for axis in trimmed if axis in tiles]
+        for axis, low, high in subset_axes:
+            if axis in tiles and resolution.get(axis) == None and not low.startswith('"'):
+                # the resolution of numeric axes comes from the coverage description, if not given
+                metadata = self.DBC.describe_coverage(self.coverage_name(self.vars[self.var_names.index(var_name)]))
+                resolution[axis] = metadata.axis(axis).resolution
+        splits = {axis: split_axis(low, high, tiles[axis], resolution.get(axis))
+                  for axis, low, high in subset_axes if axis in tiles}
+        output_format = self.format
+
+        # one query per tile, with the tiled axes of the subset replaced by the bounds of the tile
+        grid = list(itertools.product(*[range(len(splits[axis])) for axis in tiled_axes]))
+        aggregation = self.aggregation
+        stats = self.aggregations
+        # null cells don't count towards an average, so the tiles of an average also return the number of
+        # cells it was taken over ('CELLS'), and the tile averages are weighted by it
+        tile_stats = None
+        if aggregation == 'AVG':
+            tile_stats = ['AVG', 'CELLS']
+        elif 'AVG' in stats:
+            tile_stats = stats + ['CELLS']
+        queries = []
+        for position in grid:
+            bounds = {axis: splits[axis][i] for axis, i in zip(tiled_axes, position)}
+            tile_axes = [(axis, bounds[axis][0], bounds[axis][1]) if axis in bounds else (axis, low, high)
+                         for axis, low, high in subset_axes]
+            tile = self.fork().subset(format_subset(tile_axes), var_name)
+            if tile_stats != None:
+                # set directly, 'CELLS' is no aggregation stats() accepts
+                tile.aggregation = None
+                tile.aggregations = tile_stats
+            queries.append(tile.to_wcps_query())
+        if sink != None:
+            sink.describe(coverage = [self.coverage_name(var) for var in self.vars], subset = list(self.Subsets),
+                          format = output_format, query = self.to_wcps_query(), tiles = len(queries))
+        self.reset()
+
+        axis_order = axis_order if axis_order != None else trimmed
+        if sink != None:
+            # every tile is written as soon as it arrives, into the region its split gives it
+            shapes = None
+            for index, content in self.fetch_tiles(queries, max_workers, retries, yield_completed = True):
+                array = self.decode_tile(content, output_format, dtype, nodata, len(axis_order))
+                if shapes == None:
+                    # the tiles are as big as their split along the tiled axes, and as the first tile along the others
+                    shapes = []
+                    for position in grid:
+                        tile_shape = list(array.shape)
+                        for axis, i in zip(tiled_axes, position):
+                            if axis in axis_order:
+                                tile_shape[axis_order.index(axis)] = splits[axis][i][2]
+                        shapes.append(tuple(tile_shape))
+                    shape, regions = tile_regions(shapes, grid, tiled_axes, axis_order, descending)
+                    sink.allocate(shape)
+                if array.shape != shapes[index]:
+                    raise ValueError(f"Tile {index} has the shape {array.shape}, "
+                                     f"but its region of the sink has the shape {shapes[index]}")
+                sink.write(array, regions[index])
+            return sink
+
+        results = self.fetch_tiles(queries, max_workers, retries)
+        if tile_stats != None:
+            partials = [parse_stats(content, tile_stats) for content in results]
+            cells = [partial['CELLS'] for partial in partials]
+            combined = {name: combine_aggregates(name, [partial[name] for partial in partials], cells)
+                        for name in tile_stats if name != 'CELLS'}
+            if aggregation != None:
+                return [combined['AVG']]
+            return combined
+        if aggregation != None:
+            # returned as a list of one number, like execute() does
+            return [combine_aggregates(aggregation, [byte_to_list(content)[0] for content in results])]
+        if stats:
+            partials = [parse_stats(content, stats) for content in results]
+            return {name: combine_aggregates(name, [partial[name] for partial in partials]) for name in stats}
+
+        arrays = [self.decode_tile(content, output_format, dtype, nodata, len(axis_order)) for content in results]
+        return stitch_tiles(arrays, grid, tiled_axes, axis_order, descending)
+
+    def decode_tile(self, content, output_format, dtype, nodata, dimensions):
+        
+       # Turns the content of a tile into an array, images are decoded, everything else is CSV.
+
+        if output_format == 'PNG' or output_format == 'JPEG':
+            return decode_image(content)
+        return parse_csv_array(content, dtype, nodata, dimensions)
+
+    def sweep(self, axis, steps, aggregation = 'AVG', condition = None, var_name = None, max_steps = 120,
+              max_workers = None, as_numpy = False):
+        """
+        Computes an aggregation for every step along an axis, e.g. the average of every month of 20
+            years, with a coverage constructor on the server instead of one query per step. Long sweeps
+            are split into queries of at most 'max_steps' steps, which are sent in parallel.
+
+        Parameters:
+            axis (str): The axis to sweep over, e.g. 'ansi'.
+            steps (list): Consecutive slices of the coverage along 'axis', e.g. every month from
+                "2000-01" to "2019-12" of a monthly coverage. Dates don't need to be quoted.
+            aggregation (str): 'MIN', 'MAX', 'AVG', 'SUM' or 'COUNT'.
+            condition (str): The expression to aggregate, the variable itself by default. The subsets
+                of the variables are applied as usual, 'axis' is sliced at every step.
+            var_name (str): The variable that is swept, the first one by default.
+
+        Returns:
+            list: One value per step (a NumPy array with 'as_numpy').
+
+        Example:
+            >>> datacube.subset('Lat(53.08), Long(8.80)', '$c').sweep('ansi', ['2014-01', '2014-02', '2014-03'])
+
+        """
+        if not isinstance(axis, str):
+            raise TypeError("Value entered must be a string.")
+        if not isinstance(steps, (list, tuple)) or len(steps) == 0:
+            raise TypeError("Steps must be given as a list.")
+        if not (aggregation in ['MIN', 'MAX', 'AVG', 'SUM', 'COUNT']):
+            raise ValueError("Entered aggregation doesn't exist")
+        if var_name == None:
+            var_name = self.var_names[0] if self.var_names else None
+        if not (var_name in self.var_names):
+            raise ValueError("Such variable doesn't exist")
+        if condition != None:
+            if not isinstance(condition, str):
+                raise TypeError("Value entered must be a string.")
+            self.do_vars_exist(condition)
+        else:
+            condition = var_name
+        if not isinstance(max_steps, int) or max_steps < 1:
+            raise ValueError("The number of steps per query must be a positive integer")
+        steps = [axis_literal(step) for step in steps]
+        index = self.var_names.index(var_name)
+        # the sweep axis is sliced by the iterator, so it's dropped from the subset of the variable
+        other_axes = [bounds for bounds in parse_subset(self.Subsets[index] or '') if bounds[0] != axis]
+
+        queries = []
+        for start in range(0, len(steps), max_steps):
+            chunk = steps[start:start + max_steps]
+            whole = self.fork()
+            whole.Subsets[index] = format_subset([(axis, chunk[0], chunk[-1])])
+            domain = f'imageCrsDomain({whole.replace_variables_with_subsets(var_name)}, {axis})'
+            step = self.fork()
+            step.Subsets[index] = format_subset(other_axes + [(f'{axis}:"CRS:1"', '$step', None)])
+            values = f'{aggregation.lower()}({step.replace_variables_with_subsets(condition)})'
+            # the constructor is put into the query as it is, its variables were already substituted
+            query = self.fork()
+            query.Subsets = [None] * len(query.Subsets)
+            query.aggregation = None
+            query.aggregations = []
+            query.encode_as = None
+            query.format = 'CSV'
+            query.transformation = f'coverage sweep over $step {axis}({domain}) values {values}'
+            queries.append(query.to_wcps_query())
+        self.reset()
+
+        results = []
+        for start, answer in zip(range(0, len(steps), max_steps), self.DBC.send_many(queries, max_workers)):
+            if isinstance(answer, Exception):
+                raise answer
+            values = byte_to_list(answer.content)
+            if len(values) != len(steps[start:start + max_steps]):
+                raise ValueError(f"Got {len(values)} values for {len(steps[start:start + max_steps])} steps, "
+                                 "the steps must be consecutive slices of the coverage")
+            results.extend(values)
+        if as_numpy:
+            if np == None:
+                raise ImportError("Array results need the 'numpy' package")
+            return np.array(results)
+        return results
+
+    def fetch_tiles(self, queries, max_workers, retries, yield_completed = False):
+        
+       # Sends the tile queries in parallel, returns their contents in order, or with 'yield_completed' a generator of (index, content) as they arrive.
+
+        if yield_completed:
+            return self.iter_tiles(queries, max_workers, retries)
+        results = [None] * len(queries)
+        for index, content in self.iter_tiles(queries, max_workers, retries):
+            results[index] = content
+        return results
+
+    def iter_tiles(self, queries, max_workers, retries):
+        
+       # Yields (index, content) of the tiles as they arrive, the ones that failed with a retryable error are sent again.
+
+        pending = list(range(len(queries)))
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(self.DBC.backoff_factor * 2 ** (attempt - 1))
+            answers = self.DBC.send_many([queries[index] for index in pending], max_workers, yield_completed = True)
+            failed = []
+            for position, answer in answers:
+                if isinstance(answer, Exception):
+                    if not getattr(answer, 'retryable', False) or attempt == retries:
+                        raise answer
+                    failed.append(pending[position])
+                else:
+                    yield pending[position], answer.content
+            pending = failed
+            if not pending:
+                break
+
+    def execute_incremental(self, store, axis = 'ansi', var_name = None, full = False, recent = 1):
+        """
+        Executes a query over a time range, e.g. ansi("2000-01":"2019-12"), but fetches only the
+            slices that 'store' doesn't have yet, plus the 'recent' newest stored ones, which the
+            server may still update. All of them are fetched with one query over the range they span
+            and merged into the stored series. Everything is fetched again with 'full', or when the
+            coverage metadata shows that the stored slices changed (bands, CRS, other axes, or the
+            time slices up to the newest stored one).
+
+        Parameters:
+            store (TimeSeriesStore): Where the fetched slices are kept between calls.
+            axis (str): The time axis, it must be irregular (listed with its coefficients) and be
+                trimmed in the subset of the variable.
+            var_name (str): The variable whose subset holds the time range, the first one by default.
+
+        Returns:
+            dict: {time coordinate: value} for every slice of the range, in time order. A value is a
+                number if the query gives one per slice, else nested lists over the remaining axes.
+
+        Example:
+            >>> store = TimeSeriesStore('series.json')
+            >>> datacube.subset('Lat(53.08), Long(8.80), ansi("2000-01":"2019-12")', '$c').execute_incremental(store)
+
+        """
+        if not isinstance(store, TimeSeriesStore):
+            raise TypeError("TimeSeriesStore instance not passed")
+        if not isinstance(axis, str):
+            raise TypeError("Value entered must be a string.")
+        if not isinstance(recent, int) or recent < 0:
+            raise ValueError("The number of refreshed slices must be a non-negative integer")
+        if var_name == None:
+            var_name = self.var_names[0] if self.var_names else None
+        if not (var_name in self.var_names):
+            raise ValueError("Such variable doesn't exist")
+        if self.aggregation != None or self.aggregations:
+            raise ValueError("Aggregated queries can't be fetched slice by slice")
+        index = self.var_names.index(var_name)
+        bounds = parse_subset(self.Subsets[index] or '')
+        trims = [position for position, (name, _, high) in enumerate(bounds) if name == axis and high != None]
+        if not trims:
+            raise ValueError(f"The subset of {var_name} needs a range on axis {axis}")
+        metadata = self.DBC.describe_coverage(self.coverage_name(self.vars[index]), refresh = True)
+        time_axis = metadata.axis(axis)
+        if not time_axis.coefficients:
+            raise ValueError(f"Axis {axis} of {metadata.name} has no list of time slices")
+        _, low, high = bounds[trims[0]]
+        labels = time_axis.slices(low, high)
+        # the result keeps the axes that aren't sliced, in the order of the coverage
+        sliced = {name.split(':')[0] for name, _, upper in bounds if upper == None}
+        kept = [other.name for other in metadata.axes if not (other.name in sliced)]
+        position = kept.index(time_axis.name)
+
+        def with_range(low, high):
+            query = self.fork()
+            query.Subsets[index] = format_subset(bounds[:trims[0]] + [(axis, low, high)] + bounds[trims[0] + 1:])
+            query.format = 'CSV'
+            return query
+        template = f'{self.DBC.server_url} {normalize_query(with_range("*", "*").to_wcps_query())}'
+        fingerprint, slices = store.get(template)
+        if slices and (full or series_fingerprint(metadata, time_axis, max(slices, key = iso_key)) != fingerprint):
+            slices = {}
+        stored = sorted(slices, key = iso_key)
+        refreshed = set(stored[len(stored) - recent:]) if recent else set()
+        missing = [label for label in labels if not (label in slices) or label in refreshed]
+        if missing:
+            query = with_range(f'"{missing[0]}"', f'"{missing[-1]}"').to_wcps_query()
+        self.reset()
+
+        if missing:
+            fetched = time_axis.slices(missing[0], missing[-1])
+            content = self.DBC.send_query(query).content
+            if len(kept) == 1:
+                values = byte_to_list(content)
+            else:
+                if np == None:
+                    raise ImportError("Time series over several axes need the 'numpy' package")
+                values = np.moveaxis(parse_csv_array(content, ndim = len(kept)), position, 0).tolist()
+            if len(values) != len(fetched):
+                raise ValueError(f"Got {len(values)} slices for the {len(fetched)} time slices "
+                                 f"from {missing[0]} to {missing[-1]}")
+            slices.update(zip(fetched, values))
+            store.put(template, series_fingerprint(metadata, time_axis, max(slices, key = iso_key)), slices)
+        return {label: slices[label] for label in labels if label in slices}
+
+
+class LazyResult:
+    """
+    The result of dco.execute(lazy = True). The query is already on its way, but the response is only
+        waited for, and decoded, when one of the methods is called. Every decoded form is kept, so
+        asking for it again costs nothing. Errors of the query are raised by the methods.
+
+    Example:
+        >>> result = datacube.execute(lazy = True)
+        >>> ... # do something else in the meantime
+        >>> result.to_numpy()
+
+    """
+    def __init__(self, future, output_format, dtype = 'float64', nodata = None, shape = None, stats = None,
+                 layout = None):
+        self.future = future
+        self.output_format = output_format
+        self.dtype = dtype
+        self.nodata = nodata
+        self.shape = shape
+        self.stats = stats
+        self.layout = layout # cell dtype, shape and exact shape (a function) of the RAW result of an 'AUTO' query
+        self.decoded = {} # form -> decoded result
+        self.lock = threading.RLock() # decoders call raw() while holding it
+
+    parse_result = dco.parse_result
+
+    def done(self):
+        return self.future.done()
+
+    def response(self, timeout = None):
+        
+       # Waits for the response of the server and returns it.
+
+        return self.future.result(timeout)
+
+    def decode(self, form, decoder):
+        with self.lock:
+            if form not in self.decoded:
+                self.decoded[form] = decoder()
+            return self.decoded[form]
+
+    def raw(self):
+        
+       # The body of the response as a memoryview, without copying it.
+
+        return self.decode('raw', lambda: memoryview(self.response().content))
+
+    def to_list(self):
+        
+       # The numbers of a CSV or RAW result as a list (a dict for stats() queries), like execute() returns them.
+
+        if self.output_format not in (None, 'CSV', 'RAW') and not self.stats:
+            raise ValueError(f"A {self.output_format} result can't be converted to a list, use raw(), to_numpy() or image()")
+        return self.decode('list', self.decode_list)
+
+    def decode_list(self):
+        result = self.parse_result(self.raw(), self.output_format, False, self.dtype, self.nodata, self.shape,
+                                   self.stats, self.layout)
+        # the cells of a RAW result come as a memoryview on top of the response
+        return result.tolist() if isinstance(result, memoryview) else result
+
+    def to_numpy(self):
+        
+       # The result as a NumPy array, like execute(as_numpy = True) returns it (images are decoded as well).
+
+        if self.output_format in ('PNG', 'JPEG'):
+            return self.image()
+        return self.decode('numpy', lambda: self.parse_result(self.raw(), self.output_format, True, self.dtype,
+                                                              self.nodata, self.shape, self.stats, self.layout))
+
+    def iter(self, chunk_size = 65536):
+        
+       # Yields the numbers of a CSV result one by one, parsing 'chunk_size' bytes at a time instead of the whole body.
+
+        if self.stats:
+            yield from self.to_list().values()
+            return
+        if 'list' in self.decoded or self.output_format not in (None, 'CSV'):
+            yield from self.to_list()
+            return
+        content = self.raw()
+        yield from iter_csv_values(bytes(content[start:start + chunk_size]) for start in range(0, len(content), chunk_size))
+
+    def image(self):
+        
+       # The pixels of a PNG or JPEG result as an array, see decode_image.
+
+        if self.output_format not in ('PNG', 'JPEG'):
+            raise ValueError(f"A {self.output_format} result is not an image")
+        return self.decode('image', lambda: decode_image(self.raw()))
+
+
+# compiled, parameterized query
+class PreparedQuery:
+    """
+    A WCPS query template made by dco.prepare(). The template is split at its '${name}' placeholders
+        once, binding values only joins the pieces. PreparedQuery instances are never changed:
+        fork() returns a new one with some of the placeholders already bound.
+
+    """
+    PLACEHOLDER = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}')
+
+    def __init__(self, dbc_being_used, template, output_format = None, values = None, stats = None):
+        if not isinstance(dbc_being_used, dbc):
+            raise TypeError("dbc instance not passed")
+        if not isinstance(template, str):
+            raise TypeError("Value entered must be a string.")
+        self.DBC = dbc_being_used
+        self.template = template
+        self.format = output_format
+        self.stats = list(stats) if stats else None # the aggregations of a stats() query, its result becomes a dict
+        # the literal pieces of the template, with the placeholder names between them
+        pieces = self.PLACEHOLDER.split(template)
+        self.literals = pieces[0::2]
+        self.names = pieces[1::2]
+        self.placeholders = frozenset(self.names)
+        self.values = {}
+        if values != None:
+            self.values = self.check_values(values)
+
+    def check_values(self, values):
+        unknown = set(values) - self.placeholders
+        if unknown:
+            raise ValueError(f"The query has no placeholders {sorted(unknown)}")
+        return {name: str(value) for name, value in values.items()}
+
+    def bind(self, values = None, **kwargs):
+        
+       # Returns the WCPS query with all placeholders replaced by the given values (and the ones bound by fork()).
+
+        bound = dict(self.values)
+        if values != None:
+            bound.update(self.check_values(values))
+        if kwargs:
+            bound.update(self.check_values(kwargs))
+        missing = self.placeholders - set(bound)
+        if missing:
+            raise ValueError(f"No values for the placeholders {sorted(missing)}")
+        pieces = [self.literals[0]]
+        for name, literal in zip(self.names, self.literals[1:]):
+            pieces.append(bound[name])
+            pieces.append(literal)
+        return ''.join(pieces)
+
+    def fork(self, values = None, **kwargs):
+        
+       # Returns a new PreparedQuery sharing the compiled template, with some more placeholders bound.
+
+        forked = PreparedQuery.__new__(PreparedQuery)
+        forked.__dict__.update(self.__dict__)
+        forked.values = dict(self.values)
+        if values != None:
+            forked.values.update(self.check_values(values))
+        if kwargs:
+            forked.values.update(self.check_values(kwargs))
+        return forked
+
+    def execute(self, values = None, as_numpy = False, dtype = 'float64', nodata = None, shape = None, refresh = False):
+        
+       # Binds the values and executes the query, returning the same value as dco.execute() would.
+
+        response = self.DBC.send_query(self.bind(values), refresh = refresh)
+        return self.parse_result(response.content, self.format, as_numpy, dtype, nodata, shape, self.stats)
+
+    def execute_many(self, list_of_values, max_workers = None, yield_completed = False):
+        
+       # Executes the query once for every dict of values, the same way as dbc.execute_many.
+
+        tasks = [(self.DBC.send_and_parse, (self.bind(values), self, self.format, self.stats)) for values in list_of_values]
+        return self.DBC.run_batch(tasks, max_workers, yield_completed)
+
+    parse_result = dco.parse_result
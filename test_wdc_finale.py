@@ -1,6 +1,19 @@
-from wdc import dco, dbc
+from wdc import dco, dbc, AsyncDbc, ConnectionFailed, QueryError, iter_csv_values, parse_csv_array, decode_raw, \
+    ResultCache, DiskCache, WCPSResponse, normalize_query, PreparedQuery, \
+    parse_subset, split_axis, stitch_tiles, parse_stats, axis_literal, \
+    CoverageMetadata, parse_wcps, QueryMetrics, MetricsSummary, ServerError, ImageDecoder, decode_image, \
+    TimeSeriesStore, NpySink, ArrowSink, open_result, CsvParser
+from wdc_bench import StandInServer, make_payload, run, compare
+from wdc_run import main as run_queries, read_jobs, run_job
+import array
+import asyncio
+import gc
+import io
+import json
 import pytest
+import sys
 import warnings
+import wdc
 warnings.filterwarnings("ignore")
 
 # this tests initialization of dbc() instance
@@ -35,6 +48,31 @@ class Test_send_query():
         with pytest.raises(TypeError):
             my_dbc.send_query(1)
 
+    # a wrong query is reported as a non-retryable QueryError, which is still a ValueError
+    def test_send_wrong_query_error_type(self):
+        my_dbc = dbc("https://ows.rasdaman.org/rasdaman/ows")
+        with pytest.raises(QueryError) as error:
+            my_dbc.send_query("for $c in")
+        assert isinstance(error.value, ValueError) and not error.value.retryable
+
+    # an unreachable server is reported as a retryable ConnectionFailed
+    def test_send_unreachable(self):
+        my_dbc = dbc("http://127.0.0.1:9/rasdaman/ows", retries = 0, timeout = (0.5, 0.5))
+        with pytest.raises(ConnectionFailed) as error:
+            my_dbc.send_query('for $c in (AvgLandTemp) return 1')
+        assert error.value.retryable
+
+    # the connections of the dbc are pooled and reused between queries
+    def test_pool_size(self):
+        my_dbc = dbc("https://ows.rasdaman.org/rasdaman/ows", pool_size = 4)
+        adapter = my_dbc.session.get_adapter("https://ows.rasdaman.org")
+        assert adapter._pool_maxsize == 4
+
+    # pool size must be a positive integer
+    def test_wrong_pool_size(self):
+        with pytest.raises(ValueError):
+            dbc("https://ows.rasdaman.org/rasdaman/ows", pool_size = 0)
+
 # this tests initialization of dco() instance
 class Test_init_dco():
     # init by not passing a dbc() instance
@@ -128,6 +166,13 @@ class Test_set_format():
         my_dco = create_good_dco()
         assert isinstance(my_dco.set_format('JPEG'), dco)
 
+    # pass an existing binary format
+    def test_correct_format_binary(self):
+        my_dco = create_good_dco()
+        assert my_dco.set_format('RAW').return_format() == "application/octet-stream"
+        assert my_dco.set_format('GEOTIFF').return_format() == "image/tiff"
+        assert my_dco.set_format('NETCDF').return_format() == "application/netcdf"
+
     # pass nothing
     def test_pass_nothing(self):
         my_dco = create_good_dco()
@@ -170,3 +215,1011 @@ class Test_where():
         my_dco = create_good_dco()
         with pytest.raises(TypeError):
             my_dco.where(2)
+
+
+# this tests the asyncio client
+class Test_async():
+    # an AsyncDbc can be used everywhere a dbc can
+    def test_init_async_dbc(self):
+        pytest.importorskip("aiohttp")
+        my_dco = dco(AsyncDbc("https://ows.rasdaman.org/rasdaman/ows"))
+        assert isinstance(my_dco.DBC, dbc)
+
+    # the settings of a dbc reach the AsyncDbc as well
+    def test_async_dbc_settings(self):
+        pytest.importorskip("aiohttp")
+        my_dbc = AsyncDbc("https://ows.rasdaman.org/rasdaman/ows", validate = True, metadata_ttl = 60,
+                          health_query = 'for $c in (AvgLandTemp) return 1', compress = False)
+        assert my_dbc.validate and my_dbc.metadata_ttl == 60 and not my_dbc.compress
+        assert my_dbc.health_query == 'for $c in (AvgLandTemp) return 1'
+
+    # aexecute() returns the same value as execute()
+    def test_aexecute(self):
+        pytest.importorskip("aiohttp")
+        async def run():
+            async with AsyncDbc("https://ows.rasdaman.org/rasdaman/ows") as my_dbc:
+                return await dco(my_dbc).initialize_var("$c in (AvgLandTemp)").avg(
+                    '$c[Lat(53.08), Long(8.80), ansi("2014-07")]').aexecute()
+        assert isinstance(asyncio.run(run())[0], float)
+
+    # aexecute() accepts the array options of execute(), here with a stand-in for the server
+    def test_aexecute_as_numpy(self):
+        pytest.importorskip("numpy")
+        class Response: # what send_query would return
+            content = b'{1,2},{3,4}'
+        my_dbc = dbc("https://ows.rasdaman.org/rasdaman/ows")
+        my_dbc.send_query = lambda wcps_query, **kwargs: Response()
+        my_dco = dco(my_dbc).initialize_var("$c in (AvgLandTemp)").subset('Lat(53.08), Long(8.80)', '$c').set_format('CSV')
+        assert asyncio.run(my_dco.aexecute(as_numpy = True)).shape == (2, 2)
+
+    # with 'validate' aexecute() checks the subset before sending, like execute()
+    def test_aexecute_validates(self):
+        with StandInServer(b'1') as server:
+            my_dbc = dbc(server.url, validate = True)
+            my_dbc.metadata['AvgLandTemp'] = (float('inf'), CoverageMetadata.from_xml('AvgLandTemp', AVG_LAND_TEMP))
+            my_dco = dco(my_dbc).initialize_var("$c in (AvgLandTemp)").subset('Lat(100), Long(0)', '$c')
+            with pytest.raises(ValueError):
+                asyncio.run(my_dco.aexecute())
+            assert server.queries == 0
+
+    # gather() keeps the input order and can return errors instead of raising them
+    def test_gather(self):
+        pytest.importorskip("aiohttp")
+        async def run():
+            async with AsyncDbc("https://ows.rasdaman.org/rasdaman/ows") as my_dbc:
+                return await my_dbc.gather(['for $c in (AvgLandTemp) return 1', 'for $c in'],
+                                           limit = 2, return_exceptions = True)
+        results = asyncio.run(run())
+        assert results[0].content == b'1' and isinstance(results[1], QueryError)
+
+
+# this tests batch execution
+class Test_batch():
+    # results come back in input order, a failing query doesn't fail the batch
+    def test_send_many(self):
+        my_dbc = dbc("https://ows.rasdaman.org/rasdaman/ows")
+        results = my_dbc.send_many(['for $c in (AvgLandTemp) return 1', 'for $c in'], max_workers = 2)
+        assert results[0].content == b'1' and isinstance(results[1], QueryError)
+
+    # dco instances and raw strings can be mixed
+    def test_execute_many(self):
+        my_dbc = dbc("https://ows.rasdaman.org/rasdaman/ows")
+        my_dco = dco(my_dbc).initialize_var("$c in (AvgLandTemp)").avg('$c[Lat(53.08), Long(8.80), ansi("2014-07")]')
+        results = my_dbc.execute_many([my_dco, 'for $c in (AvgLandTemp) return 1'])
+        assert isinstance(results[0][0], float) and results[1].content == b'1'
+
+    # with yield_completed every query is yielded once, with its index
+    def test_yield_completed(self):
+        my_dbc = dbc("https://ows.rasdaman.org/rasdaman/ows")
+        results = dict(my_dbc.send_many(['for $c in (AvgLandTemp) return 1'] * 3, yield_completed = True))
+        assert sorted(results) == [0, 1, 2]
+
+    # only dco instances and strings can be executed
+    def test_execute_many_wrong_type(self):
+        my_dbc = dbc("https://ows.rasdaman.org/rasdaman/ows")
+        with pytest.raises(TypeError):
+            my_dbc.execute_many([1])
+
+    # a bad item doesn't reset the dco instances before it
+    def test_execute_many_keeps_state(self):
+        my_dbc = dbc("https://ows.rasdaman.org/rasdaman/ows")
+        my_dco = dco(my_dbc).initialize_var("$c in (AvgLandTemp)").avg('$c')
+        with pytest.raises(TypeError):
+            my_dbc.execute_many([my_dco, 1])
+        assert my_dco.vars == ["$c in (AvgLandTemp)"] and my_dco.aggregation == 'AVG'
+
+
+# this tests the streaming CSV parser
+class Test_iter_csv_values():
+    # numbers split between two chunks are put back together
+    def test_split_numbers(self):
+        assert list(iter_csv_values([b'1.', b'5,2', b'0,-3e', b'2'])) == [1.5, 20.0, -300.0]
+
+    # braces of nested CSV output are skipped
+    def test_nested(self):
+        assert list(iter_csv_values([b'{1,2},', b'{3,4}'])) == [1.0, 2.0, 3.0, 4.0]
+
+    # values can be yielded in blocks of a fixed size
+    def test_blocks(self):
+        assert list(iter_csv_values([b'1,2,3', b',4,5'], block_size = 2)) == [[1.0, 2.0], [3.0, 4.0], [5.0]]
+
+    # execute() can stream the result
+    def test_execute_stream(self):
+        my_dco = create_good_dco().subset('Lat(53.08), Long(8.80), ansi("2014-01":"2014-12")', '$c').set_format('CSV')
+        assert len(list(my_dco.execute(stream = True, chunk_size = 4))) == 12
+
+    # binary results are streamed as bytes, stats() results can't be streamed
+    def test_execute_stream_binary(self):
+        with StandInServer(make_payload('raw', 10)) as server:
+            my_dco = dco(dbc(server.url)).initialize_var("$c in (AvgLandTemp)").subset('Lat(0:9)', '$c')
+            assert b''.join(my_dco.fork().set_format('RAW').execute(stream = True, chunk_size = 7)) == make_payload('raw', 10)
+            with pytest.raises(ValueError):
+                my_dco.stats(['MIN', 'MAX']).execute(stream = True)
+
+
+# this tests the NumPy result decoding
+class Test_parse_csv_array():
+    # flat CSV becomes a 1-D array
+    def test_flat(self):
+        np = pytest.importorskip("numpy")
+        assert parse_csv_array(b'1,2,3').tolist() == [1.0, 2.0, 3.0]
+
+    # nested CSV keeps the shape of the coverage
+    def test_nested(self):
+        pytest.importorskip("numpy")
+        assert parse_csv_array(b'{1,2},{3,4},{5,6}').shape == (3, 2)
+        assert parse_csv_array(b'{{1,2},{3,4}},{{5,6},{7,8}}').shape == (2, 2, 2)
+
+    # nodata sentinels become NaN, or are masked for integer arrays
+    def test_nodata(self):
+        np = pytest.importorskip("numpy")
+        assert np.isnan(parse_csv_array(b'{1,99999},{3,4}', nodata = 99999)[0, 1])
+        assert parse_csv_array(b'1,99999', dtype = 'int32', nodata = 99999).mask.tolist() == [False, True]
+
+    # execute() returns an array when asked for one
+    def test_execute_as_numpy(self):
+        np = pytest.importorskip("numpy")
+        my_dco = create_good_dco().subset('Lat(53.08), Long(8.80), ansi("2014-01":"2014-12")', '$c').set_format('CSV')
+        assert isinstance(my_dco.execute(as_numpy = True), np.ndarray)
+
+    # rows of different length can't be turned into an array
+    def test_ragged(self):
+        pytest.importorskip("numpy")
+        with pytest.raises(ValueError):
+            parse_csv_array(b'{1,2,3},{4},{5,6}')
+        with pytest.raises(ValueError):
+            parse_csv_array(b'{{1,2},{3,4},{5,6}},{{7,8}}')
+
+
+# this tests decoding of 'RAW' results
+class Test_decode_raw():
+    # little-endian cells are wrapped without a copy
+    def test_numpy(self):
+        np = pytest.importorskip("numpy")
+        content = np.arange(6, dtype = '<f4').tobytes()
+        values = decode_raw(content, 'float32', (2, 3))
+        assert values.shape == (2, 3) and values[1, 2] == 5.0 and not values.flags.owndata
+
+    # without numpy a memoryview is returned
+    def test_memoryview(self):
+        content = b'\x01\x00\x02\x00'
+        assert decode_raw(content, 'int16', as_numpy = False).tolist() == [1, 2]
+
+
+# this tests the in-memory result cache
+class Test_result_cache():
+    # whitespace only matters inside string literals
+    def test_normalize_query(self):
+        assert normalize_query('for $c in (AvgLandTemp)\n  return  "a  b"') == 'for $c in (AvgLandTemp) return "a  b"'
+
+    # the least recently used responses are evicted first
+    def test_lru(self):
+        cache = ResultCache(max_bytes = 4)
+        cache.put('a', WCPSResponse(200, b'12'))
+        cache.put('b', WCPSResponse(200, b'34'))
+        cache.get('a')
+        cache.put('c', WCPSResponse(200, b'56'))
+        assert cache.get('b') == None and cache.get('a').content == b'12'
+        assert cache.stats()['evictions'] == 1
+
+    # expired responses are not returned
+    def test_ttl(self):
+        cache = ResultCache(ttl = -1)
+        cache.put('a', WCPSResponse(200, b'1'))
+        assert cache.get('a') == None and cache.stats()['misses'] == 1
+
+    # repeated queries are answered from the cache, unless a refresh is asked for
+    def test_dbc_cache(self):
+        my_dbc = dbc("https://ows.rasdaman.org/rasdaman/ows", cache = ResultCache())
+        my_dbc.send_query('for $c in (AvgLandTemp) return 1')
+        my_dbc.send_query('for $c in (AvgLandTemp)\nreturn 1')
+        my_dbc.send_query('for $c in (AvgLandTemp) return 1', refresh = True)
+        assert my_dbc.cache.stats()['hits'] == 1
+
+
+# this tests the on-disk result cache
+class Test_disk_cache():
+    # a stored response is read back through mmap, also by another cache on the same directory
+    def test_put_get(self, tmp_path):
+        DiskCache(str(tmp_path)).put(('url', 'query'), WCPSResponse(200, b'1,2', {'Content-Type': 'text/csv'}))
+        response = DiskCache(str(tmp_path)).get(('url', 'query'))
+        assert response.content[:] == b'1,2' and response.headers['Content-Type'] == 'text/csv'
+
+    # identical results are only stored once
+    def test_content_addressed(self, tmp_path):
+        cache = DiskCache(str(tmp_path))
+        cache.put(('url', 'a'), WCPSResponse(200, b'1,2'))
+        cache.put(('url', 'b'), WCPSResponse(200, b'1,2'))
+        assert len(list((tmp_path / 'objects').iterdir())) == 1 and cache.stats()['entries'] == 2
+
+    # responses beyond the size limit are evicted
+    def test_eviction(self, tmp_path):
+        cache = DiskCache(str(tmp_path), max_bytes = 4)
+        cache.put(('url', 'a'), WCPSResponse(200, b'123'))
+        cache.put(('url', 'b'), WCPSResponse(200, b'456'))
+        assert cache.stats()['bytes'] <= 4 and cache.stats()['evictions'] == 1
+
+    # expired responses are not returned
+    def test_ttl(self, tmp_path):
+        cache = DiskCache(str(tmp_path), ttl = -1)
+        cache.put(('url', 'a'), WCPSResponse(200, b'1'))
+        assert cache.get(('url', 'a')) == None
+
+    # the object of a replaced entry is dropped before live entries are evicted
+    def test_replaced_entry(self, tmp_path):
+        cache = DiskCache(str(tmp_path), max_bytes = 100)
+        cache.put(('url', 'a'), WCPSResponse(200, b'x' * 40))
+        cache.put(('url', 'a'), WCPSResponse(200, b'y' * 40))
+        cache.put(('url', 'b'), WCPSResponse(200, b'z' * 40))
+        assert cache.get(('url', 'a')).content[:] == b'y' * 40 and cache.get(('url', 'b')) != None
+        assert len(list((tmp_path / 'objects').iterdir())) == 2 and cache.stats()['bytes'] == 80
+        assert cache.stats()['evictions'] == 0
+
+
+# this tests prepared queries
+class Test_prepare():
+    # placeholders in subsets and conditions get their values on binding
+    def test_bind(self):
+        my_dco = create_good_dco().subset('Lat(${lat}), Long(8.80)', '$c').where('$c > ${t}').avg('$c')
+        query = my_dco.prepare()
+        assert isinstance(query, PreparedQuery) and query.placeholders == {'lat', 't'}
+        assert 'Lat(53.08)' in query.bind(lat = 53.08, t = 2) and '$c > 2' in query.bind(lat = 1, t = 2)
+
+    # every placeholder needs a value, and only existing placeholders can get one
+    def test_bind_wrong_values(self):
+        query = create_good_dco().subset('Lat(${lat})', '$c').prepare()
+        with pytest.raises(ValueError):
+            query.bind()
+        with pytest.raises(ValueError):
+            query.bind(lat = 1, long = 2)
+
+    # forks keep the values bound so far, without changing the base query
+    def test_fork(self):
+        query = create_good_dco().subset('Lat(${lat}), Long(${long})', '$c').prepare()
+        fork = query.fork(lat = 1)
+        assert 'Lat(1), Long(2)' in fork.bind(long = 2) and query.values == {}
+
+    # a prepared stats() query returns the same dict as execute()
+    def test_stats(self):
+        with StandInServer(b'{1 2}') as server:
+            my_dco = dco(dbc(server.url)).initialize_var("$c in (AvgLandTemp)").subset('Lat(${lat})', '$c')
+            query = my_dco.stats(['MIN', 'MAX'], '$c').prepare()
+            assert query.execute({'lat': 1}) == {'MIN': 1.0, 'MAX': 2.0}
+            assert query.execute_many([{'lat': 1}, {'lat': 2}]) == [{'MIN': 1.0, 'MAX': 2.0}] * 2
+
+    # a variable is not replaced inside a longer variable name
+    def test_similar_var_names(self):
+        my_dco = create_good_dco().initialize_var("$cc in (AvgLandTemp)").subset('ansi("2014-07")', '$c')
+        assert my_dco.replace_variables_with_subsets('$c + $cc') == '$c[ansi("2014-07")] + $cc'
+
+    # a forked dco isn't reset by executing the base
+    def test_dco_fork(self):
+        my_dco = create_good_dco()
+        fork = my_dco.fork().set_format('CSV')
+        assert my_dco.format == None and fork.var_names == ['$c']
+
+
+# this tests tiled execution
+class Test_tiling():
+    # subsets are split into their axes
+    def test_parse_subset(self):
+        assert parse_subset('Lat(53.08), Long(0:10), ansi("2014-01":"2014-12")') == [
+            ('Lat', '53.08', None), ('Long', '0', '10'), ('ansi', '"2014-01"', '"2014-12"')]
+
+    # dates are tiled in their own unit, numbers need a resolution so tiles don't overlap
+    def test_split_axis(self):
+        assert split_axis('"2013-11"', '"2014-06"', 6) == [('"2013-11"', '"2014-04"', 6), ('"2014-05"', '"2014-06"', 2)]
+        assert split_axis('0', '10', 4, resolution = 1) == [('0', '3', 4), ('4', '7', 4), ('8', '10', 3)]
+        with pytest.raises(ValueError):
+            split_axis('0', '10', 4)
+
+    # tiles are put back in their place
+    def test_stitch_tiles(self):
+        np = pytest.importorskip("numpy")
+        whole = np.arange(20).reshape(4, 5)
+        arrays = [whole[:2, :3], whole[:2, 3:], whole[2:, :3], whole[2:, 3:]]
+        grid = [(0, 0), (0, 1), (1, 0), (1, 1)]
+        assert (stitch_tiles(arrays, grid, ['Lat', 'Long'], ['Lat', 'Long']) == whole).all()
+
+    # a tiled average is the same as the untiled one
+    def test_execute_tiled_avg(self):
+        my_dco = create_good_dco().subset('Lat(50:55), Long(8.80), ansi("2014-01")', '$c').avg('$c')
+        tiled = my_dco.fork().execute_tiled({'Lat': 2}, resolution = {'Lat': 0.5})
+        assert tiled[0] == pytest.approx(my_dco.execute()[0])
+
+    # null cells don't count, the tile averages are weighted by the cells they were taken over
+    def test_execute_tiled_avg_nulls(self):
+        # both tiles have 4 cells, but only 2 of the first one aren't null: (2 * 3 + 4 * 6) / 6
+        def create_dco(server):
+            my_dco = dco(dbc(server.url)).initialize_var("$c in (AvgLandTemp)")
+            return my_dco.subset('Lat(0:3), Long(0:1)', '$c')
+        with StandInServer(b'{0 0}', answers = {'Lat(0:1)': b'{3 2}', 'Lat(2:3)': b'{6 4}'}) as server:
+            my_dco = create_dco(server)
+            with my_dco.DBC.collect() as metrics:
+                tiled = my_dco.avg().execute_tiled({'Lat': 2}, resolution = {'Lat': 1})
+            assert tiled == [pytest.approx(5)]
+            assert all('cells_value: count(($c[Lat(' in record.query and 'count($c' not in record.query for record in metrics)
+        # stats() tiles return the cell count next to the other aggregations
+        with StandInServer(b'{0 0 0}', answers = {'Lat(0:1)': b'{4 3 2}', 'Lat(2:3)': b'{8 6 4}'}) as server:
+            stats = create_dco(server).stats(['MAX', 'AVG']).execute_tiled({'Lat': 2}, resolution = {'Lat': 1})
+            assert stats == {'MAX': 8, 'AVG': pytest.approx(5)}
+
+
+# this tests several aggregations in one query
+class Test_stats():
+    # all aggregations end up in one composite value
+    def test_query(self):
+        query = create_good_dco().stats(['MIN', 'MAX', 'AVG'], '$c').to_wcps_query()
+        assert query.endswith('{min_value: min($c); max_value: max($c); avg_value: avg($c)}')
+
+    # only existing aggregations, each one once
+    def test_wrong_aggregations(self):
+        with pytest.raises(ValueError):
+            create_good_dco().stats(['MIN', 'MEDIAN'])
+        with pytest.raises(ValueError):
+            create_good_dco().stats(['MIN', 'MIN'])
+        with pytest.raises(TypeError):
+            create_good_dco().stats('MIN')
+
+    # the composite result becomes a dict
+    def test_parse_stats(self):
+        assert parse_stats(b'{-1.5 2e1 7}', ['MIN', 'MAX', 'COUNT']) == {'MIN': -1.5, 'MAX': 20.0, 'COUNT': 7.0}
+        with pytest.raises(ValueError):
+            parse_stats(b'{1 2}', ['MIN', 'MAX', 'COUNT'])
+
+    # a single aggregation replaces the stats
+    def test_single_aggregation_after_stats(self):
+        my_dco = create_good_dco().stats(['MIN', 'MAX']).avg('$c')
+        assert my_dco.aggregations == [] and my_dco.to_wcps_query().endswith('avg($c)')
+
+
+# this tests sweeps over an axis
+class Test_sweep():
+    # dates are quoted, numbers aren't
+    def test_axis_literal(self):
+        assert axis_literal('2014-07') == '"2014-07"' and axis_literal('"2014-07"') == '"2014-07"'
+        assert axis_literal(53.08) == '53.08' and axis_literal('8') == '8'
+
+    # one value per step
+    def test_sweep(self):
+        my_dco = create_good_dco().subset('Lat(53.08), Long(8.80)', '$c')
+        values = my_dco.sweep('ansi', ['2014-01', '2014-02', '2014-03'], max_steps = 2)
+        assert len(values) == 3
+
+    # wrong arguments are caught before anything is sent
+    def test_wrong_arguments(self):
+        with pytest.raises(TypeError):
+            create_good_dco().sweep('ansi', '2014-01')
+        with pytest.raises(ValueError):
+            create_good_dco().sweep('ansi', ['2014-01'], aggregation = 'MEDIAN')
+        with pytest.raises(ValueError):
+            create_good_dco().sweep('ansi', ['2014-01'], var_name = '$t')
+
+
+# a shortened DescribeCoverage response of AvgLandTemp
+AVG_LAND_TEMP = b'''<wcs:CoverageDescriptions xmlns:wcs="http://www.opengis.net/wcs/2.0" xmlns:gml="http://www.opengis.net/gml/3.2"
+    xmlns:swe="http://www.opengis.net/swe/2.0" xmlns:gmlrgrid="http://www.opengis.net/gml/3.3/rgrid">
+  <wcs:CoverageDescription>
+    <gml:boundedBy><gml:Envelope srsName="crs" axisLabels="Lat Long ansi" srsDimension="3">
+      <gml:lowerCorner>-90 -180 "2000-02-01T00:00:00.000Z"</gml:lowerCorner>
+      <gml:upperCorner>90 180 "2000-04-01T00:00:00.000Z"</gml:upperCorner>
+    </gml:Envelope></gml:boundedBy>
+    <gml:domainSet><gmlrgrid:ReferenceableGridByVectors>
+      <gml:limits><gml:GridEnvelope><gml:low>0 0 0</gml:low><gml:high>1799 3599 2</gml:high></gml:GridEnvelope></gml:limits>
+      <gmlrgrid:generalGridAxis><gmlrgrid:GeneralGridAxis><gmlrgrid:offsetVector>-0.1 0 0</gmlrgrid:offsetVector>
+        <gmlrgrid:gridAxesSpanned>Lat</gmlrgrid:gridAxesSpanned></gmlrgrid:GeneralGridAxis></gmlrgrid:generalGridAxis>
+      <gmlrgrid:generalGridAxis><gmlrgrid:GeneralGridAxis><gmlrgrid:offsetVector>0 0.1 0</gmlrgrid:offsetVector>
+        <gmlrgrid:gridAxesSpanned>Long</gmlrgrid:gridAxesSpanned></gmlrgrid:GeneralGridAxis></gmlrgrid:generalGridAxis>
+      <gmlrgrid:generalGridAxis><gmlrgrid:GeneralGridAxis><gmlrgrid:offsetVector>0 0 1</gmlrgrid:offsetVector>
+        <gmlrgrid:coefficients>"2000-02-01T00:00:00.000Z" "2000-03-01T00:00:00.000Z" "2000-04-01T00:00:00.000Z"</gmlrgrid:coefficients>
+        <gmlrgrid:gridAxesSpanned>ansi</gmlrgrid:gridAxesSpanned></gmlrgrid:GeneralGridAxis></gmlrgrid:generalGridAxis>
+    </gmlrgrid:ReferenceableGridByVectors></gml:domainSet>
+    <swe:DataRecord><swe:field name="Gray"><swe:Quantity definition="http://www.opengis.net/def/dataType/OGC/0/float32">
+      <swe:nilValue>99999</swe:nilValue></swe:Quantity></swe:field></swe:DataRecord>
+  </wcs:CoverageDescription>
+</wcs:CoverageDescriptions>'''
+
+# a dco whose dbc already knows the description of AvgLandTemp
+def create_described_dco():
+    my_dco = create_good_dco()
+    my_dco.DBC.metadata['AvgLandTemp'] = (float('inf'), CoverageMetadata.from_xml('AvgLandTemp', AVG_LAND_TEMP))
+    return my_dco
+
+# this tests the coverage metadata
+class Test_metadata():
+    # axes, resolutions and bands are read from DescribeCoverage
+    def test_from_xml(self):
+        metadata = CoverageMetadata.from_xml('AvgLandTemp', AVG_LAND_TEMP)
+        assert [axis.name for axis in metadata.axes] == ['Lat', 'Long', 'ansi']
+        assert metadata.axis('Lat').resolution == -0.1 and metadata.axis('ansi').size == 3
+        assert metadata.bands == [('Gray', 'float32', [99999.0])]
+
+    # subsets inside the coverage are fine
+    def test_validate(self):
+        my_dco = create_described_dco().subset('Lat(50:60), Long(8.80), ansi("2000-02":"2000-03")', '$c')
+        assert my_dco.validate() is my_dco
+
+    # subsets outside the coverage, or on axes it doesn't have, are caught
+    def test_validate_wrong_subset(self):
+        with pytest.raises(ValueError):
+            create_described_dco().subset('Lat(500:600)', '$c').validate()
+        with pytest.raises(ValueError):
+            create_described_dco().subset('Height(1)', '$c').validate()
+        with pytest.raises(ValueError):
+            create_described_dco().subset('ansi("1999-01")', '$c').validate()
+
+    # the size of a result is known before sending the query
+    def test_estimate(self):
+        my_dco = create_described_dco().subset('Lat(50:60), Long(8.80), ansi("2000-02":"2000-04")', '$c')
+        assert my_dco.estimate() == {'cells': 303, 'bytes': 1212}
+
+    # unknown coverages are reported
+    def test_unknown_coverage(self):
+        my_dco = dco(dbc("https://ows.rasdaman.org/rasdaman/ows")).initialize_var("$c in (NoSuchCoverage)")
+        with pytest.raises(ValueError):
+            my_dco.validate()
+
+
+# this tests the WCPS parser
+class Test_parse_wcps():
+    # variables are found in one pass, placeholders and strings are skipped
+    def test_variables(self):
+        assert parse_wcps('avg($c[Lat(${lat})]) + $cc * "$d"').variables == ['$c', '$cc']
+
+    # unbalanced and mismatched brackets are caught
+    def test_brackets(self):
+        with pytest.raises(ValueError):
+            parse_wcps('avg($c')
+        with pytest.raises(ValueError):
+            parse_wcps('avg($c]')
+        with pytest.raises(ValueError):
+            parse_wcps('$c)')
+
+    # unknown functions are only caught in strict mode, axis names in subsets and iterators are not functions
+    def test_functions(self):
+        with pytest.raises(ValueError):
+            parse_wcps('average($c)', strict = True)
+        assert parse_wcps('average($c)')
+        query = 'coverage x over $p ansi(imageCrsDomain($c, ansi)) values avg($c[ansi:"CRS:1"($p)])'
+        assert parse_wcps(query, strict = True)
+
+    # functions the allowlist may not know don't stop a query
+    def test_clip_polygon(self):
+        assert parse_wcps('clip($c, POLYGON((0 0, 1 1))) > 0', strict = True).variables == ['$c']
+        assert parse_wcps('log10($c) + arctan2($c, $d)', strict = True).variables == ['$c', '$c', '$d']
+        my_dco = create_good_dco().where('clip($c, POLYGON((0 0, 1 1))) > 0')
+        assert 'clip($c, POLYGON((0 0, 1 1))) > 0' in my_dco.to_wcps_query()
+
+    # with the 'strict_functions' setting of the dbc, validation rejects unknown functions
+    def test_strict_functions(self):
+        with StandInServer(b'1') as server:
+            my_dbc = dbc(server.url, validate = True, strict_functions = True)
+            my_dbc.metadata['AvgLandTemp'] = (float('inf'), CoverageMetadata.from_xml('AvgLandTemp', AVG_LAND_TEMP))
+            def create_dco():
+                return dco(my_dbc).initialize_var("$c in (AvgLandTemp)").subset('Lat(50), Long(0)', '$c')
+            with pytest.raises(ValueError):
+                create_dco().where('average($c) > 0').execute()
+            assert server.queries == 0
+            assert create_dco().where('clip($c, POLYGON((0 0, 1 1))) > 0').execute() == [1.0]
+
+    # where() reports syntax errors before anything is sent
+    def test_where_syntax_error(self):
+        with pytest.raises(ValueError):
+            create_good_dco().where('$c > "2')
+
+    # variables get their subset, also several times in one expression
+    def test_substitute(self):
+        assert parse_wcps('$c + abs($c)').substitute({'$c': 'Lat(1)'}) == '$c[Lat(1)] + abs($c[Lat(1)])'
+
+
+# this tests the query metrics
+class Test_metrics():
+    # collect() gets a record per executed query, a cache hit has no network timings
+    def test_collect_cache_hit(self):
+        my_dbc = dbc("https://ows.rasdaman.org/rasdaman/ows", cache = ResultCache())
+        my_dco = create_good_dco()
+        my_dco.DBC = my_dbc
+        my_dbc.cache.put(my_dbc.cache_key(my_dco.fork().to_wcps_query()), WCPSResponse(200, b'1,2'))
+        with my_dbc.collect() as metrics:
+            my_dco.execute()
+        assert len(metrics) == 1 and metrics[0].cache == 'hit' and metrics[0].ttfb == None
+        assert metrics[0].coverage == 'AvgLandTemp' and metrics[0].bytes == 3 and metrics[0].parse != None
+        assert my_dbc.listeners == []
+
+    # the summary reports nearest-rank percentiles per coverage
+    def test_summary(self):
+        summary = MetricsSummary()
+        for ttfb in range(1, 101):
+            metrics = QueryMetrics('for $c in (AvgLandTemp) return 1')
+            metrics.ttfb = ttfb
+            summary(metrics)
+        report = summary.report()['AvgLandTemp']
+        assert report['queries'] == 100 and report['ttfb'] == {'p50': 50, 'p95': 95, 'p99': 99}
+
+    # listeners must be callable
+    def test_add_listener_wrong_type(self):
+        with pytest.raises(TypeError):
+            dbc("https://ows.rasdaman.org/rasdaman/ows").add_listener(1)
+
+
+# this tests the benchmark harness and its stand-in server
+class Test_bench():
+    # the stand-in answers like the real endpoint, so that queries can run offline
+    def test_stand_in_execute(self):
+        with StandInServer(make_payload('csv', 3)) as server:
+            my_dco = dco(dbc(server.url)).initialize_var("$c in (AvgLandTemp)").set_format('CSV')
+            assert my_dco.execute() == [0.5, 1.5, 2.5]
+
+    # injected server errors are retried and then reported
+    def test_stand_in_errors(self):
+        with StandInServer(error_rate = 1) as server:
+            with pytest.raises(ServerError):
+                dbc(server.url, retries = 1, backoff_factor = 0.001).send_query('for $c in (AvgLandTemp) return 1')
+            assert server.queries == 2
+
+    # a report can be compared with itself
+    def test_report(self):
+        report = run(only = ['build'], repeat = 1)
+        assert [row[-1] for row in compare(report, report)] == [1.0, 1.0]
+
+
+# this tests the sharing of in-flight requests
+class Test_coalesce():
+    # threads sending the same query at once share one request
+    def test_threads(self):
+        with StandInServer(b'1,2', latency = 0.2) as server:
+            my_dbc = dbc(server.url)
+            results = my_dbc.send_many(['for $c in (AvgLandTemp) return 1', 'for $c in (AvgLandTemp)\nreturn 1'] * 4)
+            assert server.queries == 1 and all(result.content == b'1,2' for result in results)
+
+    # the error of the shared request is raised for every caller
+    def test_threads_error(self):
+        with StandInServer(latency = 0.2, error_rate = 1, error_status = 400) as server:
+            results = dbc(server.url).send_many(['for $c in (AvgLandTemp) return 1'] * 4)
+            assert server.queries == 1 and all(isinstance(result, QueryError) for result in results)
+
+    # without coalescing every caller sends its own request
+    def test_disabled(self):
+        with StandInServer(b'1', latency = 0.1) as server:
+            dbc(server.url, coalesce = False).send_many(['for $c in (AvgLandTemp) return 1'] * 4)
+            assert server.queries == 4
+
+    # a refresh doesn't wait for a request that may have answered from the cache
+    def test_refresh(self):
+        query = 'for $c in (AvgLandTemp) return 1'
+        with StandInServer(b'1', latency = 0.2) as server:
+            my_dbc = dbc(server.url, cache = ResultCache())
+            with my_dbc.collect() as metrics:
+                my_dbc.run_batch([(my_dbc.send_query, (query,)),
+                                  (lambda: my_dbc.send_query(query, refresh = True), ())], None, False)
+            assert server.queries == 2 and not any(record.coalesced for record in metrics)
+
+    # coroutines sending the same query at once share one request as well
+    def test_async(self):
+        pytest.importorskip("aiohttp")
+        with StandInServer(b'1', latency = 0.1) as server:
+            async def run():
+                async with AsyncDbc(server.url) as my_dbc:
+                    with my_dbc.collect() as metrics:
+                        await my_dbc.gather(['for $c in (AvgLandTemp) return 1'] * 4)
+                return metrics
+            metrics = asyncio.run(run())
+            assert server.queries == 1 and sum(record.coalesced for record in metrics) == 3
+
+
+# this tests the lazy results of execute()
+class Test_lazy():
+    # every form is decoded from the same response, and only once
+    def test_forms(self):
+        with StandInServer(b'1,2,3') as server:
+            result = dco(dbc(server.url)).initialize_var("$c in (AvgLandTemp)").set_format('CSV').execute(lazy = True)
+            assert bytes(result.raw()) == b'1,2,3' and result.raw() is result.raw()
+            assert result.to_list() == [1.0, 2.0, 3.0] and list(result.iter(chunk_size = 2)) == [1.0, 2.0, 3.0]
+            assert result.to_list() is result.to_list()
+
+    # the cells of a RAW result are a list as well
+    def test_raw_list(self):
+        cells = array.array('d', [1.5, 2.5, 3.5])
+        if sys.byteorder == 'big':
+            cells.byteswap()
+        with StandInServer(cells.tobytes()) as server:
+            my_dco = dco(dbc(server.url)).initialize_var("$c in (AvgLandTemp)").set_format('RAW')
+            result = my_dco.execute(lazy = True)
+            assert result.to_list() == [1.5, 2.5, 3.5] and list(result.iter()) == [1.5, 2.5, 3.5]
+
+    # errors of the query are raised when the result is asked for
+    def test_error(self):
+        with StandInServer(error_rate = 1, error_status = 400) as server:
+            result = dco(dbc(server.url)).initialize_var("$c in (AvgLandTemp)").execute(lazy = True)
+            with pytest.raises(QueryError):
+                result.raw()
+
+    # only images have pixels, and a result can't be lazy and streamed at once
+    def test_wrong_form(self):
+        my_dco = create_good_dco().set_format('CSV')
+        with pytest.raises(ValueError):
+            my_dco.execute(stream = True, lazy = True)
+        with StandInServer(b'1') as server:
+            my_dco.DBC = dbc(server.url)
+            with pytest.raises(ValueError):
+                my_dco.execute(lazy = True).image()
+
+
+# this tests decoding images on worker processes
+class Test_image_decoder():
+    # the pixels come back the same as decoded in this process
+    def test_decode(self):
+        pytest.importorskip("numpy")
+        pytest.importorskip("PIL")
+        png = make_payload('png', 100)
+        with ImageDecoder(max_workers = 1) as decoder:
+            assert (decoder.decode(png) == decode_image(png)).all()
+
+    # responses are decoded in input order, errors are returned in their place
+    def test_execute_many(self):
+        pytest.importorskip("numpy")
+        pytest.importorskip("PIL")
+        with StandInServer(make_payload('png', 100)) as server, ImageDecoder(max_workers = 2) as decoder:
+            my_dbc = dbc(server.url)
+            tile = dco(my_dbc).initialize_var("$c in (AvgLandTemp)").set_format('PNG')
+            results = decoder.execute_many(my_dbc, [tile.fork(), 'for $c in (AvgLandTemp) return 1'])
+            assert results[0].shape == (10, 10) and results[1].shape == (10, 10)
+            server.error_rate, server.error_status = 1, 400
+            assert isinstance(decoder.execute_many(my_dbc, ['for $c in (AvgLandTemp) return 2'])[0], QueryError)
+            with pytest.raises(ValueError):
+                decoder.execute_many(my_dbc, [tile.fork().set_format('CSV')])
+
+
+# this tests a dbc with several endpoints
+class Test_endpoints():
+    # queries go to the fastest endpoint once all of them were tried
+    def test_route_fastest(self):
+        with StandInServer(b'1', latency = 0.1) as slow, StandInServer(b'2') as fast:
+            my_dbc = dbc([slow.url, fast.url])
+            results = [my_dbc.send_query(f'for $c in (AvgLandTemp) return {i}').content for i in range(5)]
+            assert results == [b'1'] + [b'2'] * 4 and slow.queries == 1
+
+    # a failing endpoint is skipped, and after enough failures its circuit opens
+    def test_failover(self):
+        with StandInServer(error_rate = 1) as down, StandInServer(b'2') as up:
+            my_dbc = dbc([down.url, up.url], failure_threshold = 1, cooldown = 60)
+            with my_dbc.collect() as metrics:
+                assert my_dbc.send_query('for $c in (AvgLandTemp) return 1').content == b'2'
+            assert metrics[0].failovers == 1 and metrics[0].endpoint == up.url
+            assert not my_dbc.endpoints[0].available()
+            assert my_dbc.check_health() == {down.url: False, up.url: True}
+
+    # when every circuit is open the query fails right away
+    def test_all_down(self):
+        with StandInServer(error_rate = 1) as down:
+            my_dbc = dbc([down.url, down.url + '/other'], failure_threshold = 1)
+            with pytest.raises(ServerError):
+                my_dbc.send_query('for $c in (AvgLandTemp) return 1')
+            with pytest.raises(ConnectionFailed):
+                my_dbc.send_query('for $c in (AvgLandTemp) return 2')
+            assert down.queries == 2
+
+    # endpoints must be given as strings
+    def test_wrong_type(self):
+        with pytest.raises(TypeError):
+            dbc(["https://ows.rasdaman.org/rasdaman/ows", 2])
+        with pytest.raises(ValueError):
+            dbc([])
+
+
+# a GetCapabilities response that lists the binary format
+CAPABILITIES = b'''<wcs:Capabilities xmlns:wcs="http://www.opengis.net/wcs/2.0"><wcs:ServiceMetadata>
+    <wcs:formatSupported>text/csv</wcs:formatSupported>
+    <wcs:formatSupported>application/octet-stream</wcs:formatSupported>
+</wcs:ServiceMetadata></wcs:Capabilities>'''
+
+# a stand-in server for AvgLandTemp that answers CSV and RAW queries with the same 3x4 (3 x 'columns') cells
+def create_auto_server(columns = 4):
+    values = [0, 1, 2, 99999] + list(range(4, 3 * columns))
+    cells = array.array('f', values)
+    if sys.byteorder == 'big':
+        cells.byteswap()
+    answers = {'GetCapabilities': CAPABILITIES, 'DescribeCoverage': AVG_LAND_TEMP,
+               'imageCrsDomain': f'(0:2,0:{columns - 1})'.encode(), 'octet-stream': cells.tobytes()}
+    rows = ['{' + ','.join(str(value) for value in values[row * columns:(row + 1) * columns]) + '}' for row in range(3)]
+    return StandInServer(','.join(rows).encode(), answers = answers, compress = True)
+
+# this tests set_format('AUTO') and compressed responses
+class Test_auto_format():
+    # a big enough subset is fetched as RAW, and returned like the CSV result
+    def test_same_value(self):
+        pytest.importorskip("numpy")
+        with create_auto_server() as server:
+            my_dbc = dbc(server.url, auto_min_bytes = 1)
+            def create_dco():
+                return dco(my_dbc).initialize_var("$c in (AvgLandTemp)").subset('Lat(50:50.2), Long(0:0.3), ansi("2000-02")', '$c')
+            assert create_dco().set_format('AUTO').choose_format() == ('RAW', ('float32', (3, 4)))
+            with my_dbc.collect() as metrics:
+                auto = create_dco().set_format('AUTO').execute(as_numpy = True, nodata = 99999)
+            csv = create_dco().set_format('CSV').execute(as_numpy = True, nodata = 99999)
+            assert 'octet-stream' in metrics[-1].query and auto.shape == csv.shape == (3, 4)
+            assert str(auto.tolist()) == str(csv.tolist())
+            assert create_dco().set_format('AUTO').execute() == [0.0, 1.0, 2.0, 99999.0] + [float(i) for i in range(4, 12)]
+            # the shape is counted from the coverage description, without asking the server
+            assert not any('imageCrsDomain' in record.query for record in metrics)
+
+    # a server that cuts the subset one cell wider than the description says still gives the CSV value
+    def test_shape_off_by_one(self, tmp_path):
+        pytest.importorskip("numpy")
+        with create_auto_server(columns = 5) as server:
+            my_dbc = dbc(server.url, auto_min_bytes = 1)
+            def create_dco(output_format):
+                my_dco = dco(my_dbc).initialize_var("$c in (AvgLandTemp)")
+                return my_dco.subset('Lat(50:50.2), Long(0:0.3), ansi("2000-02")', '$c').set_format(output_format)
+            assert create_dco('AUTO').choose_format() == ('RAW', ('float32', (3, 4)))
+            auto = create_dco('AUTO').execute(as_numpy = True, nodata = 99999)
+            csv = create_dco('CSV').execute(as_numpy = True, nodata = 99999)
+            assert auto.shape == csv.shape == (3, 5) and str(auto.tolist()) == str(csv.tolist())
+            assert create_dco('AUTO').execute(lazy = True).to_numpy().shape == (3, 5)
+            assert create_dco('AUTO').execute_to(NpySink(str(tmp_path / 'raw.npy'))).array.shape == (3, 5)
+
+    # the server is asked for the shape if the description can't tell, e.g. for grid coordinates
+    def test_shape_fallback(self):
+        with create_auto_server() as server:
+            my_dbc = dbc(server.url, auto_min_bytes = 1)
+            my_dco = dco(my_dbc).initialize_var("$c in (AvgLandTemp)")
+            my_dco.subset('Lat:"CRS:1"(0:2), Long:"CRS:1"(0:3), ansi("2000-02")', '$c').set_format('AUTO')
+            with my_dbc.collect() as metrics:
+                assert my_dco.choose_format() == ('RAW', ('float32', (3, 4)))
+            assert any('imageCrsDomain' in record.query for record in metrics)
+
+    # aggregations and small results stay CSV
+    def test_csv(self):
+        with create_auto_server() as server:
+            my_dco = dco(dbc(server.url)).initialize_var("$c in (AvgLandTemp)").subset('Lat(50:60), Long(0:5)', '$c')
+            assert my_dco.set_format('AUTO').choose_format() == ('CSV', None)
+            assert my_dco.avg().set_format('AUTO').choose_format() == ('CSV', None)
+
+    # compressed responses are decompressed, the metrics show both sizes
+    def test_compression(self):
+        with StandInServer(b'1,' * 1000 + b'1', compress = True) as server:
+            my_dbc = dbc(server.url)
+            with my_dbc.collect() as metrics:
+                assert len(my_dbc.send_query('for $c in (AvgLandTemp) return 1').content) == 2001
+            assert metrics[0].wire_bytes < metrics[0].bytes
+
+# the description of AvgLandTemp after one more month was added
+AVG_LAND_TEMP_MAY = AVG_LAND_TEMP.replace(b'"2000-04-01T00:00:00.000Z"</gmlrgrid:coefficients>',
+                                          b'"2000-04-01T00:00:00.000Z" "2000-05-01T00:00:00.000Z"</gmlrgrid:coefficients>')
+
+# this tests fetching only the new slices of a time series
+class Test_incremental():
+    def create_dco(self, server, months = '"2000-02":"2000-04"'):
+        return dco(dbc(server.url)).initialize_var("$c in (AvgLandTemp)").subset(f'Lat(53.08), Long(8.80), ansi({months})', '$c')
+
+    # only the newest stored slice and the new ones are fetched again
+    def test_new_slices(self, tmp_path):
+        answers = {'DescribeCoverage': AVG_LAND_TEMP, '"2000-04-01T00:00:00.000Z":"2000-05-01T00:00:00.000Z"': b'8,9'}
+        with StandInServer(b'1,2,3', answers = answers) as server:
+            store = TimeSeriesStore(str(tmp_path / 'series.json'))
+            series = self.create_dco(server).execute_incremental(store)
+            assert series == {'2000-02-01T00:00:00.000Z': 1.0, '2000-03-01T00:00:00.000Z': 2.0,
+                              '2000-04-01T00:00:00.000Z': 3.0}
+            server.answers['DescribeCoverage'] = AVG_LAND_TEMP_MAY
+            store = TimeSeriesStore(str(tmp_path / 'series.json'))
+            series = self.create_dco(server, '"2000-02":"2000-05"').execute_incremental(store)
+            assert list(series.values()) == [1.0, 2.0, 8.0, 9.0]
+            assert server.queries == 4
+
+    # changed metadata of stored slices, or 'full', fetch everything again
+    def test_full_refresh(self):
+        changed = AVG_LAND_TEMP.replace(b'"2000-03-01T00:00:00.000Z" "2000-04', b'"2000-03-15T00:00:00.000Z" "2000-04')
+        with StandInServer(b'1,2,3', answers = {'DescribeCoverage': AVG_LAND_TEMP}) as server:
+            store = TimeSeriesStore()
+            self.create_dco(server).execute_incremental(store, recent = 0)
+            assert list(self.create_dco(server).execute_incremental(store, recent = 0).values()) == [1.0, 2.0, 3.0]
+            assert server.queries == 3
+            self.create_dco(server).execute_incremental(store, full = True)
+            assert server.queries == 5
+            server.answers['DescribeCoverage'] = changed
+            series = self.create_dco(server).execute_incremental(store, recent = 0)
+            assert '2000-03-15T00:00:00.000Z' in series and server.queries == 7
+
+    # the time axis needs a range, and aggregations have no slices
+    def test_bad_query(self):
+        with StandInServer(b'1', answers = {'DescribeCoverage': AVG_LAND_TEMP}) as server:
+            with pytest.raises(ValueError):
+                self.create_dco(server, '"2000-02"').execute_incremental(TimeSeriesStore())
+            with pytest.raises(ValueError):
+                self.create_dco(server).avg().execute_incremental(TimeSeriesStore())
+            with pytest.raises(TypeError):
+                self.create_dco(server).execute_incremental({})
+
+# this tests writing results into memory-mapped files
+class Test_sinks():
+    # CSV results are written while they stream in, the file is mapped by whoever opens it
+    def test_npy(self, tmp_path):
+        np = pytest.importorskip("numpy")
+        path = str(tmp_path / 'result.npy')
+        with StandInServer(b'{1,2,3},{4,5,6}') as server:
+            my_dco = dco(dbc(server.url)).initialize_var("$c in (AvgLandTemp)").subset('Lat(50:51), Long(0:2)', '$c')
+            with NpySink(path, (2, 3), dtype = 'float32') as sink:
+                my_dco.set_format('CSV').execute_to(sink, chunk_size = 4)
+        cells, metadata = open_result(path)
+        assert isinstance(cells, np.memmap) and cells.dtype == np.float32
+        assert cells.tolist() == [[1, 2, 3], [4, 5, 6]]
+        assert metadata['coverage'] == ['AvgLandTemp'] and 'Lat(50:51)' in metadata['query']
+        assert metadata['shape'] == [2, 3]
+
+    # without a shape the file gets the one of the result, RAW cells split between chunks are put together
+    def test_shape(self, tmp_path):
+        np = pytest.importorskip("numpy")
+        with create_auto_server() as server:
+            my_dbc = dbc(server.url, auto_min_bytes = 1)
+            def create_dco(output_format):
+                my_dco = dco(my_dbc).initialize_var("$c in (AvgLandTemp)")
+                return my_dco.subset('Lat(50:50.2), Long(0:0.3), ansi("2000-02")', '$c').set_format(output_format)
+            sink = create_dco('AUTO').execute_to(NpySink(str(tmp_path / 'raw.npy')), chunk_size = 7)
+            assert sink.array.shape == (3, 4) and sink.metadata['format'] == 'RAW'
+            assert sink.array.ravel().tolist() == [0, 1, 2, 99999] + list(range(4, 12))
+            sink = create_dco('CSV').execute_to(NpySink(str(tmp_path / 'csv.npy')))
+            assert sink.array.shape == (3, 4) and sink.array[0, 3] == 99999
+
+    # a batch fills disjoint regions of one file, tiles are written where stitch_tiles would put them
+    def test_regions(self, tmp_path):
+        np = pytest.importorskip("numpy")
+        answers = {'Lat(0)': b'1,2', 'Lat(1)': b'3,4'}
+        with StandInServer(b'{1,2},{3,4}', answers = answers) as server:
+            my_dbc = dbc(server.url)
+            def create_dco(subset):
+                return dco(my_dbc).initialize_var("$c in (AvgLandTemp)").subset(subset, '$c').set_format('CSV')
+            sink = NpySink(str(tmp_path / 'batch.npy'), (2, 2))
+            results = my_dbc.execute_many([create_dco('Lat(0), Long(0:1)'), create_dco('Lat(1), Long(0:1)')],
+                                          sink = sink, regions = [(1,), (0,)])
+            assert results == [sink, sink] and sink.array.tolist() == [[3, 4], [1, 2]]
+            stitched = create_dco('Lat(0:3), Long(0:1)').execute_tiled({'Lat': 2}, resolution = {'Lat': 1})
+            sink = create_dco('Lat(0:3), Long(0:1)').execute_tiled({'Lat': 2}, resolution = {'Lat': 1},
+                                                                   sink = NpySink(str(tmp_path / 'tiles.npy')))
+            assert sink.array.tolist() == stitched.tolist() and sink.metadata['tiles'] == 2
+            with pytest.raises(ValueError):
+                my_dbc.execute_many([create_dco('Lat(0), Long(0:1)')], sink = sink)
+            with pytest.raises(TypeError):
+                my_dbc.execute_many(['for $c in (AvgLandTemp) return 1'], sink = sink, regions = [(0,)])
+
+    # results that don't fill their sink exactly are errors, also a RAW result ending in part of a cell
+    def test_wrong_size(self, tmp_path):
+        np = pytest.importorskip("numpy")
+        answers = {'octet-stream': np.arange(3, dtype = '<f4').tobytes() + b'\0', 'Lat(2:3)': b'{5,6}'}
+        with StandInServer(b'{1,2},{3,4}', answers = answers) as server:
+            my_dbc = dbc(server.url)
+            def create_dco(subset = 'Lat(0:1), Long(0:1)'):
+                return dco(my_dbc).initialize_var("$c in (AvgLandTemp)").subset(subset, '$c').set_format('CSV')
+            with pytest.raises(ValueError):
+                create_dco().execute_to(NpySink(str(tmp_path / 'csv.npy'), (5,)))
+            with pytest.raises(ValueError):
+                create_dco().set_format('RAW').execute_to(NpySink(str(tmp_path / 'raw.npy'), (3,), 'float32'))
+            sink = create_dco().execute_to(NpySink(str(tmp_path / 'region.npy'), (3, 2)), (slice(0, 2),))
+            assert sink.array.tolist() == [[1, 2], [3, 4], [0, 0]]
+            # the second tile has one row instead of the two of its split
+            with pytest.raises(ValueError):
+                create_dco('Lat(0:3), Long(0:1)').execute_tiled({'Lat': 2}, resolution = {'Lat': 1},
+                                                                sink = NpySink(str(tmp_path / 'tiles.npy')))
+
+    # the Arrow file holds the cells as one column and the metadata in its schema
+    def test_arrow(self, tmp_path):
+        pytest.importorskip("pyarrow")
+        path = str(tmp_path / 'result.arrow')
+        with StandInServer(b'{1,2,3},{4,5,6}') as server:
+            my_dco = dco(dbc(server.url)).initialize_var("$c in (AvgLandTemp)").subset('Lat(50:51), Long(0:2)', '$c')
+            with ArrowSink(path, batch_size = 4, metadata = {'run': 1}) as sink:
+                my_dco.set_format('CSV').execute_to(sink, region = None, chunk_size = 8)
+                with pytest.raises(ValueError):
+                    sink.write([1], region = (0,))
+        table, metadata = open_result(path)
+        assert table.column('value').to_pylist() == [1, 2, 3, 4, 5, 6]
+        assert metadata['run'] == 1 and metadata['coverage'] == ['AvgLandTemp']
+
+# this tests the command line batch runner
+class Test_runner():
+    # plain queries and JSON lines with an output path, comments and empty lines are skipped
+    def test_read_jobs(self):
+        lines = ['# nightly', 'for $c in (AvgLandTemp) return 1', '', '{"query": "for $c in (A) return 2", "output": "a.csv"}']
+        assert read_jobs(lines) == [(2, 'for $c in (AvgLandTemp) return 1', None), (4, 'for $c in (A) return 2', 'a.csv')]
+        with pytest.raises(ValueError):
+            read_jobs(['{"output": "a.csv"}'])
+
+    # results are written to their files, the summary goes to stdout
+    def test_run(self, tmp_path, monkeypatch, capsys):
+        queries = tmp_path / 'queries.jsonl'
+        queries.write_text('for $c in (AvgLandTemp) return 1\n{"query": "for $c in (AvgLandTemp) return 2", "output": "two.csv"}\n')
+        with StandInServer(b'1,2,3', content_type = 'text/csv') as server:
+            assert run_queries(['--url', server.url, str(queries), '--output-dir', str(tmp_path / 'out')]) == 0
+            summary = json.loads(capsys.readouterr().out)
+            assert summary['succeeded'] == 2 and summary['content_bytes'] == 10 and summary['latency']['p50'] > 0
+            assert (tmp_path / 'out' / 'two.csv').read_bytes() == b'1,2,3'
+            assert (tmp_path / 'out' / '000001.csv').read_bytes() == b'1,2,3'
+            # from stdin, through a cache
+            monkeypatch.setattr(sys, 'stdin', io.StringIO('for $c in (AvgLandTemp) return 1\n' * 3))
+            arguments = ['--url', server.url, '--cache', str(tmp_path / 'cache'), '--report', str(tmp_path / 'report.json')]
+            assert run_queries(arguments) == 0
+            assert json.loads((tmp_path / 'report.json').read_text())['queries'] == 3
+
+    # failed queries are counted and listed, and make the exit status 1
+    def test_failures(self, tmp_path, capsys):
+        queries = tmp_path / 'queries.txt'
+        queries.write_text('for $c in (AvgLandTemp) return 1\n')
+        with StandInServer(error_rate = 1.0, error_status = 400) as server:
+            assert run_queries(['--url', server.url, str(queries)]) == 1
+        summary = json.loads(capsys.readouterr().out)
+        assert summary['failed'] == 1 and summary['failures'][0]['line'] == 1
+
+    # a download that breaks off leaves neither the result nor its partial file
+    def test_broken_download(self, tmp_path):
+        class Response: # a streamed response whose connection drops after the first chunk
+            headers = {}
+            def iter_content(self, chunk_size):
+                yield b'1,'
+                raise ConnectionError('connection reset')
+            def close(self):
+                pass
+        class Dbc:
+            cache = None
+            def send_query(self, wcps_query, stream = False):
+                return Response()
+        with pytest.raises(ConnectionError):
+            run_job(Dbc(), 1, 'for $c in (AvgLandTemp) return 1', 'one.csv', str(tmp_path), 65536)
+        assert list(tmp_path.iterdir()) == []
+
+# this tests parsing large CSV results on several processes
+class Test_csv_parser():
+    # the chunks give the same array as parsing on one core, whatever the nesting
+    def test_same_array(self):
+        np = pytest.importorskip("numpy")
+        cube = '{' + '},{'.join('{' + '},{'.join(','.join(str(k * 20 + j * 5 + i) for i in range(5)) for j in range(4)) + '}'
+                                for k in range(3)) + '}'
+        with CsvParser(max_workers = 3, min_bytes = 1) as parser:
+            for payload in [cube.encode(), make_payload('nested', 1000), make_payload('csv', 1001), b'{1,2,3}', b'1,2,3,']:
+                expected = parse_csv_array(payload, 'float32', nodata = 7)
+                parsed = parser.parse(memoryview(payload), 'float32', nodata = 7)
+                assert parsed.shape == expected.shape and parsed.dtype == expected.dtype
+                assert np.array_equal(parsed, expected, equal_nan = True)
+            assert parser.parse(b'1,2', ndim = 2).shape == (1, 2)
+            with pytest.raises(ValueError):
+                parser.parse(b'1,2,x,4,5,6')
+
+    # float64 results are the shared array the workers wrote into, it is closed once nothing uses it anymore
+    def test_shared_result(self, monkeypatch):
+        pytest.importorskip("numpy")
+        closed = []
+        monkeypatch.setattr(wdc, 'close_shared_memory', lambda block: closed.append(block.close()))
+        with CsvParser(max_workers = 2, min_bytes = 1) as parser:
+            values = parser.parse(b'{1,2},{3,4},')
+            converted = parser.parse(b'1,2,3,4', 'int32')
+        # the converted copy doesn't need its block anymore
+        assert converted.tolist() == [1, 2, 3, 4] and len(closed) == 1
+        base = values
+        while isinstance(base, type(values)):
+            base = base.base
+        assert type(base).__name__ == 'mmap'
+        row = values[1]
+        del values, base
+        gc.collect()
+        assert row.tolist() == [3, 4] and len(closed) == 1
+        del row
+        gc.collect()
+        assert len(closed) == 2
+
+    # small results are parsed right away, without starting any process
+    def test_small(self):
+        pytest.importorskip("numpy")
+        parser = CsvParser(max_workers = 2)
+        assert parser.parse(b'{1,2},{3,4}').tolist() == [[1, 2], [3, 4]] and parser.executor == None
+
+    # execute() parses large array results with the shared parser, lists are the same whatever their size
+    def test_execute(self, monkeypatch):
+        pytest.importorskip("numpy")
+        parser = CsvParser(max_workers = 2, min_bytes = 1000)
+        monkeypatch.setattr(wdc, 'CSV_PARSER', parser)
+        def create_dco(server):
+            return dco(dbc(server.url)).initialize_var("$c in (AvgLandTemp)").subset('Lat(0:19), Long(0:19)', '$c')
+        with StandInServer(make_payload('nested', 400)) as server:
+            assert create_dco(server).execute(as_numpy = True).shape == (20, 20)
+        assert parser.executor != None
+        with StandInServer(make_payload('csv', 400)) as server:
+            assert create_dco(server).execute() == [i + 0.5 for i in range(400)]
+        parser.close()
@@ -0,0 +1,350 @@
+"""
+Benchmarks for wdc, run against a local stand-in for the WCPS endpoint, so that they neither need
+    ows.rasdaman.org nor depend on its load. The report is written as JSON and can be compared
+    with the report of an earlier release.
+
+Example:
+    python wdc_bench.py --output new.json --compare old.json
+    python wdc_bench.py --only parse --sizes 1000 100000000
+
+"""
+import argparse
+import array
+import asyncio
+import gzip
+import json
+import platform
+import random
+import statistics
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from wdc import dbc, dco, AsyncDbc, byte_to_list, parse_csv_array, iter_csv_values, decode_raw, decode_image
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def make_payload(kind, values):
+    """
+    Builds a synthetic response body holding 'values' numbers, like the server would return them.
+
+    Parameters:
+        kind (str): 'csv' (1.5,2.5,...), 'nested' (rows of a 2-D result, {..},{..}), 'png'
+            (a grayscale image with about 'values' pixels) or 'raw' (float32 cells).
+
+    """
+    if kind == 'csv':
+        return ','.join(str(i + 0.5) for i in range(values)).encode()
+    if kind == 'nested':
+        width = max(1, int(values ** 0.5))
+        rows = (','.join(str(i * width + j + 0.5) for j in range(width)) for i in range(max(1, values // width)))
+        return ('{' + '},{'.join(rows) + '}').encode()
+    if kind == 'png':
+        width = max(1, int(values ** 0.5))
+        height = max(1, values // width)
+        pixels = b''.join(b'\x00' + bytes(i % 256 for i in range(width)) for _ in range(height))
+
+        def chunk(tag, data):
+            return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+        return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+                + chunk(b'IDAT', zlib.compress(pixels)) + chunk(b'IEND', b''))
+    if kind == 'raw':
+        return array.array('f', (i + 0.5 for i in range(values))).tobytes()
+    raise ValueError("Kind must be 'csv', 'nested', 'png' or 'raw'.")
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # answers every WCPS query with the payload of the server, after its latency, or with an injected error
+    protocol_version = 'HTTP/1.1' # keep-alive, like the real endpoint, so that the pooled connections are reused
+    disable_nagle_algorithm = True # headers and body are separate writes, don't let them wait for a delayed ACK
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        query = urllib.parse.parse_qs(self.rfile.read(length).decode()).get('query', [''])[0]
+        self.answer(query)
+
+    def do_GET(self):
+        # WCS requests like GetCapabilities are matched by their whole query string
+        query = urllib.parse.urlparse(self.path).query
+        self.answer(urllib.parse.parse_qs(query).get('query', [query])[0])
+
+    def answer(self, query):
+        server = self.server.stand_in
+        status, body = server.respond(query)
+        self.send_response(status)
+        self.send_header('Content-Type', server.content_type)
+        if server.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, compresslevel = 1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # the default of 5 drops connections when many clients connect at once
+
+
+class StandInServer:
+    """
+    A local HTTP server that behaves like a WCPS endpoint. It runs on a background thread and can
+        be used as a context manager; 'url' is what to pass to dbc.
+
+    Parameters:
+        payload (bytes): The body of every successful response, e.g. from make_payload.
+        latency (float): Seconds to wait before answering.
+        error_rate (float): Share of queries answered with 'error_status' instead (0 to 1).
+        error_status (int): 500 for errors that are retried, 400 for rejected queries.
+        seed (int): Seed of the error injection, so that runs are repeatable.
+        answers (dict): Bodies for particular requests instead of 'payload', by a text that the
+            query (or the query string of a GET request) contains, e.g. {'GetCapabilities': ...}.
+        compress (bool): Send gzip compressed bodies to clients that accept them.
+
+    Example:
+        >>> with StandInServer(make_payload('csv', 1000), latency = 0.01) as server:
+        ...     dbc(server.url).send_query('for $c in (AvgLandTemp) return 1')
+
+    """
+    def __init__(self, payload = b'1', latency = 0.0, error_rate = 0.0, error_status = 500,
+                 content_type = 'text/plain', seed = 0, answers = None, compress = False):
+        self.payload = payload
+        self.answers = answers if answers != None else {}
+        self.compress = compress
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.content_type = content_type
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.errors = 0
+        self.httpd = None
+
+    def respond(self, query):
+        with self.lock:
+            self.queries += 1
+            failing = self.error_rate > 0 and self.random.random() < self.error_rate
+            self.errors += failing
+        if self.latency:
+            time.sleep(self.latency)
+        if failing:
+            return self.error_status, b'Injected error'
+        for text, body in self.answers.items():
+            if text in query:
+                return 200, body
+        return 200, self.payload
+
+    def start(self):
+        self.httpd = StandInHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.httpd.stand_in = self
+        threading.Thread(target = self.httpd.serve_forever, daemon = True).start()
+        return self
+
+    def stop(self):
+        if self.httpd != None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}/rasdaman/ows'
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def measure(name, function, repeat = 5, items = 1, **params):
+    """
+    Runs 'function' 'repeat' times and returns a report entry with the best, median and mean
+        duration in seconds, and the throughput in 'items' per second of the best run.
+
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    best = min(durations)
+    return {'name': name, 'params': params, 'repeat': repeat, 'best': best, 'median': statistics.median(durations),
+            'mean': statistics.mean(durations), 'items_per_second': items / best if best > 0 else None}
+
+
+def bench_parse(sizes, repeat):
+    # the parsers of execute() on CSV, nested CSV, RAW and PNG payloads of every size
+    try:
+        import PIL
+    except ImportError:
+        PIL = None
+    results = []
+    for size in sizes:
+        csv = make_payload('csv', size)
+        nested = make_payload('nested', size)
+        raw = make_payload('raw', size)
+        results.append(measure('parse.byte_to_list', lambda: byte_to_list(csv), repeat, size, values = size))
+        results.append(measure('parse.iter_csv_values',
+                               lambda: sum(1 for _ in iter_csv_values(csv[i:i + 65536] for i in range(0, len(csv), 65536))),
+                               repeat, size, values = size))
+        results.append(measure('parse.decode_raw', lambda: decode_raw(raw, 'float32'), repeat, size, values = size))
+        if np != None:
+            results.append(measure('parse.parse_csv_array', lambda: parse_csv_array(csv), repeat, size, values = size))
+            results.append(measure('parse.parse_csv_array_nested', lambda: parse_csv_array(nested), repeat, size,
+                                   values = size))
+            results.append(measure('parse.decode_raw_numpy', lambda: decode_raw(raw, 'float32', as_numpy = True),
+                                   repeat, size, values = size))
+        if np != None and PIL != None:
+            png = make_payload('png', size)
+            results.append(measure('parse.decode_image', lambda: decode_image(png), repeat, size, values = size))
+    return results
+
+
+def bench_build(repeat, count = 1000):
+    # building queries with to_wcps_query, for a simple and for a composite query
+    my_dbc = dbc('http://127.0.0.1:1/rasdaman/ows')
+
+    def simple():
+        for _ in range(count):
+            dco(my_dbc).initialize_var('$c in (AvgLandTemp)').subset('Lat(53.08), Long(8.80), ansi("2014-01":"2014-12")',
+                                                                     '$c').set_format('CSV').to_wcps_query()
+
+    def composite():
+        for _ in range(count):
+            datacube = dco(my_dbc).initialize_var('$c in (AvgLandTemp)').initialize_var('$d in (AvgLandTemp)')
+            datacube.subset('Lat(53.08), Long(8.80), ansi("2014-01":"2014-12")', '$c')
+            datacube.subset('Lat(53.08), Long(8.80), ansi("2015-01":"2015-12")', '$d')
+            datacube.where('$c > 0').stats(['MIN', 'MAX', 'AVG'], '$c - $d').to_wcps_query()
+    return [measure('build.simple', simple, repeat, count, queries = count),
+            measure('build.composite', composite, repeat, count, queries = count)]
+
+
+def distinct_queries(count):
+    # queries that differ in their subset, so that none of them is answered by another one in flight
+    return [f'for $c in (AvgLandTemp) return encode($c[Lat({i % 180 - 89.5}), Long({i // 180 % 360 - 179.5}), '
+            f'ansi("2014-01":"2014-12")], "text/csv")' for i in range(count)]
+
+
+def bench_send(repeat, latency, queries, pool_size, values):
+    # send_query one after another, send_many on threads, execute_many with parsing and AsyncDbc.gather
+    results = []
+    batch = distinct_queries(queries)
+    params = {'queries': queries, 'latency': latency, 'pool_size': pool_size, 'values': values}
+    with StandInServer(make_payload('csv', values), latency = latency) as server:
+        with dbc(server.url, pool_size = pool_size) as my_dbc:
+            results.append(measure('send.sequential', lambda: [my_dbc.send_query(query) for query in batch],
+                                   repeat, queries, **params))
+            results.append(measure('send.send_many', lambda: my_dbc.send_many(batch), repeat, queries, **params))
+            # the same query from every thread, sent once and shared
+            results.append(measure('send.send_many_identical', lambda: my_dbc.send_many(batch[:1] * queries), repeat,
+                                   queries, **params))
+
+            def execute_many():
+                datacubes = [dco(my_dbc).initialize_var('$c in (AvgLandTemp)').subset(f'Lat({i})', '$c').set_format('CSV')
+                             for i in range(queries)]
+                my_dbc.execute_many(datacubes)
+            results.append(measure('send.execute_many', execute_many, repeat, queries, **params))
+        try:
+            AsyncDbc(server.url)
+        except ImportError:
+            return results
+
+        async def gather():
+            async with AsyncDbc(server.url, pool_size = pool_size) as my_dbc:
+                await my_dbc.gather(batch)
+        results.append(measure('send.async_gather', lambda: asyncio.run(gather()), repeat, queries, **params))
+    return results
+
+
+def bench_errors(repeat, queries, error_rate):
+    # the cost of retried server errors, with a short backoff
+    with StandInServer(b'1', error_rate = error_rate) as server:
+        with dbc(server.url, backoff_factor = 0.001) as my_dbc:
+            return [measure('send.with_errors', lambda: my_dbc.send_many(distinct_queries(queries)), repeat, queries,
+                            queries = queries, error_rate = error_rate)]
+
+
+def run(only = None, sizes = (1000, 10000, 100000, 1000000), repeat = 5, latency = 0.005, queries = 200,
+        pool_size = 10, values = 1000, error_rate = 0.1):
+    """
+    Runs the benchmarks (all of them, or the groups in 'only': 'parse', 'build', 'send', 'errors')
+        and returns the report as a dict.
+
+    """
+    groups = {'parse': lambda: bench_parse(sizes, repeat),
+              'build': lambda: bench_build(repeat),
+              'send': lambda: bench_send(repeat, latency, queries, pool_size, values),
+              'errors': lambda: bench_errors(repeat, queries, error_rate)}
+    results = []
+    for group in only or groups:
+        if group not in groups:
+            raise ValueError(f"Unknown benchmark group '{group}'.")
+        results.extend(groups[group]())
+    return {'python': sys.version.split()[0], 'platform': platform.platform(),
+            'numpy': np.__version__ if np != None else None, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results}
+
+
+def result_key(result):
+    return (result['name'], json.dumps(result['params'], sort_keys = True))
+
+
+def compare(old, new):
+    """
+    Matches the results of two reports and returns (name, params, old best, new best, ratio) for each,
+        a ratio above 1 means the new release is slower.
+
+    """
+    old_results = {result_key(result): result for result in old['results']}
+    rows = []
+    for result in new['results']:
+        before = old_results.get(result_key(result))
+        if before != None:
+            rows.append((result['name'], result['params'], before['best'], result['best'], result['best'] / before['best']))
+    return rows
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmarks wdc against a local stand-in WCPS server.')
+    parser.add_argument('--only', nargs = '+', choices = ['parse', 'build', 'send', 'errors'])
+    parser.add_argument('--sizes', nargs = '+', type = int, default = [1000, 10000, 100000, 1000000],
+                        help = 'numbers per payload for the parser benchmarks, up to 100000000')
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--latency', type = float, default = 0.005, help = 'seconds the server waits per query')
+    parser.add_argument('--queries', type = int, default = 200)
+    parser.add_argument('--pool-size', type = int, default = 10)
+    parser.add_argument('--error-rate', type = float, default = 0.1)
+    parser.add_argument('--output', help = 'file to write the JSON report to, stdout by default')
+    parser.add_argument('--compare', help = 'JSON report of an earlier run to compare with')
+    args = parser.parse_args(argv)
+    report = run(args.only, args.sizes, args.repeat, args.latency, args.queries, args.pool_size,
+                 error_rate = args.error_rate)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent = 2)
+    else:
+        json.dump(report, sys.stdout, indent = 2)
+        print()
+    if args.compare:
+        with open(args.compare) as file:
+            old = json.load(file)
+        for name, params, before, after, ratio in compare(old, report):
+            print(f'{name:32} {json.dumps(params):70} {before:.6f}s -> {after:.6f}s  x{ratio:.2f}', file = sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
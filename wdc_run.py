@@ -0,0 +1,191 @@
+"""
+Runs a batch of WCPS queries from a file or stdin, e.g. for nightly jobs, and reports the
+    throughput, latency percentiles, bytes received (decompressed content) and failures of the run as JSON.
+
+    Every line holds either a WCPS query, or a JSON object with the 'query' and the 'output'
+    path its result is written to. Empty lines and lines starting with '#' are skipped. Results
+    are streamed to disk, to the 'output' of their line or, for plain queries, to numbered files
+    in --output-dir; without either they are downloaded and only counted.
+
+Example:
+    python wdc_run.py --url https://ows.rasdaman.org/rasdaman/ows queries.txt --output-dir results
+    python wdc_run.py --url https://a.example/ows --url https://b.example/ows --concurrency 32 < queries.jsonl
+
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from wdc import dbc, DiskCache, MetricsSummary, percentile
+
+# file extensions of the results of plain queries, by their Content-Type
+EXTENSIONS = {'text/csv': 'csv', 'text/plain': 'txt', 'image/png': 'png', 'image/jpeg': 'jpg',
+              'image/tiff': 'tif', 'application/netcdf': 'nc', 'application/octet-stream': 'bin'}
+
+
+def read_jobs(lines):
+    """
+    Turns the lines of a query file into a list of (line number, query, output path) tuples, the
+        output path is None if the line doesn't name one.
+
+    """
+    jobs = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('{'):
+            try:
+                job = json.loads(line)
+            except ValueError as error:
+                raise ValueError(f"Line {number} isn't valid JSON: {error}") from error
+            if not isinstance(job.get('query'), str):
+                raise ValueError(f"Line {number} has no 'query'")
+            jobs.append((number, job['query'], job.get('output')))
+        else:
+            jobs.append((number, line, None))
+    return jobs
+
+
+def run_job(my_dbc, number, query, output, output_dir, chunk_size):
+    
+   # Sends one query and writes its result, returns (content bytes, output path); the file only appears once it is complete.
+
+    if my_dbc.cache != None:
+        # only whole responses go through the cache, a cached one is already in memory (or mapped)
+        response = my_dbc.send_query(query)
+        chunks = [response.content]
+        close = lambda: None
+    else:
+        response = my_dbc.send_query(query, stream = True)
+        chunks = response.iter_content(chunk_size)
+        close = response.close
+    try:
+        if output == None and output_dir != None:
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+            output = f'{number:06d}.{EXTENSIONS.get(content_type, "out")}'
+        if output != None and output_dir != None:
+            output = os.path.join(output_dir, output)
+        if output == None:
+            return sum(len(chunk) for chunk in chunks), None
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok = True)
+        size = 0
+        try:
+            with open(output + '.part', 'wb') as output_file:
+                for chunk in chunks:
+                    output_file.write(chunk)
+                    size += len(chunk)
+            os.replace(output + '.part', output)
+        except Exception:
+            # a failed download leaves no partial file behind
+            if os.path.exists(output + '.part'):
+                os.remove(output + '.part')
+            raise
+        return size, output
+    finally:
+        close()
+
+
+def run(my_dbc, jobs, concurrency = 10, output_dir = None, chunk_size = 65536, progress = None):
+    """
+    Runs the jobs of read_jobs on 'concurrency' threads and returns the summary of the run.
+
+    Parameters:
+        progress (file): Where a line per failed query is written while the run goes on, e.g. sys.stderr.
+
+    """
+    summary = MetricsSummary()
+    my_dbc.add_listener(summary)
+    latencies = []
+    failures = []
+    transferred = 0
+
+    def timed(job):
+        start = time.perf_counter()
+        result = run_job(my_dbc, *job, output_dir, chunk_size)
+        return result, time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers = concurrency) as executor:
+            futures = {executor.submit(timed, job): job for job in jobs}
+            for future in as_completed(futures):
+                number = futures[future][0]
+                error = future.exception()
+                if error != None:
+                    failures.append({'line': number, 'error': f'{type(error).__name__}: {error}'})
+                    if progress != None:
+                        print(f'line {number}: {type(error).__name__}: {error}', file = progress)
+                    continue
+                (size, _), latency = future.result()
+                transferred += size
+                latencies.append(latency)
+    finally:
+        my_dbc.remove_listener(summary)
+    seconds = time.perf_counter() - start
+
+    counters = {}
+    for coverage in summary.report().values():
+        for counter in ('cache_hits', 'retries', 'failovers'):
+            counters[counter] = counters.get(counter, 0) + coverage[counter]
+    latencies.sort()
+    return {
+        'queries': len(jobs),
+        'succeeded': len(latencies),
+        'failed': len(failures),
+        'seconds': seconds,
+        'queries_per_second': len(latencies) / seconds if seconds > 0 else None,
+        # decompressed content, the bytes on the wire can be fewer
+        'content_bytes': transferred,
+        'content_bytes_per_second': transferred / seconds if seconds > 0 else None,
+        'latency': {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                    'p99': percentile(latencies, 99), 'max': latencies[-1]} if latencies else None,
+        'cache_hits': counters.get('cache_hits', 0),
+        'retries': counters.get('retries', 0),
+        'failovers': counters.get('failovers', 0),
+        'failures': sorted(failures, key = lambda failure: failure['line']),
+    }
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Runs a file of WCPS queries and reports the throughput of the run.')
+    parser.add_argument('queries', nargs = '?', default = '-',
+                        help = 'file with one query or JSON object per line, stdin by default')
+    parser.add_argument('--url', action = 'append', required = True,
+                        help = 'WCPS endpoint, can be repeated to fail over between several ones')
+    parser.add_argument('--concurrency', type = int, default = 10, help = 'queries in flight at once')
+    parser.add_argument('--retries', type = int, default = 3, help = 'retries of a query after a 5xx answer')
+    parser.add_argument('--timeout', type = float, default = 60, help = 'seconds to wait for an answer')
+    parser.add_argument('--cache', help = 'directory of a disk cache shared with earlier runs')
+    parser.add_argument('--output-dir', help = 'where results are written, output paths are relative to it')
+    parser.add_argument('--report', help = 'file to write the JSON summary to, stdout by default')
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+
+    if args.queries == '-':
+        jobs = read_jobs(sys.stdin)
+    else:
+        with open(args.queries, encoding = 'utf-8') as queries_file:
+            jobs = read_jobs(queries_file)
+    cache = DiskCache(args.cache) if args.cache else None
+    my_dbc = dbc(args.url, pool_size = args.concurrency, timeout = (5, args.timeout), retries = args.retries,
+                 cache = cache)
+    try:
+        summary = run(my_dbc, jobs, args.concurrency, args.output_dir, progress = sys.stderr)
+    finally:
+        my_dbc.close()
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(summary, report_file, indent = 2)
+    else:
+        json.dump(summary, sys.stdout, indent = 2)
+        print()
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())